@@ -19,6 +19,7 @@
 
 import argparse
 import logging
+import os
 import sys
 
 pythondir = '@pythondir@'
@@ -28,31 +29,71 @@ if not pythondir.startswith('@'):
 
 from ceiba_dl.config import Config
 
-def progress_callback(path, total_to_download, downloaded, *args):
-    if downloaded == None:
-        if not total_to_download:
-            sys.stderr.write('\r{}: 0%'.format(path))
-        else:
-            sys.stderr.write('\r{}: 100%'.format(path))
-    else:
-        total_to_download_mib = total_to_download / 2**20
-        downloaded_mib = downloaded / 2**20
-        if downloaded != total_to_download:
-            sys.stderr.write('\r{}: {}% ({:.2f}/{:.2f} MiB)'.format(path,
-                downloaded * 100 // total_to_download,
-                downloaded_mib, total_to_download_mib))
-        elif downloaded == 0:
-            sys.stderr.write('\r{}: 0% ({:.2f}/{:.2f} MiB)'.format(path,
-                downloaded_mib, total_to_download_mib))
-        else:
-            sys.stderr.write('\r{}: 100% ({:.2f}/{:.2f} MiB)'.format(path,
-                downloaded_mib, total_to_download_mib))
+# get、cat 的進度都回報到 ceiba_dl.progress，由另一個執行緒負責顯示在終端機上
+# 和寫入 --progress-json 指定的檔案描述子。顯示進度時記錄訊息也要經過進度顯示，
+# 才不會和進度混在一起
+def start_progress(args, show):
+    from ceiba_dl.progress import progress, Display
+    if not show and args.progress_json_output == None:
+        return None
+    progress.enable()
+    display = Display(progress, sys.stderr if show else None,
+        args.progress_json_output)
+    if display.terminal:
+        for handler in logging.getLogger().handlers:
+            if isinstance(handler, logging.StreamHandler) and \
+                handler.stream is sys.stderr:
+                handler.setStream(display)
+    display.start()
+    return display
+
+def stop_progress(display):
+    if display == None:
+        return
+    display.stop()
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.StreamHandler) and \
+            handler.stream is display:
+            handler.setStream(sys.stderr)
+
+# 執行結束時顯示請求統計，並依照選項寫入 JSON 和 Prometheus textfile 格式
+def report_stats(args, request, show_summary=False):
+    logger = logging.getLogger('ceiba-dl-stats')
+    if len(request.stats.endpoints) == 0:
+        return True
+    if show_summary or args.stats:
+        sys.stderr.write(request.stats.summary())
+    succeeded = True
+    for path, write in [(args.stats_json, request.stats.write_json),
+        (args.stats_prometheus, request.stats.write_prometheus)]:
+        if not path:
+            continue
+        try:
+            write(path)
+        except OSError as err:
+            logger.error('無法寫入統計資料至 {}：{}'.format(path, err))
+            succeeded = False
+    return succeeded
+
+# 使用 --har 時每個請求都會記錄到同一個 HarRecorder
+def create_request(args, config):
+    from ceiba_dl import Request
+    request = Request(config.api_cookies, config.web_cookies,
+        network=config.network, governor=config.governor)
+    request.har = args.har_recorder
+    return request
+
+def nonnegative_int(value):
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError('{} 不可以是負數'.format(value))
+    return number
 
 def run_api(args, config):
-    from ceiba_dl import Request, Error
+    from ceiba_dl import Error
     logger = logging.getLogger('ceiba-dl-api')
 
-    request = Request(config.api_cookies, config.web_cookies)
+    request = create_request(args, config)
     query_fields = dict()
     for field in args.field:
         query_fields[field[0]] = field[1]
@@ -61,97 +102,185 @@ def run_api(args, config):
         result = request.api(query_fields)
     except Error as err:
         logger.error(err)
+        report_stats(args, request)
         return False
 
     from pprint import pprint
     pprint(result)
-    return True
+    return report_stats(args, request)
 
 def run_cat(args, config):
-    from ceiba_dl import Request, Cat, Error
+    from ceiba_dl import Cat
+    from ceiba_dl.cache import Cache
+    from ceiba_dl.progress import progress
     from ceiba_dl.vfs import VFS
-    from time import monotonic
     logger = logging.getLogger('ceiba-dl-cat')
 
     if len(args.file) == 0:
         return True
 
-    request = Request(config.api_cookies, config.web_cookies)
-    vfs = VFS(request, config.strings, config.edit)
-    cat = Cat(vfs)
+    request = create_request(args, config)
+    cache = Cache(config.name, config.profile, config.cache)
+    cache.load()
+    vfs = VFS(request, config.strings, config.edit, cache=cache)
+    cat = Cat(vfs, logger=logger)
     failed = False
-    for path in args.file:
-        try:
-            progress_callback_used = False
-            last_update_time = 0
-            def cat_progress_callback(total_to_download, downloaded, *args):
-                nonlocal progress_callback_used
-                nonlocal last_update_time
-                if downloaded != None:
-                    current_time = monotonic()
-                    if total_to_download == downloaded or \
-                       current_time - last_update_time >= 0.1:
-                        progress_callback_used = True
-                        last_update_time = current_time
-                        progress_callback(
-                            path, total_to_download, downloaded, *args)
-            cat.run(sys.stdout.buffer, path,
-                progress_callback=cat_progress_callback)
-            if progress_callback_used:
-                sys.stderr.write('\n')
-        except Error as err:
-            failed = True
-            logger.error(err)
-    return not failed
+
+    def cat_progress_callback(path, total_to_download, downloaded, *args):
+        if downloaded != None:
+            progress.update(path, total_to_download, downloaded)
+
+    def error_callback(path, err):
+        nonlocal failed
+        failed = True
+        logger.error(err)
+
+    # 內容直接輸出到終端機時不能顯示進度，不然會蓋掉輸出的內容
+    display = start_progress(args, not sys.stdout.isatty())
+    try:
+        cat.run_all(sys.stdout.buffer, args.file,
+            progress_callback=cat_progress_callback,
+            end_callback=progress.finish, error_callback=error_callback,
+            offset=args.offset, length=args.length)
+    finally:
+        stop_progress(display)
+    cache.store()
+    return report_stats(args, request) and not failed
 
 def run_get(args, config):
-    from ceiba_dl import Request, Get
+    from ceiba_dl import Get, Plan, Error
+    from ceiba_dl.cache import Cache
+    from ceiba_dl.progress import progress
+    from ceiba_dl.store import Store
     from ceiba_dl.vfs import VFS
-    from time import monotonic
     logger = logging.getLogger('ceiba-dl-get')
 
     if len(args.file) == 0:
         args.file.append('/')
 
-    request = Request(config.api_cookies, config.web_cookies)
-    vfs = VFS(request, config.strings, config.edit)
-    get = Get(vfs, logger)
+    request = create_request(args, config)
+    cache = Cache(config.name, config.profile, config.cache)
+    cache.load()
+    vfs = VFS(request, config.strings, config.edit, cache=cache)
+    if args.dedup:
+        store = Store()
+        store.load()
+    else:
+        store = None
+    if args.plan:
+        succeeded = run_get_plan(args, logger, request, cache, vfs, store)
+        cache.store()
+        return report_stats(args, request) and succeeded
+    if args.execute_plan:
+        plan = Plan(vfs, logger, store=store)
+        try:
+            plan.load(args.execute_plan)
+        except (OSError, ValueError, KeyError, Error) as err:
+            logger.error('無法讀取計畫 {}：{}'.format(args.execute_plan, err))
+            return False
+        transfer = plan.totals()['transfer']
+        progress.plan(files=transfer['files'], size=transfer['bytes'])
+    else:
+        plan = None
+    get = Get(vfs, logger, store=store, scheduler=create_scheduler(args, config))
     succeeded = True
-    for path in args.file:
-        last_progress_update = 0
-
-        def download_callback(path, total_to_download, downloaded, *args):
-            nonlocal last_progress_update
-            current = monotonic()
-            if downloaded == None or total_to_download == downloaded or \
-                current - last_progress_update >= 0.1:
-                last_progress_update = current
-                progress_callback(path, total_to_download, downloaded, *args)
-
-        def end_callback(path):
-            nonlocal last_progress_update
-            last_progress_update = 0
-            sys.stderr.write('\n')
-
-        if args.no_progress:
-            succeeded = succeeded and get.run(path, retry=args.retry)
+    progress.status = request.governor.describe
+    display = start_progress(args, not args.no_progress)
+
+    def download_callback(path, total_to_download, downloaded, *args):
+        progress.update(path, total_to_download, downloaded)
+
+    if display == None:
+        callbacks = dict()
+    else:
+        callbacks = dict(download_progress_callback=download_callback,
+            end_download_callback=progress.finish)
+    try:
+        if plan:
+            succeeded = plan.execute(retry=args.retry,
+                scheduler=get.scheduler, **callbacks)
         else:
-            succeeded = succeeded and get.run(path, retry=args.retry,
-                download_progress_callback=download_callback,
-                end_download_callback=end_callback)
+            succeeded = get.run_all(args.file, retry=args.retry, **callbacks)
+    finally:
+        stop_progress(display)
+    # 記錄這次的下載速度，下次建立計畫時用來預估時間
+    throughput, latency = request.stats.throughput('file')
+    if throughput != None:
+        cache.set('throughput', 'file', [throughput, latency])
+    cache.store()
+    if store:
+        store.store()
+    return report_stats(args, request, show_summary=True) and succeeded
+
+# 命令列指定的 --priority 比設定檔的 course_priority 優先
+def create_scheduler(args, config):
+    from ceiba_dl.scheduler import Scheduler
+    download = config.download
+    download['course_priority'] = args.priority + \
+        download.get('course_priority', [])
+    return Scheduler(download,
+        large_file_size=config.network.get('large_file_size', 0))
+
+def run_get_plan(args, logger, request, cache, vfs, store):
+    from ceiba_dl import Plan
+    from ceiba_dl.progress import format_duration
+    plan = Plan(vfs, logger, store=store)
+    succeeded = True
+    for path in args.file:
+        succeeded = plan.walk(path) and succeeded
+
+    descriptions = {'new': '新增', 'changed': '變更'}
+    for entry in plan.entries:
+        if entry['type'] == 'file' and entry['status'] in descriptions:
+            print('{} {} ({:.2f} MiB)'.format(descriptions[entry['status']],
+                entry['path'], (entry['size'] or 0) / 2**20))
+    totals = plan.totals()
+    for status, description in [('new', '新檔案'), ('changed', '變更的檔案'),
+        ('unchanged', '沒有變更的檔案'), ('error', '無法查詢的項目')]:
+        print('{}：{} 個，{:.2f} MiB'.format(description,
+            totals[status]['files'], totals[status]['bytes'] / 2**20))
+    transfer = totals['transfer']
+    print('需要下載：{:.2f} MiB，約 {} 個請求，另外要建立 {} 個資料夾和 {} 個' \
+        '符號連結'.format(transfer['bytes'] / 2**20, transfer['requests'],
+        transfer['directories'], transfer['links']))
+
+    # 下載速度只能從之前的 get 得知，等待時間則優先使用這次 HEAD 請求的結果
+    previous = cache.get('throughput', 'file', [None, None])
+    throughput = previous[0]
+    latency = request.stats.throughput('file HEAD')[1] or previous[1]
+    duration = plan.estimate(throughput, latency)
+    if duration == None:
+        print('預估時間：還沒有下載過檔案，無法預估')
+    else:
+        print('預估時間：{}（下載速度 {:.2f} MiB/s，每個請求等待 {:.2f} 秒）' \
+            .format(format_duration(duration), throughput / 2**20,
+            latency or 0))
+
+    try:
+        plan.write(args.plan)
+    except OSError as err:
+        logger.error('無法寫入計畫 {}：{}'.format(args.plan, err))
+        return False
+    print('計畫已寫入 {}，可以用 get --execute-plan {} 執行'.format(
+        args.plan, args.plan))
     return succeeded
 
 def run_ls(args, config):
-    from ceiba_dl import Request, Ls, Error
+    from ceiba_dl import Ls, Error
+    from ceiba_dl.cache import Cache
     from ceiba_dl.vfs import VFS
     logger = logging.getLogger('ceiba-dl-ls')
 
     if len(args.file) == 0:
         args.file.append('/')
 
-    request = Request(config.api_cookies, config.web_cookies)
-    vfs = VFS(request, config.strings, config.edit)
-    lser = Ls(vfs, details=args.long, recursive=args.recursive)
+    request = create_request(args, config)
+    cache = Cache(config.name, config.profile, config.cache)
+    cache.load()
+    vfs = VFS(request, config.strings, config.edit, cache=cache)
+    lser = Ls(vfs, details=args.long or args.sort != None,
+        recursive=args.recursive, sort=args.sort, prefetch=args.prefetch,
+        ordered=not args.unordered, logger=logger)
     failed = False
     for path in args.file:
         try:
@@ -159,7 +288,125 @@ def run_ls(args, config):
         except Error as err:
             failed = True
             logger.error(err)
-    return not failed
+    cache.store()
+    return report_stats(args, request) and not failed
+
+def run_daemon(args, config):
+    from ceiba_dl.client import run_client
+    from ceiba_dl.daemon import Daemon
+    logger = logging.getLogger('ceiba-dl-daemon')
+
+    if args.stop:
+        result = run_client(config.name, config.profile,
+            {'command': 'stop'}, sys.stdout.buffer, sys.stderr)
+        if result == None:
+            logger.error('沒有正在執行的常駐程式')
+            return False
+        return result
+
+    daemon = Daemon(config, idle_timeout=args.idle_timeout,
+        memory_limit=args.memory_limit * 2**20)
+    return daemon.run()
+
+# 如果常駐程式正在執行，就把 cat、get、ls 交給它處理
+def run_via_daemon(args, config, log_level, log_format):
+    from ceiba_dl.client import run_client
+
+    # 常駐程式不支援下載計畫
+    if args.func == run_get and (args.plan or args.execute_plan):
+        return None
+
+    job = {
+        'command': args.func.__name__[len('run_'):],
+        'files': list(args.file),
+        'cwd': os.getcwd(),
+        'log_level': log_level,
+        'log_format': log_format
+    }
+    if args.func == run_cat:
+        if len(job['files']) == 0:
+            return True
+    else:
+        if len(job['files']) == 0:
+            job['files'].append('/')
+    if args.func == run_cat:
+        job['offset'] = args.offset
+        job['length'] = args.length
+    if args.func == run_get:
+        job['dedup'] = args.dedup
+        job['no_progress'] = args.no_progress
+        job['retry'] = args.retry
+        job['priority'] = args.priority
+    if args.func == run_ls:
+        job['long'] = args.long
+        job['recursive'] = args.recursive
+        job['sort'] = args.sort
+        job['prefetch'] = args.prefetch
+        job['unordered'] = args.unordered
+
+    from ceiba_dl.progress import progress
+    if args.func == run_get:
+        display = start_progress(args, not args.no_progress)
+    elif args.func == run_cat:
+        display = start_progress(args, not sys.stdout.isatty())
+    else:
+        display = None
+    if display != None and display.output != None:
+        stderr = display
+    else:
+        stderr = sys.stderr
+    try:
+        return run_client(config.name, config.profile, job,
+            sys.stdout.buffer, stderr, progress_callback=progress.update,
+            end_callback=progress.finish)
+    finally:
+        stop_progress(display)
+
+def run_mount(args, config):
+    from ceiba_dl.cache import Cache
+    from ceiba_dl.vfs import VFS
+    import xdg.BaseDirectory
+    logger = logging.getLogger('ceiba-dl-mount')
+
+    try:
+        from ceiba_dl.mount import mount
+    except (ImportError, OSError) as err:
+        logger.error('無法載入 fusepy，不能使用掛載功能：{}'.format(err))
+        return False
+
+    request = create_request(args, config)
+    cache = Cache(config.name, config.profile, config.cache)
+    cache.load()
+    vfs = VFS(request, config.strings, config.edit, cache=cache)
+    block_dir = os.path.join(xdg.BaseDirectory.xdg_cache_home,
+        config.name, 'blocks', config.profile)
+    try:
+        mount(vfs, args.mountpoint, block_dir,
+            cache_size=args.cache_size * 2**20)
+    except RuntimeError as err:
+        logger.error('無法掛載至 {}：{}'.format(args.mountpoint, err))
+        return False
+    finally:
+        cache.store()
+    return report_stats(args, request)
+
+def run_analyze(args, config):
+    from ceiba_dl.har import analyze
+    import json
+    logger = logging.getLogger('ceiba-dl-analyze')
+
+    try:
+        with open(args.file) as har_file:
+            har = json.load(har_file)
+    except (OSError, ValueError) as err:
+        logger.error('無法讀取 HAR 檔案 {}：{}'.format(args.file, err))
+        return False
+    try:
+        analyze(har, sys.stdout, limit=args.limit)
+    except (KeyError, TypeError) as err:
+        logger.error('HAR 檔案 {} 的格式不正確：{}'.format(args.file, err))
+        return False
+    return True
 
 def run_login(args, config):
     from ceiba_dl.helper import Login
@@ -175,6 +422,12 @@ if __name__ == '__main__':
     app = argparse.ArgumentParser(add_help=False,
         description='NTU CEIBA 資料下載工具' + version)
     sub = app.add_subparsers(title='可用的子指令')
+    cmd_analyze = sub.add_parser('analyze', help='分析 --har 產生的記錄')
+    cmd_analyze.set_defaults(func=run_analyze)
+    cmd_analyze.add_argument('-n', '--limit', type=nonnegative_int, default=20,
+        help='每一項最多列出幾筆')
+    cmd_analyze.add_argument('file', type=str,
+        help='HAR 檔案名稱')
     cmd_api = sub.add_parser('api', help='直接使用 NTU CEIBA API')
     cmd_api.set_defaults(func=run_api)
     cmd_api.add_argument('field', nargs='*',
@@ -184,10 +437,30 @@ if __name__ == '__main__':
     cmd_cat.set_defaults(func=run_cat)
     cmd_cat.add_argument('file', nargs='*', type=str,
         help='要查看的檔案名稱')
+    cmd_cat.add_argument('--offset', type=nonnegative_int, default=None,
+        help='從第幾個位元組開始顯示，網路上的檔案會使用 HTTP Range 請求')
+    cmd_cat.add_argument('--length', type=nonnegative_int, default=None,
+        help='最多顯示幾個位元組')
+    cmd_cat.add_argument('--stdin', action='store_true',
+        help='從標準輸入讀取要查看的檔案名稱，每行一個')
     cmd_get = sub.add_parser('get', help='下載資料')
     cmd_get.set_defaults(func=run_get)
+    cmd_get.add_argument('-d', '--dedup', action='store_true',
+        help='將下載的檔案存進 .ceiba-dl-store 並以硬連結取代重複的檔案')
+    cmd_get_plan = cmd_get.add_mutually_exclusive_group()
+    cmd_get_plan.add_argument('--plan', nargs='?', const='.ceiba-dl-plan.json',
+        metavar='檔案', help='不要下載，只列出要下載的檔案、大小和預估時間，'
+            '並將計畫寫入檔案')
+    cmd_get_plan.add_argument('--execute-plan', nargs='?',
+        const='.ceiba-dl-plan.json', metavar='檔案',
+        help='依照 --plan 建立的計畫下載，不需要重新讀取所有資料夾')
+    cmd_get.add_argument('--priority', action='append', default=[],
+        metavar='樣式', help='優先下載符合這個 glob 樣式的路徑，可以使用多次，'
+            '前面的優先')
     cmd_get.add_argument('-s', '--no-progress', action='store_true',
         help='不要顯示下載進度列')
+    cmd_get.add_argument('--stdin', action='store_true',
+        help='從標準輸入讀取要下載的檔案名稱，每行一個')
     cmd_get.add_argument('-t', '--retry',
         type=lambda x: int(x) if int(x) >= 0 else 0, default=3,
         help='自動重試的次數')
@@ -199,13 +472,38 @@ if __name__ == '__main__':
         help='顯示檔案詳細資訊')
     cmd_ls.add_argument('-r', '--recursive', action='store_true',
         help='遞迴列出子目錄')
+    cmd_ls.add_argument('--sort', choices=['size', 'time'],
+        help='依照檔案大小或修改時間排序，大的和新的在前面，會自動啟用 -l')
+    cmd_ls.add_argument('--prefetch', metavar='N',
+        type=lambda x: int(x) if int(x) >= 0 else 0, default=0,
+        help='用另一個執行緒讀取資料夾，最多領先輸出 N 個資料夾，預設不使用')
+    cmd_ls.add_argument('--unordered', action='store_true',
+        help='先列出已經讀取過的資料夾，不維持原本的順序')
     cmd_ls.add_argument('file', nargs='*', type=str,
         help='要查看的資料夾名稱')
+    cmd_daemon = sub.add_parser('daemon', help='執行常駐程式')
+    cmd_daemon.set_defaults(func=run_daemon)
+    cmd_daemon.add_argument('--idle-timeout', type=int, default=600,
+        metavar='秒數', help='閒置多久以後自動結束')
+    cmd_daemon.add_argument('--memory-limit', type=int, default=512,
+        metavar='MiB', help='記憶體用量超過多少時清除已下載的資料')
+    cmd_daemon.add_argument('--stop', action='store_true',
+        help='結束正在執行的常駐程式')
+    cmd_mount = sub.add_parser('mount', help='以 FUSE 掛載成檔案系統')
+    cmd_mount.set_defaults(func=run_mount)
+    cmd_mount.add_argument('--cache-size', type=int, default=256,
+        metavar='MiB', help='保存檔案內容的區塊最多使用多少磁碟空間')
+    cmd_mount.add_argument('mountpoint', type=str,
+        help='要掛載的資料夾')
     cmd_login = sub.add_parser('login', help='登入網站')
     cmd_login.set_defaults(func=run_login)
     cmd_login.add_argument('-n', '--dry-run', action='store_true',
         help='測試模式：不要將取得的登入資訊寫入設定檔')
     opt = app.add_argument_group(title='可用的選項')
+    opt.add_argument('--har', action='store', metavar='檔案',
+        help='結束時將所有 HTTP 請求寫入 HAR 檔案')
+    opt.add_argument('--har-bodies', action='store_true',
+        help='HAR 檔案中也記錄 API 和網頁的回應內容')
     opt.add_argument('--help', action='help',
         help='顯示說明訊息並離開')
     opt.add_argument('--log-level', action='store', metavar='層級',
@@ -213,8 +511,34 @@ if __name__ == '__main__':
         help='要記錄的訊息層級', default='WARNING')
     opt.add_argument('--log-time', action='store_true',
         help='記錄訊息產生的時間')
+    opt.add_argument('--no-daemon', action='store_true',
+        help='即使常駐程式正在執行也不要使用')
     opt.add_argument('-p', '--profile', action='store', metavar='設定檔',
         help='選擇要使用的設定檔', default='default')
+    opt.add_argument('--progress-json', action='store', metavar='FD',
+        type=nonnegative_int, default=None,
+        help='將下載進度以每行一個 JSON 的格式寫入這個檔案描述子')
+    opt.add_argument('--profile-cpu', action='store', metavar='檔案',
+        help='用 cProfile 執行子指令並將結果寫入檔案')
+    opt.add_argument('--profile-cpu-format', action='store', metavar='格式',
+        choices=['pstats', 'collapsed'], default='pstats',
+        help='CPU 分析結果的格式，pstats 可以用 python -m pstats 開啟，'
+            'collapsed 是 flamegraph.pl 使用的格式')
+    opt.add_argument('--profile-mem', action='store_true',
+        help='用 tracemalloc 記錄各階段的記憶體用量，結束時顯示配置最多記憶體'
+            '的程式碼和 RSS 峰值')
+    opt.add_argument('--stats', action='store_true',
+        help='結束時顯示各類請求的統計表')
+    opt.add_argument('--stats-json', action='store', metavar='檔案',
+        help='結束時將請求統計寫入 JSON 檔案')
+    opt.add_argument('--stats-prometheus', action='store', metavar='檔案',
+        help='結束時將請求統計寫入 Prometheus textfile collector 格式的檔案')
+    opt.add_argument('--trace', action='store', metavar='檔案',
+        help='記錄節點下載、HTTP 請求和網頁解析的時間並寫入檔案')
+    opt.add_argument('--trace-format', action='store', metavar='格式',
+        choices=['chrome', 'collapsed'], default='chrome',
+        help='追蹤記錄的格式，chrome 是 Chrome trace event JSON，'
+            'collapsed 是 flamegraph.pl 使用的格式')
     opt.add_argument('-v', '--verbose', action='store_true',
         help='顯示各項操作詳細資訊')
     args = app.parse_args(sys.argv[1:])
@@ -236,8 +560,72 @@ if __name__ == '__main__':
         logging.error('沒有指定子指令')
         exit(1)
 
+    # 從標準輸入讀到的路徑接在命令列的路徑後面，一起排入同一個工作佇列
+    if getattr(args, 'stdin', False):
+        args.file.extend(filter(lambda x: len(x) > 0,
+            map(lambda x: x.rstrip('\r\n'), sys.stdin)))
+
+    if args.progress_json != None:
+        try:
+            args.progress_json_output = os.fdopen(args.progress_json, 'w',
+                buffering=1, closefd=False)
+        except OSError as err:
+            logging.error('無法開啟檔案描述子 {}：{}'.format(
+                args.progress_json, err))
+            exit(1)
+    else:
+        args.progress_json_output = None
+
     config = Config(profile=args.profile)
     if not config.load():
         exit(1)
 
-    exit(0 if args.func(args, config) else 1)
+    # 常駐程式的統計是累積的，要輸出統計資料、追蹤或分析記錄時不使用常駐程式
+    use_daemon = not (args.no_daemon or args.stats or args.stats_json or
+        args.stats_prometheus or args.trace or args.har or
+        args.profile_cpu or args.profile_mem)
+    if args.func in [run_cat, run_get, run_ls] and use_daemon:
+        result = run_via_daemon(args, config, log_level_number, log_format)
+        if result != None:
+            exit(0 if result else 1)
+
+    # HAR 記錄中請求所屬的節點是從追蹤記錄取得的
+    if args.trace or args.har:
+        from ceiba_dl.trace import tracer
+        tracer.enable()
+    if args.har:
+        from ceiba_dl.har import HarRecorder
+        args.har_recorder = HarRecorder(include_bodies=args.har_bodies)
+    else:
+        args.har_recorder = None
+    if args.profile_mem:
+        from ceiba_dl.profiler import memory
+        memory.enable()
+    if args.profile_cpu:
+        from ceiba_dl.profiler import write_cpu_profile
+        import cProfile
+        profile = cProfile.Profile()
+        result = profile.runcall(args.func, args, config)
+        try:
+            write_cpu_profile(profile, args.profile_cpu, args.profile_cpu_format)
+        except OSError as err:
+            logging.error('無法寫入 CPU 分析結果至 {}：{}'.format(
+                args.profile_cpu, err))
+            result = False
+    else:
+        result = args.func(args, config)
+    if args.profile_mem:
+        memory.report(sys.stderr)
+    if args.har:
+        try:
+            args.har_recorder.write(args.har)
+        except OSError as err:
+            logging.error('無法寫入 HAR 檔案至 {}：{}'.format(args.har, err))
+            result = False
+    if args.trace:
+        try:
+            tracer.write(args.trace, args.trace_format)
+        except OSError as err:
+            logging.error('無法寫入追蹤記錄至 {}：{}'.format(args.trace, err))
+            result = False
+    exit(0 if result else 1)
@@ -0,0 +1,68 @@
+# License: LGPL3+
+
+from tempfile import NamedTemporaryFile
+import os
+import shutil
+
+# 先寫到同一個資料夾中的暫存檔，寫完再改名成目標檔案，寫到一半中斷或失敗時
+# 原本的檔案不受影響，同時讀取的其他程式也不會看到不完整的內容。改名時權限和
+# 直接用 open 寫入相同：取代既有檔案時沿用原本的權限，新檔案則依照 umask，
+# 也可以用 permissions 指定
+
+_umask = os.umask(0)
+os.umask(_umask)
+
+class AtomicFile:
+    def __init__(self, path, mode='w', directory=None, prefix='.ceiba-dl-',
+        permissions=None):
+        self.path = str(path) if path != None else None
+        if directory == None:
+            directory = os.path.dirname(os.path.abspath(self.path))
+        self.permissions = permissions
+        self.file = NamedTemporaryFile(mode=mode, dir=str(directory),
+            prefix=prefix, delete=False)
+        self.temp_path = self.file.name
+
+    def write(self, data):
+        return self.file.write(data)
+
+    # 目標檔案要等寫完才知道時可以在這裡指定
+    def commit(self, path=None):
+        path = str(path) if path != None else self.path
+        self.file.close()
+        try:
+            if self.permissions != None:
+                os.chmod(self.temp_path, self.permissions)
+            elif os.path.exists(path):
+                shutil.copymode(path, self.temp_path)
+            else:
+                os.chmod(self.temp_path, 0o666 & ~_umask)
+            os.replace(self.temp_path, path)
+        except OSError:
+            self.discard()
+            raise
+        self.temp_path = None
+
+    def discard(self):
+        self.file.close()
+        if self.temp_path != None:
+            try:
+                os.unlink(self.temp_path)
+            except OSError:
+                pass
+            self.temp_path = None
+
+    def __enter__(self):
+        return self
+
+    # 沒有發生錯誤而且還沒有處理過暫存檔時才改名
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type != None:
+            self.discard()
+        elif self.temp_path != None:
+            self.commit()
+        return False
+
+def write_atomic(path, content, mode='w', permissions=None):
+    with AtomicFile(path, mode=mode, permissions=permissions) as atomic_file:
+        atomic_file.write(content)
@@ -0,0 +1,138 @@
+# License: LGPL3+
+
+from .atomic import AtomicFile
+import json
+import logging
+import os
+import time
+import xdg.BaseDirectory
+
+# 跨次執行保留的快取，內容是一個兩層的 JSON 物件：第一層是區段名稱，第二層是
+# 項目名稱，每個項目會記錄寫入的時間，讀取時依照設定檔的 <區段>_ttl 判斷是否
+# 已經過期。沒有啟用時仍然可以使用，只是資料只會存在記憶體中。
+
+class Cache:
+    def __init__(self, name='ceiba-dl', profile='default', settings={}):
+        self._logger = logging.getLogger(__name__)
+        self._data = dict()
+        self._deleted = set()
+        self._changed = False
+        self.name = name
+        self.profile = profile
+        self.settings = settings
+
+    @property
+    def enabled(self):
+        return self.settings.get('enabled', False)
+
+    @property
+    def path(self):
+        return os.path.join(xdg.BaseDirectory.xdg_cache_home,
+            self.name, '{}.json'.format(self.profile))
+
+    def load(self):
+        if not self.enabled:
+            return True
+
+        # 檔案不存在就算了
+        cache_path = self.path
+        if not os.path.exists(cache_path):
+            return True
+
+        self._logger.info('準備讀取快取檔 {}'.format(cache_path))
+
+        data = self.read()
+        if data != None:
+            self._data = data
+            self.prune()
+        return True
+
+    def read(self):
+        try:
+            with open(self.path, 'r') as cache_file:
+                data = json.load(cache_file)
+        except (IOError, ValueError) as err:
+            # 快取壞掉不影響正常使用，重新建立就好
+            self._logger.warning('無法載入快取檔：{}'.format(err))
+            return None
+        if not isinstance(data, dict):
+            return None
+        return data
+
+    # 常駐程式或同時執行的其他程式可能在載入以後又寫入了快取檔，寫入前先把
+    # 檔案中比較新的項目合併進來，才不會蓋掉別人剛存的資料
+    def merge(self):
+        if not os.path.exists(self.path):
+            return
+        data = self.read()
+        if data == None:
+            return
+        for section, entries in data.items():
+            if not isinstance(entries, dict):
+                continue
+            mine = self._data.setdefault(section, dict())
+            for key, entry in entries.items():
+                if (section, key) in self._deleted:
+                    continue
+                if key not in mine or mine[key]['time'] < entry['time']:
+                    mine[key] = entry
+        self.prune()
+
+    def store(self):
+        if not self.enabled or not self._changed:
+            return True
+
+        cache_path = self.path
+        cache_dir = os.path.dirname(cache_path)
+        self._logger.info('準備寫入快取檔 {}'.format(cache_path))
+        self.merge()
+
+        # 快取中有學生的個人資料，只讓自己讀取
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with AtomicFile(cache_path, permissions=0o600) as cache_file:
+                json.dump(self._data, cache_file, ensure_ascii=False)
+        except IOError as err:
+            self._logger.error('無法寫入快取檔：{}'.format(err))
+            return False
+
+        self._deleted.clear()
+        self._changed = False
+        return True
+
+    def ttl(self, section):
+        return self.settings.get('{}_ttl'.format(section), None)
+
+    # 過期的項目不會再被讀取，直接刪掉，快取檔才不會一直變大
+    def prune(self):
+        now = time.time()
+        for section, entries in self._data.items():
+            ttl = self.ttl(section)
+            if ttl == None:
+                continue
+            for key in list(filter(
+                lambda x: now - entries[x]['time'] > ttl, entries)):
+                del entries[key]
+                self._changed = True
+
+    def get(self, section, key, default=None):
+        entry = self._data.get(section, {}).get(key, None)
+        if entry == None:
+            return default
+        ttl = self.ttl(section)
+        if ttl != None and time.time() - entry['time'] > ttl:
+            return default
+        return entry['value']
+
+    def set(self, section, key, value):
+        if section not in self._data:
+            self._data[section] = dict()
+        self._data[section][key] = {'time': time.time(), 'value': value}
+        self._deleted.discard((section, key))
+        self._changed = True
+
+    def delete(self, section, key):
+        if key in self._data.get(section, {}):
+            del self._data[section][key]
+            self._deleted.add((section, key))
+            self._changed = True
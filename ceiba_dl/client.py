@@ -0,0 +1,87 @@
+# License: LGPL3+
+
+from tempfile import gettempdir
+import json
+import logging
+import os
+import socket
+import struct
+
+# 連線到常駐程式的用戶端。每次執行 ceiba-dl 都會先試著連線，所以這裡只能使用
+# 載入很快的模組，不能載入 pycurl 和 lxml。
+#
+# 用戶端送出一行 JSON 表示要執行的指令，常駐程式回傳一連串的訊框，每個訊框的
+# 開頭是一個位元組的頻道名稱和四個位元組的長度：
+#   O 標準輸出的內容
+#   E 標準錯誤的內容，例如記錄訊息
+#   P 下載進度，內容是 [路徑, 總大小, 已下載大小, 連線狀態] 的 JSON
+#   D 一個檔案的下載進度顯示結束
+#   X 指令執行結束，內容是表示是否成功的 JSON
+
+frame_header = struct.Struct('!cI')
+
+def socket_path(name, profile):
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR', None)
+    if not runtime_dir:
+        runtime_dir = os.path.join(gettempdir(),
+            '{}-{}'.format(name, os.getuid()))
+        os.makedirs(runtime_dir, mode=0o700, exist_ok=True)
+    return os.path.join(runtime_dir, '{}-{}.sock'.format(name, profile))
+
+def send_frame(conn, channel, payload):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    conn.sendall(frame_header.pack(channel, len(payload)) + payload)
+
+def recv_exactly(conn, size):
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if len(chunk) == 0:
+            return None
+        data += chunk
+    return data
+
+def recv_frame(conn):
+    header = recv_exactly(conn, frame_header.size)
+    if header == None:
+        return None, None
+    channel, size = frame_header.unpack(header)
+    payload = recv_exactly(conn, size)
+    if payload == None:
+        return None, None
+    return channel, payload
+
+# 用戶端：常駐程式沒有執行時回傳 None，讓呼叫的程式自己處理
+def run_client(name, profile, job, stdout, stderr,
+    progress_callback=lambda *x, **y: None, end_callback=lambda *x: None):
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path(name, profile))
+    except OSError:
+        conn.close()
+        return None
+
+    with conn:
+        conn.sendall(json.dumps(job).encode() + b'\n')
+        while True:
+            channel, payload = recv_frame(conn)
+            if channel == None:
+                logging.getLogger(__name__).error('常駐程式意外中斷連線')
+                return False
+            elif channel == b'O':
+                stdout.write(payload)
+                stdout.flush()
+            elif channel == b'E':
+                stderr.write(payload.decode())
+                stderr.flush()
+            elif channel == b'P':
+                path, total_to_download, downloaded, status = \
+                    json.loads(payload.decode())
+                progress_callback(path, total_to_download, downloaded,
+                    status=status)
+            elif channel == b'D':
+                end_callback(payload.decode())
+            elif channel == b'X':
+                return json.loads(payload.decode())
@@ -13,6 +13,62 @@ class Config:
     defaults = {
         'api_cookies': { },
         'web_cookies': { },
+        'cache': {
+            'enabled': 'True',
+            'downloaded_ttl': '2592000',
+            'file_info_ttl': '86400',
+            'functions_ttl': '2592000',
+            'students_ttl': '604800'
+        },
+        'network': {
+            'api_connect_timeout': '15',
+            'api_low_speed_limit': '1',
+            'api_low_speed_time': '30',
+            'api_timeout': '60',
+            'page_connect_timeout': '15',
+            'page_low_speed_limit': '1',
+            'page_low_speed_time': '30',
+            'page_timeout': '120',
+            'small_file_connect_timeout': '15',
+            'small_file_low_speed_limit': '1',
+            'small_file_low_speed_time': '30',
+            'small_file_timeout': '300',
+            'large_file_connect_timeout': '15',
+            'large_file_low_speed_limit': '1',
+            'large_file_low_speed_time': '60',
+            'large_file_timeout': '0',
+            'large_file_size': '16777216',
+            'stall_resumes': '5',
+            'retry_attempts': '4',
+            'retry_base_delay': '1',
+            'retry_max_delay': '60'
+        },
+        'governor': {
+            'rate': '20',
+            'burst': '20',
+            'max_connections': '4',
+            'api_rate': '10',
+            'api_burst': '10',
+            'api_max_connections': '1',
+            'page_rate': '10',
+            'page_burst': '10',
+            'page_max_connections': '4',
+            'file_rate': '5',
+            'file_burst': '5',
+            'file_max_connections': '4',
+            'latency_factor': '3',
+            'breaker_failures': '5',
+            'breaker_cooldown': '15',
+            'breaker_max_cooldown': '300'
+        },
+        'download': {
+            'concurrent': 'False',
+            'metadata_first': 'True',
+            'current_semester_first': 'True',
+            'course_priority': '[]',
+            'largest_first': 'True',
+            'large_connections': '2'
+        },
         'edit': {
             'add_courses': [ ],
             'add_unenrolled_courses': [ ],
@@ -353,6 +409,34 @@ class Config:
         self._config['web_cookies'] = {}
         self._config['web_cookies'].update(value)
 
+    @property
+    def cache(self):
+        cache = dict(self._config['cache'])
+        for key in cache.keys():
+            cache[key] = ast.literal_eval(cache[key])
+        return cache
+
+    @property
+    def network(self):
+        network = dict(self._config['network'])
+        for key in network.keys():
+            network[key] = ast.literal_eval(network[key])
+        return network
+
+    @property
+    def governor(self):
+        governor = dict(self._config['governor'])
+        for key in governor.keys():
+            governor[key] = ast.literal_eval(governor[key])
+        return governor
+
+    @property
+    def download(self):
+        download = dict(self._config['download'])
+        for key in download.keys():
+            download[key] = ast.literal_eval(download[key])
+        return download
+
     @property
     def edit(self):
         edit = dict(self._config['edit'])
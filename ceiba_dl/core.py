@@ -0,0 +1,1806 @@
+# License: LGPL3+
+
+from .atomic import AtomicFile
+from .governor import Governor, trouble_curl_errors
+from .profiler import phase
+from .scheduler import Scheduler
+from .stats import Stats, endpoint_name
+from .trace import span
+from collections import OrderedDict, deque
+from lxml import etree
+from tempfile import SpooledTemporaryFile
+from time import sleep
+import errno
+import io
+import json
+import logging
+import os
+import pathlib
+import pycurl
+import queue
+import random
+import shutil
+import threading
+import time
+import urllib.parse
+
+class Error(Exception):
+    def __str__(self):
+        return self.message
+
+class ServerError(Error):
+    def __init__(self, status, headers=b''):
+        from http import HTTPStatus
+        self.status = status
+        try:
+            phrase = HTTPStatus(status).phrase
+            self.message = '伺服器回傳 HTTP 狀態 {} ({})'.format(status, phrase)
+        except ValueError:
+            self.message = '伺服器回傳 HTTP 狀態 {}'.format(status)
+        self.retry_after = None
+        for header_line in headers.split(b'\r\n'):
+            if header_line.find(b':') < 0:
+                continue
+            name, value = header_line.split(b':', maxsplit=1)
+            if name.strip().lower() == b'retry-after':
+                self.retry_after = parse_retry_after(value.strip().decode())
+
+class NotJSONError(Error):
+    def __init__(self, data):
+        self.response = data
+        self.message = '伺服器回傳非 JSON 格式資料：{}'.format(
+            data.strip().replace('\r', '').replace('\n', ' '))
+
+class NoneIO:
+    def write(*x):
+        pass
+
+# Retry-After 可能是秒數或 HTTP 日期
+def parse_retry_after(value):
+    from email.utils import parsedate_to_datetime
+    from datetime import datetime, timezone
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_time = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_time - datetime.now(timezone.utc)).total_seconds(), 0)
+
+# 網路問題和伺服器暫時無法處理的狀態可以重試，其他錯誤例如 403、404 或是回傳
+# 的資料格式錯誤，重試幾次都是一樣的結果
+transient_statuses = [429, 502, 503, 504]
+
+def transient_error(err):
+    if isinstance(err, pycurl.error):
+        return err.args[0] in trouble_curl_errors
+    if isinstance(err, ServerError):
+        return err.status in transient_statuses
+    return False
+
+# 從 HTTP 回應標頭中取出檔案大小、ETag 和修改時間
+def parse_file_info(headers):
+    from email.utils import parsedate_to_datetime
+    info = {'size': None, 'etag': None, 'mtime': None}
+    for header_line in headers.split(b'\r\n'):
+        if header_line.find(b':') < 0:
+            continue
+        name, value = header_line.split(b':', maxsplit=1)
+        name = name.strip().lower()
+        if name == b'content-length':
+            info['size'] = int(value.strip())
+        elif name == b'etag':
+            info['etag'] = value.strip().decode()
+        elif name == b'last-modified':
+            try:
+                info['mtime'] = parsedate_to_datetime(
+                    value.strip().decode()).timestamp()
+            except (TypeError, ValueError):
+                pass
+    return info
+
+class CountingWriter:
+    def __init__(self, output):
+        self._output = output
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return self._output.write(data)
+
+# 伺服器忽略 Range 標頭而回傳整個檔案時，只留下要求的範圍，超過範圍後就中斷
+# 下載，不用把整個檔案傳完。錯誤頁面的內容則全部丟掉，讓重試時可以從已經寫入
+# 的位置繼續
+class RangeWriter:
+    def __init__(self, output, headers, offset, length):
+        self._output = output
+        self._headers = headers
+        self._offset = offset
+        self._length = length
+        self._position = None
+        self._discard = False
+
+    def write(self, data):
+        if self._position == None:
+            status_lines = list(filter(lambda x: x.startswith(b'HTTP/'),
+                self._headers.getvalue().split(b'\r\n')))
+            status = status_lines[-1].split()[1] if len(status_lines) > 0 \
+                else b'200'
+            if status == b'206':
+                self._position = self._offset
+            else:
+                self._position = 0
+                self._discard = not status.startswith(b'2')
+        if self._discard:
+            return len(data)
+        start = max(self._offset - self._position, 0)
+        if self._length != None:
+            end = max(self._offset + self._length - self._position, 0)
+        else:
+            end = len(data)
+        self._position += len(data)
+        if start < end:
+            self._output.write(data[start:end])
+        # 回傳的長度不同時 curl 會以 E_WRITE_ERROR 中斷
+        if self.finished:
+            return 0
+        return len(data)
+
+    @property
+    def finished(self):
+        return self._length != None and self._position != None and \
+            self._position > self._offset + self._length
+
+# Request.file_multi 的一個下載工作。輸出在開始下載時才開啟，結束時呼叫
+# done_callback(output, error)，成功時 error 是 None
+class FileJob:
+    def __init__(self, path, args={}, size=None, open_output=None,
+        progress_callback=lambda *x: None, done_callback=lambda *x: None):
+        self.path = path
+        self.args = args
+        self.size = size
+        self.open_output = open_output
+        self.progress_callback = progress_callback
+        self.done_callback = done_callback
+
+class Request:
+    def __init__(self, api_cookies, web_cookies, cipher=None, api_args={'api': '1'},
+        api_url='https://ceiba.ntu.edu.tw/course/f03067/app/login.php',
+        file_url='https://ceiba.ntu.edu.tw',
+        web_url='https://ceiba.ntu.edu.tw',
+        max_connections=4, network={}, governor={}):
+
+        self.logger = logging.getLogger(__package__)
+        self.api_cookie = ';'.join(map(lambda x: '{}={}'.format(*x), api_cookies.items()))
+        self.web_cookie = ';'.join(map(lambda x: '{}={}'.format(*x), web_cookies.items()))
+        self.api_args = api_args
+        self.api_url = api_url
+        self.file_url = file_url
+        self.web_url = web_url
+        self.api_cache = None
+        self.web_cache = dict()
+        # 切換學期和課程的請求，依照送出的順序記錄
+        self.state_requests = OrderedDict()
+        self.max_connections = max_connections
+        self.network = network
+        self.governor = Governor(governor)
+        self.stats = Stats()
+        # 使用 --har 時才會設定成 HarRecorder
+        self.har = None
+        if not cipher:
+            tls_backend = pycurl.version_info()[5].split('/')[0]
+            if tls_backend == 'OpenSSL' or tls_backend == 'LibreSSL':
+                cipher = 'ECDHE-RSA-AES128-GCM-SHA256'
+            elif tls_backend == 'GnuTLS':
+                cipher = 'ECDHE-RSA-AES128-GCM-SHA256'
+            elif tls_backend == 'NSS':
+                cipher = 'ecdhe_rsa_aes_128_gcm_sha_256'
+            else:
+                assert False, 'TLS 實作 {} 尚未支援'.format(tls_backend)
+        self.cipher = cipher
+        # 同時送出請求時使用的連線共用 DNS 和 TLS session，減少建立連線的時間
+        self.share = pycurl.CurlShare()
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        self.curl = self._create_curl()
+        self.multi_curls = list()
+
+    def _create_curl(self):
+        curl = pycurl.Curl()
+        curl.setopt(pycurl.USE_SSL, pycurl.USESSL_ALL)
+        curl.setopt(pycurl.SSL_CIPHER_LIST, self.cipher)
+        curl.setopt(pycurl.PROTOCOLS, pycurl.PROTO_HTTPS)
+        curl.setopt(pycurl.REDIR_PROTOCOLS, pycurl.PROTO_HTTPS)
+        curl.setopt(pycurl.DEFAULT_PROTOCOL, 'https')
+        curl.setopt(pycurl.FOLLOWLOCATION, False)
+        curl.setopt(pycurl.SHARE, self.share)
+        return curl
+
+    # 請求分成 api、page、small_file、large_file 四類，各自有連線逾時、低速限制和
+    # 總時間限制，沒有設定的項目都是 0，也就是使用 curl 的預設值或不限制
+    def _set_timeouts(self, curl, request_class):
+        def get(name):
+            return self.network.get('{}_{}'.format(request_class, name), 0)
+        curl.setopt(pycurl.CONNECTTIMEOUT, get('connect_timeout'))
+        curl.setopt(pycurl.LOW_SPEED_LIMIT, get('low_speed_limit'))
+        curl.setopt(pycurl.LOW_SPEED_TIME, get('low_speed_time'))
+        curl.setopt(pycurl.TIMEOUT, get('timeout'))
+
+    def _perform(self, url, request_class, head=False, writer=None):
+        self._set_timeouts(self.curl, request_class)
+        self.governor.acquire(request_class)
+        if self.har:
+            self.har.begin(self.curl, request_class)
+        try:
+            with span(endpoint_name(request_class, url, head=head), 'network',
+                url=url):
+                self.curl.perform()
+        except pycurl.error as err:
+            # 已經收到要求的範圍而主動中斷的下載不算失敗
+            if err.args[0] != pycurl.E_WRITE_ERROR or writer == None or \
+                not writer.finished:
+                self._record(request_class, self.curl, err, head=head)
+                raise
+        self._record(request_class, self.curl, head=head)
+
+    # 每個請求結束後都要更新請求速度的控制、統計資料和 HAR 記錄
+    def _record(self, request_class, curl, error=None, head=False):
+        self.governor.record_curl(request_class, curl, error)
+        self.stats.record(request_class, curl, error, head=head)
+        if self.har:
+            self.har.finish(curl, request_class, error, head=head)
+        if error != None and error.args[0] == pycurl.E_OPERATION_TIMEDOUT:
+            self.stats.events['stalls'] += 1
+
+    # 暫時性的錯誤會等一段時間後重試，等待時間以指數增加並加上隨機的抖動，
+    # 伺服器有回傳 Retry-After 時至少等待指定的時間。重試前會重新送出設定學期和
+    # 課程的請求，因為伺服器出錯時可能已經遺失了這些狀態
+    def _retry_delay(self, failures, err):
+        base_delay = self.network.get('retry_base_delay', 1)
+        max_delay = self.network.get('retry_max_delay', 60)
+        delay = random.uniform(0, min(max_delay, base_delay * 2 ** (failures - 1)))
+        if isinstance(err, ServerError) and err.retry_after != None:
+            delay = max(delay, err.retry_after)
+        return delay
+
+    def _should_retry(self, failures, err, description):
+        if not transient_error(err) or \
+            failures >= self.network.get('retry_attempts', 1):
+            return False
+        delay = self._retry_delay(failures, err)
+        self.stats.retry()
+        self.logger.warning('{}時發生錯誤：{}，{:.1f} 秒後重試第 {} 次' \
+            .format(description, err, delay, failures + 1))
+        sleep(delay)
+        return True
+
+    def _restore_state(self, skip=None):
+        for key, request in list(self.state_requests.items()):
+            if key != skip:
+                self.logger.debug('重新送出設定伺服器狀態的請求')
+                request()
+
+    def _retry(self, attempt, description, state_key=None):
+        failures = 0
+        while True:
+            try:
+                if failures > 0:
+                    self._restore_state(skip=state_key)
+                return attempt()
+            except (pycurl.error, ServerError) as err:
+                failures += 1
+                if not self._should_retry(failures, err, description):
+                    raise
+
+    def _remember_state(self, key, request):
+        self.state_requests.pop(key, None)
+        self.state_requests[key] = request
+
+    # 其他的 ceiba-dl 可能已經切換了伺服器上的學期和課程，不能再假設伺服器的狀態
+    # 和上次送出的請求相同
+    def forget_state(self):
+        self.api_cache = None
+        self.web_cache = dict()
+        self.state_requests = OrderedDict()
+
+    # 用多個連線同時下載 jobs 中的網址，每一項都是 (網址, cookie, 輸出) 的格式
+    # 注意 CEIBA 會把目前選擇的學期和課程記錄在伺服器上，所以同一批請求中不可以
+    # 包含會改變這些狀態的請求，也不能依賴同一批中其他請求的結果
+    def _perform_multi(self, jobs, nobody=False, request_class='page'):
+        while len(self.multi_curls) < min(len(jobs), self.max_connections):
+            self.multi_curls.append(self._create_curl())
+        free_curls = list(self.multi_curls)
+        multi = pycurl.CurlMulti()
+        pending = list(enumerate(jobs))
+        pending.reverse()
+        active = dict()
+        errors = dict()
+        statuses = [None] * len(jobs)
+        job_headers = list(map(
+            lambda x: x[3] if x[3] != None else io.BytesIO(), jobs))
+
+        with span('multi {}'.format(request_class), 'network', count=len(jobs)):
+            self._perform_multi_loop(multi, pending, free_curls, active,
+                errors, statuses, job_headers, nobody, request_class)
+
+        multi.close()
+        for index in range(len(jobs)):
+            if index in errors:
+                raise errors[index]
+            if statuses[index] != 200:
+                raise ServerError(statuses[index], job_headers[index].getvalue())
+
+    def _perform_multi_loop(self, multi, pending, free_curls, active,
+        errors, statuses, job_headers, nobody, request_class):
+
+        while len(pending) > 0 or len(active) > 0:
+            while len(pending) > 0 and len(free_curls) > 0 and \
+                len(active) < self.governor.connections(request_class) and \
+                self.governor.try_acquire(request_class):
+                index, (url, cookie, output, headers) = pending.pop()
+                self.logger.debug('HTTP 請求網址：{}'.format(url))
+                curl = free_curls.pop()
+                curl.setopt(pycurl.URL, url)
+                curl.setopt(pycurl.COOKIE, cookie)
+                curl.setopt(pycurl.NOBODY, nobody)
+                curl.setopt(pycurl.NOPROGRESS, True)
+                curl.setopt(pycurl.WRITEDATA, output)
+                curl.setopt(pycurl.HEADERFUNCTION, job_headers[index].write)
+                curl.setopt(pycurl.XFERINFOFUNCTION, lambda *x: None)
+                self._set_timeouts(curl, request_class)
+                if self.har:
+                    self.har.begin(curl, request_class)
+                multi.add_handle(curl)
+                active[curl] = index
+            while True:
+                ret, running = multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            while True:
+                queued, ok_list, err_list = multi.info_read()
+                for curl in ok_list:
+                    statuses[active[curl]] = curl.getinfo(pycurl.RESPONSE_CODE)
+                    self._record(request_class, curl, head=nobody)
+                for curl, code, errmsg in err_list:
+                    errors[active[curl]] = pycurl.error(code, errmsg)
+                    self._record(request_class, curl,
+                        errors[active[curl]], head=nobody)
+                for curl in ok_list + list(map(lambda x: x[0], err_list)):
+                    multi.remove_handle(curl)
+                    del active[curl]
+                    free_curls.append(curl)
+                if queued == 0:
+                    break
+            # 還有請求在等待時，要在 token 夠用時醒來送出下一個請求
+            if len(pending) > 0:
+                wait = min(max(self.governor.wait_time(request_class), 0.01), 1.0)
+            else:
+                wait = 1.0
+            if len(active) > 0:
+                multi.select(wait)
+            elif len(pending) > 0:
+                sleep(wait)
+
+    def api(self, args, encoding='utf-8', allow_return_none=False):
+        self.logger.debug('準備送出 API 請求')
+        state_request = args.get('mode', '') == 'semester'
+        if state_request:
+            semester = args.get('semester', '')
+            if allow_return_none and self.api_cache == semester:
+                self.logger.debug('忽略重複的 {} 學期 API 請求'.format(semester))
+                return
+            self.api_cache = semester
+        query_args = dict()
+        query_args.update(self.api_args)
+        query_args.update(args)
+        url = self.api_url + '?' + urllib.parse.urlencode(query_args)
+        def attempt():
+            data = io.BytesIO()
+            headers = io.BytesIO()
+            self.logger.debug('HTTP 請求網址：{}'.format(url))
+            self.curl.setopt(pycurl.URL, url)
+            self.curl.setopt(pycurl.COOKIE, self.api_cookie)
+            self.curl.setopt(pycurl.NOBODY, False)
+            self.curl.setopt(pycurl.NOPROGRESS, True)
+            self.curl.setopt(pycurl.WRITEDATA, data)
+            self.curl.setopt(pycurl.HEADERFUNCTION, headers.write)
+            self.curl.setopt(pycurl.XFERINFOFUNCTION, lambda *x: None)
+            self._perform(url, 'api')
+            status = self.curl.getinfo(pycurl.RESPONSE_CODE)
+            if status != 200:
+                raise ServerError(status, headers.getvalue())
+            return data.getvalue()
+        state_key = 'api' if state_request else None
+        value = self._retry(attempt, '送出 API 請求', state_key=state_key)
+        if state_request:
+            self._remember_state(state_key, attempt)
+        try:
+            return json.loads(value.decode(encoding))
+        except json.decoder.JSONDecodeError:
+            raise NotJSONError(value.decode(encoding))
+
+    def file(self, path, output, args={}, progress_callback=lambda *x: None,
+        offset=None, length=None):
+        self.logger.debug('準備送出檔案下載請求')
+        self.web_cache[path] = dict(args)
+        url = urllib.parse.urljoin(self.file_url, urllib.parse.quote(path))
+        if len(args) > 0:
+            url += '?' + urllib.parse.urlencode(args)
+        self.logger.debug('HTTP 請求網址：{}'.format(url))
+        start = offset if offset != None else 0
+        counter = CountingWriter(output)
+        request_class = 'small_file'
+        resumes = 0
+        failures = 0
+        while True:
+            headers = io.BytesIO()
+            position = start + counter.size
+            remaining = length - counter.size if length != None else None
+            if remaining != None and remaining <= 0:
+                return parse_file_info(b'')
+            # 只要求部份內容或從中斷處繼續下載時使用 Range 標頭，但伺服器也可能
+            # 直接回傳整個檔案
+            ranged = offset != None or length != None or counter.size > 0
+            if ranged:
+                if remaining != None:
+                    self.curl.setopt(pycurl.RANGE,
+                        '{}-{}'.format(position, position + remaining - 1))
+                else:
+                    self.curl.setopt(pycurl.RANGE, '{}-'.format(position))
+                writer = RangeWriter(counter, headers, position, remaining)
+            else:
+                writer = RangeWriter(counter, headers, 0, None)
+            self.curl.setopt(pycurl.URL, url)
+            self.curl.setopt(pycurl.COOKIE, self.web_cookie)
+            self.curl.setopt(pycurl.NOBODY, False)
+            self.curl.setopt(pycurl.NOPROGRESS, False)
+            self.curl.setopt(pycurl.WRITEDATA, writer)
+            self.curl.setopt(pycurl.HEADERFUNCTION, headers.write)
+            self.curl.setopt(pycurl.XFERINFOFUNCTION, progress_callback)
+            failure = None
+            try:
+                self._perform(url, request_class, writer=writer)
+            except pycurl.error as err:
+                if err.args[0] != pycurl.E_OPERATION_TIMEDOUT or \
+                    resumes >= self.network.get('stall_resumes', 0):
+                    failure = err
+                else:
+                    # 已經下載的部份不用重新下載，大檔案改用大檔案的時間限制
+                    resumes += 1
+                    self.stats.events['resumes'] += 1
+                    total = parse_file_info(headers.getvalue())['size']
+                    if total != None and ranged:
+                        total += position
+                    if total != None and \
+                        total >= self.network.get('large_file_size', 0):
+                        request_class = 'large_file'
+                    self.logger.warning('下載 {} 時連線停滯，從第 {} 位元組繼續下載' \
+                        .format(path, start + counter.size))
+                    continue
+            finally:
+                # 同一個 curl 物件之後還會用來送出其他請求
+                self.curl.setopt(pycurl.RANGE, None)
+            if failure == None:
+                status = self.curl.getinfo(pycurl.RESPONSE_CODE)
+                if ranged and status == 416:
+                    # 要求的範圍超過檔案結尾
+                    return parse_file_info(b'')
+                if status == 200 or (ranged and status == 206):
+                    info = parse_file_info(headers.getvalue())
+                    if offset == None and length == None and status == 206:
+                        # 續傳時 Content-Length 只有最後一段的大小
+                        info['size'] = counter.size
+                    return info
+                failure = ServerError(status, headers.getvalue())
+            # 重試時同樣從已經下載的位置繼續
+            failures += 1
+            if not self._should_retry(failures, failure,
+                '下載 {} '.format(path)):
+                raise failure
+            self._restore_state()
+
+    def file_size(self, path, args={}):
+        self.logger.debug('準備送出檔案大小查詢請求')
+        self.web_cache[path] = dict(args)
+        url = urllib.parse.urljoin(self.file_url, urllib.parse.quote(path))
+        if len(args) > 0:
+            url += '?' + urllib.parse.urlencode(args)
+        def attempt():
+            headers = io.BytesIO()
+            self.logger.debug('HTTP 請求網址：{}'.format(url))
+            self.curl.setopt(pycurl.URL, url)
+            self.curl.setopt(pycurl.COOKIE, self.web_cookie)
+            self.curl.setopt(pycurl.NOBODY, True)
+            self.curl.setopt(pycurl.NOPROGRESS, True)
+            self.curl.setopt(pycurl.WRITEDATA, io.BytesIO())
+            self.curl.setopt(pycurl.HEADERFUNCTION, headers.write)
+            self.curl.setopt(pycurl.XFERINFOFUNCTION, lambda *x: None)
+            self._perform(url, 'small_file', head=True)
+            status = self.curl.getinfo(pycurl.RESPONSE_CODE)
+            if status != 200:
+                raise ServerError(status, headers.getvalue())
+            return self.curl.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD)
+        return self._retry(attempt, '查詢 {} 的大小'.format(path))
+
+    def file_info_multi(self, requests):
+        self.logger.debug('準備同時送出 {} 個檔案資訊查詢請求'.format(len(requests)))
+        urls = list()
+        for path, args in requests:
+            self.web_cache[path] = dict(args)
+            url = urllib.parse.urljoin(self.file_url, urllib.parse.quote(path))
+            if len(args) > 0:
+                url += '?' + urllib.parse.urlencode(args)
+            urls.append(url)
+        def attempt():
+            jobs = list(map(lambda x: (x, self.web_cookie,
+                io.BytesIO(), io.BytesIO()), urls))
+            self._perform_multi(jobs, nobody=True, request_class='small_file')
+            return list(map(lambda x: parse_file_info(x[3].getvalue()), jobs))
+        return self._retry(attempt, '查詢檔案資訊')
+
+    def file_info(self, path, args={}):
+        return self.file_info_multi([(path, args)])[0]
+
+    # 同時下載多個檔案，依照 jobs 的順序開始，已知大小超過 large_file_size 的
+    # 檔案最多同時佔用 max_large 個連線，其他連線留給小檔案。這裡不會重試，也不會
+    # 從中斷處繼續下載，失敗的工作由呼叫的程式改用 file 處理
+    def file_multi(self, jobs, max_large=None):
+        self.logger.debug('準備同時下載 {} 個檔案'.format(len(jobs)))
+        large_file_size = self.network.get('large_file_size', 0)
+        def request_class(job):
+            if job.size != None and job.size >= large_file_size:
+                return 'large_file'
+            return 'small_file'
+        while len(self.multi_curls) < min(len(jobs), self.max_connections):
+            self.multi_curls.append(self._create_curl())
+        free_curls = list(self.multi_curls)
+        multi = pycurl.CurlMulti()
+        pending = list(jobs)
+        active = dict()
+
+        def next_job():
+            if max_large == None or len(list(filter(
+                lambda x: request_class(x[0]) == 'large_file',
+                active.values()))) < max_large:
+                return 0
+            for index, job in enumerate(pending):
+                if request_class(job) != 'large_file':
+                    return index
+            # 只剩下大檔案時就不用保留連線了
+            return 0
+
+        def start(job):
+            try:
+                output = job.open_output()
+            except OSError as err:
+                job.done_callback(None, err)
+                return
+            url = urllib.parse.urljoin(self.file_url, urllib.parse.quote(job.path))
+            if len(job.args) > 0:
+                url += '?' + urllib.parse.urlencode(job.args)
+            self.web_cache[job.path] = dict(job.args)
+            self.logger.debug('HTTP 請求網址：{}'.format(url))
+            headers = io.BytesIO()
+            curl = free_curls.pop()
+            curl.setopt(pycurl.URL, url)
+            curl.setopt(pycurl.COOKIE, self.web_cookie)
+            curl.setopt(pycurl.NOBODY, False)
+            curl.setopt(pycurl.NOPROGRESS, False)
+            curl.setopt(pycurl.WRITEDATA, RangeWriter(output, headers, 0, None))
+            curl.setopt(pycurl.HEADERFUNCTION, headers.write)
+            curl.setopt(pycurl.XFERINFOFUNCTION, job.progress_callback)
+            self._set_timeouts(curl, request_class(job))
+            if self.har:
+                self.har.begin(curl, request_class(job))
+            multi.add_handle(curl)
+            active[curl] = (job, output, headers)
+
+        def finish(curl, error):
+            job, output, headers = active.pop(curl)
+            multi.remove_handle(curl)
+            free_curls.append(curl)
+            self._record(request_class(job), curl, error)
+            if error == None:
+                status = curl.getinfo(pycurl.RESPONSE_CODE)
+                if status != 200:
+                    error = ServerError(status, headers.getvalue())
+            job.done_callback(output, error)
+
+        try:
+            with span('multi file', 'network', count=len(jobs)):
+                while len(pending) > 0 or len(active) > 0:
+                    while len(pending) > 0 and len(free_curls) > 0 and \
+                        len(active) < \
+                            self.governor.connections('small_file') and \
+                        self.governor.try_acquire('small_file'):
+                        start(pending.pop(next_job()))
+                    while True:
+                        ret, running = multi.perform()
+                        if ret != pycurl.E_CALL_MULTI_PERFORM:
+                            break
+                    while True:
+                        queued, ok_list, err_list = multi.info_read()
+                        for curl in ok_list:
+                            finish(curl, None)
+                        for curl, code, errmsg in err_list:
+                            finish(curl, pycurl.error(code, errmsg))
+                        if queued == 0:
+                            break
+                    if len(pending) > 0:
+                        wait = min(max(
+                            self.governor.wait_time('small_file'), 0.01), 1.0)
+                    else:
+                        wait = 1.0
+                    if len(active) > 0:
+                        multi.select(wait)
+                    elif len(pending) > 0:
+                        sleep(wait)
+        finally:
+            # 回呼函式發生錯誤時也要移除還在傳輸的連線，之後才能再使用
+            for curl in list(active.keys()):
+                multi.remove_handle(curl)
+            multi.close()
+
+    def web(self, path, args={}, encoding=None, allow_return_none=False):
+        self.logger.debug('準備送出網頁請求')
+        if allow_return_none:
+            if path in self.web_cache and self.web_cache[path] == args:
+                self.logger.debug('忽略重複的 {} 網頁請求'.format(path))
+                self.logger.debug('參數：{}'.format(args))
+                return
+        self.web_cache[path] = dict(args)
+        url = urllib.parse.urljoin(self.web_url, urllib.parse.quote(path))
+        if len(args) > 0:
+            url += '?' + urllib.parse.urlencode(args)
+        def attempt():
+            data = io.BytesIO()
+            headers = io.BytesIO()
+            self.logger.debug('HTTP 請求網址：{}'.format(url))
+            self.curl.setopt(pycurl.URL, url)
+            self.curl.setopt(pycurl.COOKIE, self.web_cookie)
+            self.curl.setopt(pycurl.NOBODY, False)
+            self.curl.setopt(pycurl.NOPROGRESS, True)
+            self.curl.setopt(pycurl.WRITEDATA, data)
+            self.curl.setopt(pycurl.HEADERFUNCTION, headers.write)
+            self.curl.setopt(pycurl.XFERINFOFUNCTION, lambda *x: None)
+            self._perform(url, 'page')
+            status = self.curl.getinfo(pycurl.RESPONSE_CODE)
+            if status != 200:
+                raise ServerError(status, headers.getvalue())
+            return data
+        # 可以省略的請求都是用來切換學期或課程的，重試其他請求前要重新送出
+        state_key = ('web', path) if allow_return_none else None
+        data = self._retry(attempt, '下載網頁 {} '.format(path),
+            state_key=state_key)
+        if allow_return_none:
+            self._remember_state(state_key, attempt)
+        data.seek(io.SEEK_SET)
+        with span('parse', 'parse', path=path):
+            return etree.parse(data, etree.HTMLParser(
+                encoding=encoding, remove_comments=True))
+
+    def web_multi(self, requests, encoding=None):
+        self.logger.debug('準備同時送出 {} 個網頁請求'.format(len(requests)))
+        urls = list()
+        for path, args in requests:
+            self.web_cache[path] = dict(args)
+            url = urllib.parse.urljoin(self.web_url, urllib.parse.quote(path))
+            if len(args) > 0:
+                url += '?' + urllib.parse.urlencode(args)
+            urls.append(url)
+        def attempt():
+            jobs = list(map(lambda x: (x, self.web_cookie, io.BytesIO(), None),
+                urls))
+            self._perform_multi(jobs)
+            return jobs
+        jobs = self._retry(attempt, '同時下載網頁')
+        pages = list()
+        for url, cookie, data, headers in jobs:
+            data.seek(io.SEEK_SET)
+            with span('parse', 'parse', url=url):
+                pages.append(etree.parse(data, etree.HTMLParser(
+                    encoding=encoding, remove_comments=True)))
+        return pages
+
+    def web_redirect(self, path, args={}):
+        self.logger.debug('準備測試網頁重導向目的地')
+        self.web_cache[path] = dict(args)
+        url = urllib.parse.urljoin(self.web_url, urllib.parse.quote(path))
+        if len(args) > 0:
+            url += '?' + urllib.parse.urlencode(args)
+        def attempt():
+            headers = io.BytesIO()
+            self.logger.debug('HTTP 請求網址：{}'.format(url))
+            self.curl.setopt(pycurl.URL, url)
+            self.curl.setopt(pycurl.COOKIE, self.web_cookie)
+            self.curl.setopt(pycurl.NOBODY, False)
+            self.curl.setopt(pycurl.NOPROGRESS, True)
+            self.curl.setopt(pycurl.WRITEDATA, NoneIO())
+            self.curl.setopt(pycurl.HEADERFUNCTION, headers.write)
+            self.curl.setopt(pycurl.XFERINFOFUNCTION, lambda *x: None)
+            self._perform(url, 'page')
+            status = self.curl.getinfo(pycurl.RESPONSE_CODE)
+            if status != 302:
+                raise ServerError(status, headers.getvalue())
+            return headers
+        headers = self._retry(attempt, '測試 {} 的重導向目的地'.format(path))
+        for header_line in headers.getvalue().split(b'\r\n'):
+            if header_line.startswith(b'Location:'):
+                return header_line.split(b':', maxsplit=1)[1].strip().decode()
+        return None
+
+class Cat:
+    def __init__(self, vfs, logger=None):
+        self.vfs = vfs
+        self.logger = logger if logger else logging.getLogger(__package__)
+
+    def run(self, output, path, progress_callback=lambda *x: None,
+        offset=None, length=None):
+        node = self.vfs.open(path)
+        while self.vfs.is_internal_link(node):
+            node = self.vfs.open(node.read_link(), cwd=node.parent)
+        if offset == None and length == None:
+            node.read(output, progress_callback=progress_callback)
+        elif self.vfs.is_regular(node):
+            node.read(output, progress_callback=progress_callback,
+                offset=offset, length=length)
+        else:
+            raise IsADirectoryError('{} 不是普通檔案，無法只讀取部份內容' \
+                .format(path))
+
+    # 顯示多個檔案時，可以直接從網址下載的檔案會同時下載，但仍然依照參數的順序
+    # 輸出。還沒輪到的檔案先放在暫存檔中，每個檔案只有前 buffer_size 個位元組
+    # 放在記憶體中。progress_callback 的第一個參數是路徑，每個路徑結束時呼叫
+    # end_callback，發生錯誤時呼叫 error_callback
+    def run_all(self, output, paths, progress_callback=lambda *x: None,
+        end_callback=lambda *x: None, error_callback=None,
+        offset=None, length=None, buffer_size=2**20):
+
+        def fail(path, err):
+            if error_callback == None:
+                raise err
+            error_callback(path, err)
+
+        def read(slot, target):
+            slot['node'].read(target, progress_callback=lambda *args:
+                progress_callback(slot['path'], *args))
+
+        if offset != None or length != None or len(paths) < 2:
+            for path in paths:
+                try:
+                    self.run(output, path, progress_callback=lambda *args:
+                        progress_callback(path, *args),
+                        offset=offset, length=length)
+                except (Error, OSError) as err:
+                    fail(path, err)
+                finally:
+                    end_callback(path)
+            return
+
+        # 讀取 VFS 的請求會改變伺服器上的狀態，所以先依序找出所有節點，不能
+        # 直接從網址下載的檔案也在這時候讀取
+        slots = list()
+        jobs = list()
+        position = 0
+
+        # 同時下載失敗的檔案要等全部下載結束後才能重新讀取
+        def write_ready(final=False):
+            nonlocal position
+            while position < len(slots) and slots[position]['done']:
+                slot = slots[position]
+                if slot['retry'] and not final:
+                    break
+                position += 1
+                try:
+                    if slot['error'] != None:
+                        fail(slot['path'], slot['error'])
+                    elif slot['retry']:
+                        read(slot, output)
+                    else:
+                        slot['buffer'].seek(0)
+                        shutil.copyfileobj(slot['buffer'], output)
+                    output.flush()
+                except (Error, OSError) as err:
+                    fail(slot['path'], err)
+                finally:
+                    if slot['buffer'] != None:
+                        slot['buffer'].close()
+                    end_callback(slot['path'])
+
+        def job_done(slot, error):
+            if error != None:
+                self.logger.warning('同時下載 {} 時發生錯誤：{}，稍後重新' \
+                    '下載'.format(slot['path'], error))
+                if slot['buffer'] != None:
+                    slot['buffer'].close()
+                    slot['buffer'] = None
+                slot['retry'] = True
+            slot['done'] = True
+            write_ready()
+
+        try:
+            for path in paths:
+                slot = {'path': path, 'node': None, 'buffer': None,
+                    'error': None, 'done': True, 'retry': False}
+                slots.append(slot)
+                try:
+                    node = self.vfs.open(path)
+                    while self.vfs.is_internal_link(node):
+                        node = self.vfs.open(node.read_link(), cwd=node.parent)
+                    slot['node'] = node
+                    if self.vfs.is_regular(node) and not node.local and \
+                        getattr(node, 'download_request', None) != None:
+                        slot['done'] = False
+                        jobs.append(self._make_job(slot, buffer_size,
+                            progress_callback, job_done))
+                    else:
+                        slot['buffer'] = SpooledTemporaryFile(
+                            max_size=buffer_size)
+                        read(slot, slot['buffer'])
+                except (Error, OSError) as err:
+                    slot['error'] = err
+
+            write_ready()
+            if len(jobs) > 0:
+                self.vfs.request.file_multi(jobs)
+            write_ready(final=True)
+        finally:
+            for slot in slots[position:]:
+                if slot['buffer'] != None:
+                    slot['buffer'].close()
+
+    def _make_job(self, slot, buffer_size, progress_callback, done_callback):
+        path, args = slot['node'].download_request
+        def open_output():
+            slot['buffer'] = SpooledTemporaryFile(max_size=buffer_size)
+            return slot['buffer']
+        return FileJob(path, args, open_output=open_output,
+            progress_callback=lambda *args:
+                progress_callback(slot['path'], *args),
+            done_callback=lambda output, error: done_callback(slot, error))
+
+class Get:
+    def __init__(self, vfs, logger, store=None, scheduler=None):
+        self.vfs = vfs
+        self.logger = logger
+        self.store = store
+        self.scheduler = scheduler
+        self.unchanged_dirs = set()
+
+    # 下載成功的檔案會把 signature 記錄在快取中，下次遇到相同的 signature 而且
+    # 檔案還在的話，就不需要再向伺服器確認。快取使用檔案的絕對路徑，從不同的
+    # 資料夾執行時才不會互相影響
+    def signature_entry(self, node, disk_path_object):
+        if node.signature == None:
+            return None
+        entry = self.vfs.cache.get('downloaded',
+            str(disk_path_object.absolute()))
+        if not isinstance(entry, dict) or \
+            entry.get('signature') != node.signature:
+            return None
+        return entry
+
+    def signature_unchanged(self, node, disk_path_object):
+        if not disk_path_object.exists():
+            return False
+        if any(map(lambda x: x in self.unchanged_dirs,
+            disk_path_object.parents)):
+            return True
+        return self.signature_entry(node, disk_path_object) != None
+
+    # 資料夾的 signature 沒變而且記錄的檔案都還在時，不需要讀取資料夾，只要重新
+    # 套用讀取時對其他資料夾的修改。有檔案被刪除時才讀取資料夾，只補上缺少的
+    # 檔案
+    def skip_directory(self, node, disk_path_object):
+        if not disk_path_object.is_dir():
+            return False
+        entry = self.signature_entry(node, disk_path_object)
+        if entry == None:
+            return False
+        if entry.get('files') == None or not all(map(
+            lambda x: os.path.lexists(str(disk_path_object / x)),
+            entry['files'])):
+            self.unchanged_dirs.add(disk_path_object)
+            return False
+        if entry.get('effects') != None:
+            node.replay(entry['effects'])
+        # 重新寫入一次，快取項目才不會過期
+        self.vfs.cache.set('downloaded', str(disk_path_object.absolute()),
+            entry)
+        return True
+
+    def tree_files(self, node, prefix=pathlib.PurePosixPath()):
+        files = list()
+        for child_name, child_node in node.list():
+            child_path = prefix / child_name
+            if self.vfs.is_directory(child_node):
+                files.extend(self.tree_files(child_node, child_path))
+            else:
+                files.append(child_path.as_posix())
+        return files
+
+    def signature_commit(self, node, disk_path_object):
+        if node.signature == None:
+            return
+        entry = {'signature': node.signature}
+        if self.vfs.is_directory(node):
+            entry['files'] = self.tree_files(node)
+            entry['effects'] = node.effects()
+        self.vfs.cache.set('downloaded', str(disk_path_object.absolute()),
+            entry)
+
+    def download_file(self, path, retry, dcb, ecb):
+        self.logger.info('準備下載檔案 {}'.format(path))
+
+        disk_path_object = pathlib.Path(path.lstrip('/'))
+        node_ready = False
+        for i in range(retry):
+            try:
+                if i != 0:
+                    self.logger.error('存取 {} 時發生錯誤，正在嘗試第 {} 次' \
+                        .format(path, i + 1))
+                node = self.vfs.open(path, fetch=False)
+                if self.vfs.is_directory(node) and \
+                    self.skip_directory(node, disk_path_object):
+                    self.logger.info('跳過已經存在且沒有變更的資料夾 {}' \
+                        .format(str(disk_path_object)))
+                    return True
+                if not node.ready:
+                    node.fetch()
+                node_ready = True
+                break
+            except (pycurl.error, Error) as err:
+                self.logger.error(err)
+        if not node_ready:
+            return False
+
+        if self.vfs.is_internal_link(node):
+            return self.download_link(path, node, retry, dcb, ecb)
+        elif self.vfs.is_regular(node):
+            return self.download_regular(path, node, retry, dcb, ecb)
+        elif self.vfs.is_directory(node):
+            if disk_path_object in self.unchanged_dirs:
+                self.logger.info('資料夾 {} 沒有變更，只補上缺少的檔案' \
+                    .format(str(disk_path_object)))
+            if not self.download_directory(path, node, retry, dcb, ecb):
+                return False
+            for child_name, child_node in node.list():
+                child_path = pathlib.PurePosixPath(path) / child_name
+                child_path = child_path.as_posix()
+                if not self.download_file(child_path, retry, dcb, ecb):
+                    return False
+            self.signature_commit(node, disk_path_object)
+            return True
+        else:
+            assert False, '無法辨識的檔案格式'
+
+    def download_link(self, path, node, retry, dcb, ecb):
+        disk_path_object = pathlib.Path(path.lstrip('/'))
+        disk_path = str(disk_path_object)
+        if self.vfs.is_internal_link(node):
+            link_target_path = str(pathlib.PurePath(node.read_link()))
+        else:
+            assert False
+
+        if disk_path_object.is_symlink():
+            existing_link_target_path = os.readlink(disk_path)
+            if existing_link_target_path == link_target_path:
+                self.logger.info('跳過已經存在且目標相同的符號連結 {}' \
+                    .format(disk_path))
+                return True
+
+        download_ok = False
+        for i in range(retry):
+            try:
+                if i != 0:
+                    self.logger.error('無法建立符號連結 {}，正在嘗試第 {} 次' \
+                        .format(disk_path, i + 1))
+                try:
+                    dcb(path, False, None, None, None)
+                    disk_path_object.symlink_to(link_target_path)
+                    dcb(path, True, None, None, None)
+                    ecb(path)
+                    download_ok = True
+                    break
+                except FileExistsError:
+                    if disk_path_object.is_symlink():
+                        disk_path_object.unlink()
+                        dcb(path, False, None, None, None)
+                        disk_path_object.symlink_to(link_target_path)
+                        dcb(path, True, None, None, None)
+                        ecb(path)
+                        download_ok = True
+                        break
+            except IOError as err:
+                ecb(path)
+                self.logger.error(err)
+
+        if not download_ok:
+            return False
+
+        return True
+
+    # 逐段比較磁碟上的檔案和要下載的內容，遇到不同的地方就可以停止
+    def same_content(self, node, disk_path_object):
+        with disk_path_object.open('rb') as disk_file:
+            for chunk in node.chunks():
+                if disk_file.read(len(chunk)) != chunk:
+                    return False
+            return len(disk_file.read(1)) == 0
+
+    def download_regular(self, path, node, retry, dcb, ecb):
+        if self.store and not node.local:
+            return self.download_regular_dedup(path, node, retry, dcb, ecb)
+
+        disk_path_object = pathlib.Path(path.lstrip('/'))
+
+        def ccb(*args):
+            return dcb(path, *args)
+
+        def disk_path_object_open(mode):
+            while True:
+                try:
+                    nonlocal disk_path_object
+                    return disk_path_object.open(mode)
+                except IOError as err:
+                    if err.errno != errno.ENAMETOOLONG:
+                        raise err
+                    disk_path_object = disk_path_object.parent / \
+                        (disk_path_object.stem[:-1] + disk_path_object.suffix)
+                    self.logger.info('指定的檔案名稱太長，正在嘗試改用 {}' \
+                        .format(str(disk_path_object)))
+
+        download_ok = False
+        for i in range(retry):
+            try:
+                if i != 0:
+                    self.logger.error('下載檔案 {} 時發生錯誤，正在嘗試第 {} 次' \
+                        .format(path, i + 1))
+                disk_file_opened = False
+                temp_file = None
+                try:
+                    disk_file = disk_path_object_open('xb')
+                    disk_file_opened = True
+                except FileExistsError:
+                    if disk_path_object.is_file() and \
+                        self.signature_unchanged(node, disk_path_object):
+                        self.logger.info('跳過已經存在且沒有變更的檔案 {}' \
+                            .format(str(disk_path_object)))
+                        download_ok = True
+                        break
+                    if disk_path_object.is_file() and \
+                        disk_path_object.stat().st_size == node.size():
+                        if node.local:
+                            if self.same_content(node, disk_path_object):
+                                self.logger.info(
+                                    '跳過已經存在且內容相同的檔案 {}' \
+                                    .format(str(disk_path_object)))
+                                download_ok = True
+                                break
+                        else:
+                            self.logger.info('跳過已經存在且大小相同的檔案 {}' \
+                                .format(str(disk_path_object)))
+                            download_ok = True
+                            break
+                    # 內容不同時先寫到暫存檔再改名，避免中斷時留下不完整的檔案
+                    temp_file = AtomicFile(disk_path_object, mode='wb')
+                    disk_file = temp_file.file
+                    disk_file_opened = True
+                info = node.read(disk_file, progress_callback=ccb)
+                disk_file.close()
+                if info != None and not node.local:
+                    self.vfs.cache.set('file_info', node.remote_path, info)
+                if temp_file:
+                    temp_file.commit()
+                ecb(path)
+                download_ok = True
+                break
+            except (pycurl.error, Error, IOError) as err:
+                self.logger.error(err)
+                if disk_file_opened:
+                    disk_file.close()
+                if temp_file:
+                    temp_file.discard()
+
+        if download_ok:
+            self.signature_commit(node, disk_path_object)
+        return download_ok
+
+    # 從網路下載的檔案先存進儲存區，再用硬連結放到要下載的位置。大小和 ETag
+    # 都和上次相同的檔案不需要下載，內容相同的檔案也只會存一份
+    # 和 download_regular 開啟檔案時一樣，檔案名稱太長就逐字縮短，直到可以查詢
+    # 檔案狀態為止
+    def shorten_name(self, disk_path_object):
+        while True:
+            try:
+                disk_path_object.exists()
+                return disk_path_object
+            except OSError as err:
+                if err.errno != errno.ENAMETOOLONG:
+                    raise err
+                disk_path_object = disk_path_object.parent / \
+                    (disk_path_object.stem[:-1] + disk_path_object.suffix)
+                self.logger.info('指定的檔案名稱太長，正在嘗試改用 {}' \
+                    .format(str(disk_path_object)))
+
+    def download_regular_dedup(self, path, node, retry, dcb, ecb):
+        disk_path_object = self.shorten_name(pathlib.Path(path.lstrip('/')))
+
+        if disk_path_object.is_file() and \
+            self.signature_unchanged(node, disk_path_object):
+            self.logger.info('跳過已經存在且沒有變更的檔案 {}' \
+                .format(str(disk_path_object)))
+            return True
+
+        def ccb(*args):
+            return dcb(path, *args)
+
+        download_ok = False
+        for i in range(retry):
+            try:
+                if i != 0:
+                    self.logger.error('下載檔案 {} 時發生錯誤，正在嘗試第 {} 次' \
+                        .format(path, i + 1))
+                digest = self.store.lookup(node.remote_path, node.info())
+                if digest:
+                    self.logger.info('跳過大小和 ETag 都沒有變更的檔案 {}' \
+                        .format(str(disk_path_object)))
+                else:
+                    digest = self.store.download(node.remote_path,
+                        lambda x: node.read(x, progress_callback=ccb))
+                    ecb(path)
+                self.store.link(digest, disk_path_object)
+                download_ok = True
+                break
+            except (pycurl.error, Error, IOError) as err:
+                self.logger.error(err)
+
+        if download_ok:
+            self.signature_commit(node, disk_path_object)
+        return download_ok
+
+    def download_directory(self, path, node, retry, dcb, ecb):
+        disk_path_object = pathlib.Path(path.lstrip('/'))
+        if disk_path_object.is_dir():
+            self.logger.info('跳過已經存在的資料夾 {}' \
+                .format(str(disk_path_object)))
+            return True
+
+        download_ok = False
+        for i in range(retry):
+            try:
+                if i != 0:
+                    self.logger.error('無法建立資料夾 {}，正在嘗試第 {} 次' \
+                        .format(str(disk_path_object), i + 1))
+                dcb(path, False, None, None, None)
+                disk_path_object.mkdir(parents=True, exist_ok=False)
+                dcb(path, True, None, None, None)
+                ecb(path)
+                download_ok = True
+                break
+            except IOError as err:
+                ecb(path)
+                self.logger.error(err)
+
+        if not download_ok:
+            return False
+
+        return True
+
+    def run(self, path, retry=3,
+        download_progress_callback=lambda *x: None,
+        end_download_callback=lambda *x: None):
+        return self.run_all([path], retry, download_progress_callback,
+            end_download_callback)
+
+    # 可以同時下載時先列出所有路徑中要下載的檔案，再一起依照優先順序下載，
+    # 所有路徑的檔案共用同一組連線。有一個路徑失敗時仍然會繼續下載其他路徑
+    def run_all(self, paths, retry=3,
+        download_progress_callback=lambda *x: None,
+        end_download_callback=lambda *x: None):
+        succeeded = True
+        if self.scheduler != None and self.scheduler.concurrent:
+            plan = Plan(self.vfs, self.logger, store=self.store)
+            for path in paths:
+                succeeded = plan.walk(path) and succeeded
+            return plan.execute(retry, download_progress_callback,
+                end_download_callback, scheduler=self.scheduler) and succeeded
+        def end_callback(path):
+            end_download_callback(path)
+            phase('下載 {}'.format(path))
+        for path in paths:
+            succeeded = self.download_file(path, retry + 1,
+                download_progress_callback, end_callback) and succeeded
+        return succeeded
+
+# 不實際下載，只列出 get 會下載哪些檔案、要傳輸多少資料和大約需要多少時間。
+# 從 CEIBA 下載的檔案會一次送出多個 HEAD 請求查詢大小，判斷方式和 get 相同。
+# 計畫會寫入 JSON 檔案，之後執行計畫時不需要重新讀取整個 VFS
+class Plan:
+    version = 1
+
+    def __init__(self, vfs, logger, store=None, batch_size=32):
+        self.vfs = vfs
+        self.logger = logger
+        self.store = store
+        self.batch_size = batch_size
+        self.get = Get(vfs, logger, store=store)
+        self.paths = list()
+        self.entries = list()
+        self.semester = None
+        self._pending = list()
+        self._walked = set()
+
+    def _entry(self, path, entry_type, status, **fields):
+        entry = OrderedDict([('path', path), ('type', entry_type),
+            ('status', status)])
+        entry.update(fields)
+        self.entries.append(entry)
+        return entry
+
+    def walk(self, path):
+        self.paths.append(path)
+        succeeded = self._walk(path)
+        self._flush()
+        return succeeded
+
+    def _walk(self, path):
+        # 同時指定了資料夾和其中的檔案時只需要列出一次
+        walked_key = pathlib.PurePosixPath('/', path).as_posix()
+        if walked_key in self._walked:
+            return True
+        self._walked.add(walked_key)
+        disk_path_object = pathlib.Path(path.lstrip('/'))
+        try:
+            node = self.vfs.open(path, fetch=False)
+            if self.vfs.is_directory(node) and \
+                self.get.skip_directory(node, disk_path_object):
+                self._entry(path, 'directory', 'unchanged')
+                return True
+            if not node.ready:
+                node.fetch()
+        except (pycurl.error, Error) as err:
+            self.logger.error(err)
+            self._entry(path, 'unknown', 'error', error=str(err))
+            return False
+
+        if self.vfs.is_internal_link(node):
+            target = str(pathlib.PurePath(node.read_link()))
+            if disk_path_object.is_symlink():
+                if os.readlink(str(disk_path_object)) == target:
+                    status = 'unchanged'
+                else:
+                    status = 'changed'
+            else:
+                status = 'new'
+            self._entry(path, 'link', status, target=target)
+            return True
+        elif self.vfs.is_regular(node):
+            return self._walk_regular(path, node, disk_path_object)
+        elif self.vfs.is_directory(node):
+            entry = self._entry(path, 'directory',
+                'unchanged' if disk_path_object.is_dir() else 'new',
+                signature=node.signature)
+            succeeded = True
+            for child_name, child_node in node.list():
+                child_path = pathlib.PurePosixPath(path) / child_name
+                succeeded = self._walk(child_path.as_posix()) and succeeded
+            if node.signature != None:
+                entry['files'] = self.get.tree_files(node)
+                entry['effects'] = node.effects()
+            return succeeded
+        else:
+            assert False, '無法辨識的檔案格式'
+
+    def _walk_regular(self, path, node, disk_path_object):
+        disk_path_object = self.get.shorten_name(disk_path_object)
+        if disk_path_object.is_file() and \
+            self.get.signature_unchanged(node, disk_path_object):
+            self._entry(path, 'file', 'unchanged', size=None,
+                signature=node.signature)
+            return True
+        if node.local:
+            size = node.size()
+            if not disk_path_object.exists():
+                status = 'new'
+            elif disk_path_object.is_file() and \
+                disk_path_object.stat().st_size == size and \
+                self.get.same_content(node, disk_path_object):
+                status = 'unchanged'
+            else:
+                status = 'changed'
+            self._entry(path, 'file', status, size=size, requests=0,
+                local=True)
+            return True
+
+        # 磁碟上沒有的檔案一定要下載，不需要先送出 HEAD 請求，大小只從快取取得
+        if self.store:
+            missing = not disk_path_object.is_file()
+        else:
+            missing = not disk_path_object.exists()
+        if missing:
+            info = self.vfs.cache.get('file_info', node.remote_path)
+            self._entry(path, 'file', 'new',
+                size=info['size'] if info != None else None, requests=1,
+                remote=getattr(node, 'download_request', None),
+                signature=node.signature)
+            return True
+
+        # 從 CEIBA 下載的檔案等累積到一定數量再一起查詢
+        entry = self._entry(path, 'file', 'unknown', size=None,
+            remote=getattr(node, 'download_request', None),
+            signature=node.signature)
+        self._pending.append((entry, node, disk_path_object))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        return True
+
+    def _flush(self):
+        pending = self._pending
+        self._pending = list()
+        for (entry, node, disk_path_object), (info, err) in zip(pending,
+            self.vfs.file_infos(list(map(lambda x: x[1], pending)))):
+            if err != None:
+                self.logger.error('無法查詢 {} 的資訊：{}' \
+                    .format(entry['path'], err))
+                entry['status'] = 'error'
+                entry['error'] = str(err)
+                continue
+            entry['size'] = info['size']
+            entry['requests'] = 1
+            entry['status'] = self._remote_status(node, info, disk_path_object)
+
+    # 和 Get.download_regular、Get.download_regular_dedup 判斷是否要下載的方式相同
+    def _remote_status(self, node, info, disk_path_object):
+        if self.store:
+            if not disk_path_object.is_file():
+                return 'new'
+            if self.store.lookup(node.remote_path, info):
+                return 'unchanged'
+            return 'changed'
+        if not disk_path_object.exists():
+            return 'new'
+        if disk_path_object.is_file() and \
+            disk_path_object.stat().st_size == info['size']:
+            return 'unchanged'
+        return 'changed'
+
+    def totals(self):
+        totals = OrderedDict()
+        for status in ['new', 'changed', 'unchanged', 'error']:
+            entries = list(filter(lambda x: x['status'] == status and
+                (x['type'] == 'file' or status == 'error'), self.entries))
+            totals[status] = OrderedDict([
+                ('files', len(entries)),
+                ('bytes', sum(map(lambda x: x.get('size') or 0, entries))),
+            ])
+        transfers = list(filter(lambda x: x['type'] == 'file' and
+            x['status'] in ['new', 'changed'], self.entries))
+        totals['transfer'] = OrderedDict([
+            ('files', len(transfers)),
+            ('bytes', sum(map(lambda x: x.get('size') or 0, transfers))),
+            ('requests', sum(map(lambda x: x.get('requests', 1), transfers))),
+            ('directories', len(list(filter(lambda x: x['type'] == 'directory'
+                and x['status'] == 'new', self.entries)))),
+            ('links', len(list(filter(lambda x: x['type'] == 'link'
+                and x['status'] in ['new', 'changed'], self.entries)))),
+        ])
+        return totals
+
+    # 每個請求都要等待 latency 秒才開始傳輸，之後以 throughput 的速度下載
+    def estimate(self, throughput, latency):
+        transfer = self.totals()['transfer']
+        if throughput == None or throughput <= 0:
+            return None
+        return transfer['requests'] * (latency or 0) + \
+            transfer['bytes'] / throughput
+
+    def write(self, path):
+        with open(path, 'w') as plan_file:
+            json.dump(OrderedDict([
+                ('version', self.version),
+                ('cwd', os.getcwd()),
+                ('paths', self.paths),
+                ('semester', self.current_semester()),
+                ('totals', self.totals()),
+                ('entries', self.entries),
+            ]), plan_file, ensure_ascii=False, indent=1)
+
+    def load(self, path):
+        with open(path, 'r') as plan_file:
+            data = json.load(plan_file, object_pairs_hook=OrderedDict)
+        if data.get('version') != self.version:
+            raise Error('不支援的計畫檔案版本 {}'.format(data.get('version')))
+        if data.get('cwd') != os.getcwd():
+            self.logger.warning('計畫是在 {} 建立的，和目前的資料夾不同' \
+                .format(data.get('cwd')))
+        self.paths = data['paths']
+        self.entries = data['entries']
+        self.semester = data.get('semester')
+
+    # 目前學期的資料夾路徑，只在已經列出學期時才知道
+    def current_semester(self):
+        courses = self.vfs.root.courses
+        if not courses.ready:
+            return self.semester
+        s = self.vfs.strings
+        for name, node in courses.list():
+            if name == s['link_semester_current'] and \
+                self.vfs.is_internal_link(node):
+                return (pathlib.PurePosixPath('/', s['dir_root_courses']) /
+                    node.read_link()).as_posix()
+        return self.semester
+
+    def _commit_signature(self, entry):
+        if entry.get('signature') == None:
+            return
+        value = {'signature': entry['signature']}
+        for key in ['files', 'effects']:
+            if key in entry:
+                value[key] = entry[key]
+        self.vfs.cache.set('downloaded',
+            str(pathlib.Path(entry['path'].lstrip('/')).absolute()), value)
+
+    # 只處理計畫中新增和變更的項目，順序由 scheduler 決定。從 CEIBA 直接下載的
+    # 檔案不需要經過 VFS，可以同時下載；其他項目仍然要從 VFS 取得內容
+    def execute(self, retry=3,
+        download_progress_callback=lambda *x: None,
+        end_download_callback=lambda *x: None, scheduler=None):
+        from .vfs import DownloadFile
+        if scheduler == None:
+            scheduler = Scheduler(large_file_size=self.vfs.request.network.get(
+                'large_file_size', 0))
+        scheduler.current_semester = self.current_semester()
+        dcb = download_progress_callback
+        ecb = end_download_callback
+        todo = list(filter(lambda x: x['status'] in ['new', 'changed'],
+            self.entries))
+        structure = list(filter(lambda x: x['type'] != 'file', todo))
+        local = list(filter(lambda x: x['type'] == 'file' and
+            x.get('local', False), todo))
+        bodies = scheduler.order(map(lambda x: (x['path'], x.get('size'), x),
+            filter(lambda x: x['type'] == 'file' and
+                not x.get('local', False), todo)))
+        failed = list()
+
+        def done(entry, ok):
+            if ok:
+                phase('下載 {}'.format(entry['path']))
+            else:
+                failed.append(entry['path'])
+
+        # 資料夾要先建立，檔案才有地方放
+        for entry in structure:
+            if entry['type'] == 'directory':
+                done(entry, self.get.download_directory(entry['path'], None,
+                    retry + 1, dcb, ecb))
+            else:
+                done(entry, self.get.download_file(entry['path'], retry + 1,
+                    dcb, ecb))
+        if scheduler.metadata_first:
+            for entry in local:
+                done(entry, self.get.download_file(entry['path'], retry + 1,
+                    dcb, ecb))
+
+        # 放進儲存區的檔案要一邊下載一邊計算雜湊，只能一個一個下載
+        if scheduler.concurrent and not self.store:
+            concurrent = list(filter(lambda x: x[2].get('remote'), bodies))
+            bodies = list(filter(lambda x: not x[2].get('remote'), bodies))
+            for entry in self._download_concurrent(
+                list(map(lambda x: x[2], concurrent)), scheduler, dcb, ecb,
+                lambda entry: done(entry, True)):
+                bodies.append((entry['path'], entry.get('size'), entry))
+        for path, size, entry in bodies:
+            if entry.get('remote'):
+                node = DownloadFile(self.vfs, None, *entry['remote'])
+                node.signature = entry.get('signature')
+                done(entry, self.get.download_regular(path, node, retry + 1,
+                    dcb, ecb))
+            else:
+                done(entry, self.get.download_file(path, retry + 1, dcb, ecb))
+
+        if not scheduler.metadata_first:
+            for entry in local:
+                done(entry, self.get.download_file(entry['path'], retry + 1,
+                    dcb, ecb))
+
+        # 資料夾底下全部成功時才記錄 signature，下次才能整個跳過。沒有變更的
+        # 檔案也重新記錄一次，快取項目才不會過期
+        failed.extend(map(lambda x: x['path'], filter(
+            lambda x: x['status'] in ['error', 'unknown'], self.entries)))
+        for entry in filter(lambda x: x['type'] == 'directory' or
+            (x['type'] == 'file' and x['status'] == 'unchanged'),
+            self.entries):
+            prefix = entry['path'].rstrip('/') + '/'
+            if not any(map(lambda x: x == entry['path'] or
+                x.startswith(prefix), failed)):
+                self._commit_signature(entry)
+        return len(failed) == 0
+
+    # 回傳同時下載失敗的項目，讓呼叫的程式用一般的方式重試
+    def _download_concurrent(self, entries, scheduler, dcb, ecb, success):
+        failed = list()
+
+        def make_job(entry):
+            path = entry['path']
+            disk_path_object = self.get.shorten_name(
+                pathlib.Path(path.lstrip('/')))
+            temp_file = None
+
+            # 和 Get.download_regular 相同，內容不同時先寫到暫存檔再改名
+            def open_output():
+                nonlocal temp_file
+                if not disk_path_object.exists():
+                    return disk_path_object.open('xb')
+                temp_file = AtomicFile(disk_path_object, mode='wb')
+                return temp_file.file
+
+            def job_done(output, error):
+                if output != None:
+                    output.close()
+                try:
+                    if error == None and temp_file:
+                        temp_file.commit()
+                except OSError as err:
+                    error = err
+                if error == None:
+                    ecb(path)
+                    self._commit_signature(entry)
+                    success(entry)
+                    return
+                self.logger.warning('同時下載 {} 時發生錯誤：{}，稍後重新下載' \
+                    .format(path, error))
+                if temp_file:
+                    temp_file.discard()
+                elif output != None:
+                    try:
+                        disk_path_object.unlink()
+                    except OSError:
+                        pass
+                failed.append(entry)
+
+            return FileJob(entry['remote'][0], entry['remote'][1],
+                size=entry.get('size'), open_output=open_output,
+                progress_callback=lambda *args: dcb(path, *args),
+                done_callback=job_done)
+
+        if len(entries) > 0:
+            self.vfs.request.file_multi(list(map(make_job, entries)),
+                max_large=scheduler.large_connections)
+        return failed
+
+class ListingCancelled(Exception):
+    pass
+
+# ls 讀取 VFS 的執行緒寫入的內容，每次 flush 是一個資料夾，最多保留 size 個
+class ListingQueue:
+    def __init__(self, size):
+        self._queue = queue.Queue(maxsize=size)
+        self._buffer = list()
+        self._cancelled = threading.Event()
+
+    def write(self, text):
+        self._buffer.append(text)
+
+    def _put(self, item):
+        while True:
+            if self._cancelled.is_set():
+                raise ListingCancelled()
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def flush(self):
+        if len(self._buffer) == 0:
+            return
+        text = ''.join(self._buffer)
+        self._buffer = list()
+        self._put(text)
+
+    def close(self):
+        try:
+            self.flush()
+            self._put(None)
+        except ListingCancelled:
+            pass
+
+    def get(self):
+        return self._queue.get()
+
+    # 清空佇列，讓卡在 flush 的執行緒可以發現已經取消
+    def cancel(self):
+        self._cancelled.set()
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+# ls -l 會顯示每個檔案的大小和修改時間。VFS 產生的檔案直接計算內容大小，從
+# CEIBA 下載的檔案先查快取，查不到的累積到一定數量再一起送出 HEAD 請求。沒有
+# 指定排序方式時，每查完一批就依照原本的順序輸出，不用等全部列完
+class Ls:
+    labels = {
+        'link': '連結       ',
+        'regular': '普通檔案   ',
+        'directory': '資料夾     ',
+    }
+
+    sort_keys = {
+        'size': lambda x: x['size'],
+        'time': lambda x: x['mtime'],
+    }
+
+    def __init__(self, vfs, details=False, recursive=False, sort=None,
+        batch_size=32, prefetch=0, ordered=True, logger=None):
+        self.vfs = vfs
+        self.details = details
+        self.recursive = recursive
+        self.sort = sort
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.ordered = ordered
+        self.logger = logger if logger else logging.getLogger(__package__)
+        self._entries = list()
+        self._pending = list()
+        self._deferred = deque()
+
+    def print_file(self, output, path, recursive):
+        node = self.vfs.open(path)
+        if self.vfs.is_internal_link(node):
+            self.print_internal_link(output, path, node)
+        elif self.vfs.is_regular(node):
+            self.print_regular(output, path, node)
+        elif self.vfs.is_directory(node):
+            self.print_directory(output, path)
+            children = node.list()
+            if self.prefetch > 0:
+                output.flush()
+            for child_name, child_node in children:
+                child_path = pathlib.PurePosixPath(path) / child_name
+                child_path = child_path.as_posix()
+                if not recursive and self.vfs.is_directory(child_node):
+                    self.print_directory(output, child_path)
+                elif not self.ordered and self.vfs.is_directory(child_node) \
+                    and not child_node.ready:
+                    # 還要下載的資料夾留到最後，先印出已經知道內容的項目
+                    self._deferred.append(child_path)
+                else:
+                    self.print_file(output, child_path, recursive)
+        else:
+            assert False, '無法辨識的檔案格式'
+
+    def print_internal_link(self, output, path, node):
+        if self.details:
+            self._add(output, 'link', path,
+                suffix=' -> {}'.format(node.read_link()))
+        else:
+            output.write(path + '\n')
+
+    def print_regular(self, output, path, node=None):
+        if not self.details:
+            output.write(path + '\n')
+            return
+        if node == None:
+            node = self.vfs.open(path)
+        entry = self._add(output, 'regular', path, ready=False)
+        info = None
+        if node.local:
+            entry['size'] = node.size()
+        else:
+            info = self.vfs.cache.get('file_info', node.remote_path)
+            if info == None:
+                self._pending.append((entry, node))
+                if len(self._pending) >= self.batch_size:
+                    self.flush(output)
+                return
+        if info != None:
+            entry['size'] = info['size']
+            entry['mtime'] = info['mtime']
+        if self.sort == None and len(self._pending) == 0:
+            self._write(output)
+
+    def print_directory(self, output, path):
+        if self.details:
+            self._add(output, 'directory', path)
+        else:
+            output.write(path + '\n')
+
+    # 前面還有檔案在等待查詢時要先保留，輸出的順序才會和原本相同
+    def _add(self, output, kind, path, suffix='', ready=True):
+        entry = {'kind': kind, 'path': path, 'suffix': suffix,
+            'size': None, 'mtime': None}
+        self._entries.append(entry)
+        if ready and self.sort == None and len(self._pending) == 0:
+            self._write(output)
+        return entry
+
+    # 可以直接從網址下載的檔案一起查詢，其他的和查詢失敗的再一個一個查詢
+    def _resolve(self):
+        pending = self._pending
+        self._pending = list()
+        for (entry, node), (info, err) in zip(pending,
+            self.vfs.file_infos(list(map(lambda x: x[1], pending)))):
+            if err != None:
+                self.logger.error('無法查詢 {} 的資訊：{}' \
+                    .format(entry['path'], err))
+                continue
+            entry['size'] = info['size']
+            entry['mtime'] = info['mtime']
+
+    def format_entry(self, entry):
+        # 查詢失敗的檔案大小顯示為 ?，資料夾和連結沒有大小
+        if entry['size'] != None:
+            size = str(entry['size'])
+        elif entry['kind'] == 'regular':
+            size = '?'
+        else:
+            size = '-'
+        if entry['mtime'] != None:
+            mtime = time.strftime('%Y-%m-%d %H:%M',
+                time.localtime(entry['mtime']))
+        else:
+            mtime = '-'
+        return '{}{:>12}  {:16}  {}{}\n'.format(
+            self.labels[entry['kind']], size, mtime,
+            entry['path'], entry['suffix'])
+
+    def _write(self, output):
+        for entry in self._entries:
+            output.write(self.format_entry(entry))
+        self._entries = list()
+
+    # 查完目前累積的檔案並輸出，有指定排序方式時要等到最後才能輸出
+    def flush(self, output):
+        self._resolve()
+        if self.sort == None:
+            self._write(output)
+
+    def _run(self, output, path):
+        try:
+            self.print_file(output, path, self.recursive)
+            while len(self._deferred) > 0:
+                self.print_file(output, self._deferred.popleft(), self.recursive)
+        finally:
+            self._deferred.clear()
+            self._resolve()
+            # 大的和新的排在前面，不知道大小或時間的放在最後
+            if self.sort != None:
+                key = self.sort_keys[self.sort]
+                self._entries.sort(key=lambda x: (key(x) == None,
+                    -(key(x) or 0)))
+            self._write(output)
+
+    def run(self, output, path):
+        if self.prefetch <= 0:
+            return self._run(output, path)
+
+        # 由另一個執行緒讀取 VFS，最多領先輸出 prefetch 個資料夾，這個執行緒
+        # 只負責輸出。CEIBA 會把目前的學期和課程記錄在伺服器上，所以所有請求
+        # 仍然只由讀取 VFS 的執行緒依序送出
+        pipe = ListingQueue(self.prefetch)
+        errors = list()
+        def worker():
+            try:
+                self._run(pipe, path)
+            except ListingCancelled:
+                pass
+            except BaseException as err:
+                errors.append(err)
+            finally:
+                pipe.close()
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            for text in iter(pipe.get, None):
+                output.write(text)
+        finally:
+            # 輸出失敗時讓讀取的執行緒停下來，等它結束才能繼續使用 VFS
+            pipe.cancel()
+            thread.join()
+        if len(errors) > 0:
+            raise errors[0]
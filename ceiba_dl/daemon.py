@@ -0,0 +1,304 @@
+# License: LGPL3+
+
+from . import Request, Cat, Get, Ls, Error
+from .cache import Cache
+from .client import send_frame, socket_path
+from .config import Config
+from .profiler import current_rss, peak_rss
+from .scheduler import Scheduler
+from .store import Store
+from .vfs import VFS
+from time import monotonic
+import json
+import logging
+import os
+import signal
+import socket
+import traceback
+
+# 常駐程式會保留 VFS、已經下載過的節點和 curl 連線，讓 ls、cat、get 透過 Unix
+# socket 使用，省下每次啟動時重新載入模組、登入狀態和網頁的時間。通訊的格式
+# 請見 client 模組。
+
+class ChannelWriter:
+    def __init__(self, conn, channel, buffer_size=65536):
+        self._conn = conn
+        self._channel = channel
+        self._buffer = bytearray()
+        self._buffer_size = buffer_size
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self._buffer += data
+        if len(self._buffer) >= self._buffer_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if len(self._buffer) > 0:
+            send_frame(self._conn, self._channel, bytes(self._buffer))
+            self._buffer = bytearray()
+
+class ChannelLogHandler(logging.Handler):
+    def __init__(self, writer):
+        super().__init__()
+        self._writer = writer
+
+    def emit(self, record):
+        try:
+            self._writer.write(self.format(record) + '\n')
+            self._writer.flush()
+        except OSError:
+            pass
+
+class Daemon:
+    def __init__(self, config, idle_timeout=600, memory_limit=512 * 2**20):
+        self.logger = logging.getLogger(__name__)
+        self.config = config
+        self.idle_timeout = idle_timeout
+        self.memory_limit = memory_limit
+        self.request = None
+        self.cache = None
+        self.vfs = None
+
+    @property
+    def path(self):
+        return socket_path(self.config.name, self.config.profile)
+
+    def _open_vfs(self):
+        if not self.request:
+            self.request = Request(
+                self.config.api_cookies, self.config.web_cookies,
+                network=self.config.network, governor=self.config.governor)
+        if not self.cache:
+            self.cache = Cache(
+                self.config.name, self.config.profile, self.config.cache)
+            self.cache.load()
+        if not self.vfs:
+            self.logger.info('準備建立新的 VFS')
+            self.vfs = VFS(self.request, self.config.strings,
+                self.config.edit, cache=self.cache)
+        return self.vfs
+
+    def _drop_vfs(self, drop_request=False):
+        if self.cache:
+            self.cache.store()
+        self.vfs = None
+        if drop_request:
+            self.request = None
+            self.cache = None
+
+    def _reload_config(self):
+        # 重新登入或修改設定檔以後，原本的 VFS 就不能再用了
+        config = Config(self.config.name, self.config.profile)
+        if not config.load():
+            return False
+        for key in ['api_cookies', 'web_cookies', 'cache', 'network',
+            'governor', 'download', 'edit', 'strings']:
+            if getattr(config, key) != getattr(self.config, key):
+                self.logger.info('設定檔已經變更，重新建立 VFS')
+                self.config = config
+                self._drop_vfs(drop_request=True)
+                break
+        return True
+
+    # 終止時要和 Ctrl-C 一樣離開，快取才會寫回檔案
+    def _terminate(self, signum, frame):
+        raise SystemExit(0)
+
+    def _check_memory(self):
+        rss = current_rss()
+        if rss == None:
+            # 拿不到目前的用量就用最高用量代替
+            rss = peak_rss()
+        if rss > self.memory_limit:
+            self.logger.warning('記憶體用量 {:.1f} MiB 超過限制，清除 VFS' \
+                .format(rss / 2**20))
+            self._drop_vfs()
+
+    def run(self):
+        path = self.path
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+                self.logger.error('已經有常駐程式使用 {}'.format(path))
+                return False
+            except OSError:
+                os.unlink(path)
+            finally:
+                probe.close()
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        os.chmod(path, 0o600)
+        server.listen(8)
+        server.settimeout(self.idle_timeout)
+        signal.signal(signal.SIGTERM, self._terminate)
+        self.logger.info('常駐程式開始在 {} 等待連線'.format(path))
+
+        try:
+            while True:
+                try:
+                    conn, address = server.accept()
+                except socket.timeout:
+                    self.logger.info('閒置超過 {} 秒，常駐程式結束' \
+                        .format(self.idle_timeout))
+                    break
+                with conn:
+                    conn.settimeout(None)
+                    try:
+                        keep_running = self.serve(conn)
+                    except OSError as err:
+                        self.logger.error('用戶端連線錯誤：{}'.format(err))
+                        keep_running = True
+                if not keep_running:
+                    break
+                self._check_memory()
+        finally:
+            server.close()
+            os.unlink(path)
+            self._drop_vfs()
+        return True
+
+    def serve(self, conn):
+        line = conn.makefile('rb').readline()
+        try:
+            job = json.loads(line.decode())
+        except ValueError:
+            self.logger.error('無法辨識的用戶端請求')
+            return True
+
+        if job['command'] == 'stop':
+            send_frame(conn, b'X', json.dumps(True))
+            return False
+
+        output = ChannelWriter(conn, b'O')
+        errors = ChannelWriter(conn, b'E')
+        handler = ChannelLogHandler(errors)
+        handler.setFormatter(logging.Formatter(
+            job['log_format'], datefmt='%Y-%m-%d %H:%M:%S'))
+        root_logger = logging.getLogger()
+        root_level = root_logger.level
+        root_logger.addHandler(handler)
+        root_logger.setLevel(job['log_level'])
+        saved_cwd = os.getcwd()
+
+        try:
+            os.chdir(job['cwd'])
+            if not self._reload_config():
+                succeeded = False
+            else:
+                # 兩個指令之間可能有不經過常駐程式的 ceiba-dl 使用同一個帳號
+                if self.request:
+                    self.request.forget_state()
+                command = getattr(self, 'run_' + job['command'])
+                succeeded = command(job, conn, output)
+        except Exception:
+            # 發生意料之外的錯誤時 VFS 可能已經不完整了，下次重新建立
+            errors.write(traceback.format_exc())
+            self._drop_vfs()
+            succeeded = False
+        finally:
+            # 每個指令結束就寫回快取檔，不經過常駐程式的 ceiba-dl 才讀得到，
+            # 寫入時也會合併它們在這段期間存入的項目
+            if self.cache:
+                self.cache.store()
+            os.chdir(saved_cwd)
+            root_logger.removeHandler(handler)
+            root_logger.setLevel(root_level)
+
+        output.flush()
+        errors.flush()
+        send_frame(conn, b'X', json.dumps(succeeded))
+        return True
+
+    def _progress_sender(self, conn, path):
+        last_update = 0
+        def send_progress(total_to_download, downloaded, *args):
+            nonlocal last_update
+            current = monotonic()
+            if downloaded == None or total_to_download == downloaded or \
+                current - last_update >= 0.1:
+                last_update = current
+                send_frame(conn, b'P', json.dumps(
+                    [path, total_to_download, downloaded,
+                        self.request.governor.describe()]))
+        return send_progress
+
+    def run_cat(self, job, conn, output):
+        cat = Cat(self._open_vfs(), logger=self.logger)
+        failed = False
+        senders = dict()
+
+        def cat_progress_callback(path, total_to_download, downloaded, *args):
+            if downloaded != None:
+                if path not in senders:
+                    senders[path] = self._progress_sender(conn, path)
+                senders[path](total_to_download, downloaded, *args)
+
+        def end_callback(path):
+            output.flush()
+            if senders.pop(path, None) != None:
+                send_frame(conn, b'D', path)
+
+        # 路徑打錯不需要丟掉整個 VFS
+        def error_callback(path, err):
+            nonlocal failed
+            failed = True
+            self.logger.error(err)
+
+        cat.run_all(output, job['files'],
+            progress_callback=cat_progress_callback,
+            end_callback=end_callback, error_callback=error_callback,
+            offset=job['offset'], length=job['length'])
+        return not failed
+
+    def run_ls(self, job, conn, output):
+        lser = Ls(self._open_vfs(), details=job['long'] or job['sort'] != None,
+            recursive=job['recursive'], sort=job['sort'],
+            prefetch=job['prefetch'], ordered=not job['unordered'],
+            logger=self.logger)
+        failed = False
+        for path in job['files']:
+            try:
+                lser.run(output, path)
+            except (Error, OSError) as err:
+                # 路徑打錯不需要丟掉整個 VFS
+                failed = True
+                self.logger.error(err)
+        return not failed
+
+    def run_get(self, job, conn, output):
+        if job['dedup']:
+            store = Store()
+            store.load()
+        else:
+            store = None
+        download = self.config.download
+        download['course_priority'] = job.get('priority', []) + \
+            download.get('course_priority', [])
+        get = Get(self._open_vfs(), logging.getLogger('ceiba-dl-get'),
+            store=store, scheduler=Scheduler(download,
+                large_file_size=self.config.network.get('large_file_size', 0)))
+        senders = dict()
+
+        def download_callback(path, *args):
+            if path not in senders:
+                senders[path] = self._progress_sender(conn, path)
+            senders[path](*args)
+
+        def end_callback(path):
+            senders.pop(path, None)
+            send_frame(conn, b'D', path)
+
+        if job['no_progress']:
+            succeeded = get.run_all(job['files'], retry=job['retry'])
+        else:
+            succeeded = get.run_all(job['files'], retry=job['retry'],
+                download_progress_callback=download_callback,
+                end_download_callback=end_callback)
+        if store:
+            store.store()
+        return succeeded
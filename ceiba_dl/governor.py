@@ -0,0 +1,196 @@
+# License: LGPL3+
+
+from time import monotonic, sleep
+import logging
+import pycurl
+import threading
+
+# 控制送往 CEIBA 的請求速度和同時連線數，避免平行下載時對學校的伺服器造成太大
+# 的負擔而被限制或封鎖。
+#
+# 請求分成 api、page、file 三類，每一類和全部請求各有一個 token bucket 限制每秒
+# 的請求數。同時連線數以 AIMD 的方式調整：回應時間穩定時慢慢增加，遇到 429、
+# 5xx、逾時或回應時間明顯變長時減半。連續失敗太多次時斷路器會暫停所有請求一段
+# 時間。進度顯示和常駐程式會從其他執行緒讀取狀態，所以全部的操作都要先取得鎖。
+
+# 表示伺服器或網路出問題的 curl 錯誤
+trouble_curl_errors = [
+    pycurl.E_COULDNT_CONNECT,
+    pycurl.E_SSL_CONNECT_ERROR,
+    pycurl.E_PARTIAL_FILE,
+    pycurl.E_OPERATION_TIMEDOUT,
+    pycurl.E_GOT_NOTHING,
+    pycurl.E_SEND_ERROR,
+    pycurl.E_RECV_ERROR,
+]
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = self.burst
+        self._updated = monotonic()
+
+    def _refill(self):
+        current = monotonic()
+        self._tokens = min(self.burst,
+            self._tokens + (current - self._updated) * self.rate)
+        self._updated = current
+
+    # 回傳還要等幾秒才有 token 可以用，rate 是 0 表示不限制
+    def wait_time(self):
+        if self.rate <= 0:
+            return 0
+        self._refill()
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def take(self):
+        if self.rate <= 0:
+            return
+        self._refill()
+        self._tokens -= 1
+
+class Endpoint:
+    def __init__(self, name, rate, burst, max_connections):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.max_connections = max_connections
+        self.limit = min(2, max_connections)
+        self.latency = None
+        self.baseline = None
+        self.last_decrease = 0
+
+    @property
+    def connections(self):
+        return max(1, min(int(self.limit), self.max_connections))
+
+    def increase(self):
+        self.limit = min(self.max_connections, self.limit + 1 / self.limit)
+
+    def decrease(self):
+        # 同一批請求通常會一起變慢，短時間內只減半一次
+        current = monotonic()
+        if current - self.last_decrease < 1:
+            return False
+        self.last_decrease = current
+        self.limit = max(1, self.limit / 2)
+        return True
+
+class Governor:
+    def __init__(self, config={}):
+        self.logger = logging.getLogger(__name__)
+        self.bucket = TokenBucket(
+            config.get('rate', 0), config.get('burst', 1))
+        self.max_connections = config.get('max_connections', 4)
+        self.latency_factor = config.get('latency_factor', 3)
+        self.breaker_failures = config.get('breaker_failures', 0)
+        self.breaker_cooldown = config.get('breaker_cooldown', 15)
+        self.breaker_max_cooldown = config.get('breaker_max_cooldown', 300)
+        self.endpoints = dict()
+        for name in ['api', 'page', 'file']:
+            self.endpoints[name] = Endpoint(name,
+                config.get('{}_rate'.format(name), 0),
+                config.get('{}_burst'.format(name), 1),
+                config.get('{}_max_connections'.format(name),
+                    self.max_connections))
+        self._failures = 0
+        self._cooldown = self.breaker_cooldown
+        self._open_until = 0
+        self._lock = threading.RLock()
+
+    # network 區段的 small_file 和 large_file 都算是 file
+    def endpoint(self, request_class):
+        if request_class.endswith('_file'):
+            request_class = 'file'
+        return self.endpoints[request_class]
+
+    def connections(self, request_class):
+        with self._lock:
+            return min(self.max_connections,
+                self.endpoint(request_class).connections)
+
+    def wait_time(self, request_class):
+        with self._lock:
+            return max(self._open_until - monotonic(),
+                self.bucket.wait_time(),
+                self.endpoint(request_class).bucket.wait_time(), 0)
+
+    def try_acquire(self, request_class):
+        with self._lock:
+            if self.wait_time(request_class) > 0:
+                return False
+            self.bucket.take()
+            self.endpoint(request_class).bucket.take()
+            return True
+
+    def acquire(self, request_class):
+        while not self.try_acquire(request_class):
+            sleep(self.wait_time(request_class))
+
+    def record(self, request_class, latency=None, trouble=False):
+        with self._lock:
+            self._record(request_class, latency, trouble)
+
+    def _record(self, request_class, latency, trouble):
+        endpoint = self.endpoint(request_class)
+        if trouble:
+            if endpoint.decrease():
+                self.logger.info('{} 請求發生錯誤，同時連線數降為 {}' \
+                    .format(endpoint.name, endpoint.connections))
+            self._failures += 1
+            if self.breaker_failures > 0 and \
+                self._failures >= self.breaker_failures:
+                self.logger.warning('連續 {} 個請求失敗，暫停所有請求 {} 秒' \
+                    .format(self._failures, self._cooldown))
+                self._open_until = monotonic() + self._cooldown
+                self._cooldown = min(self._cooldown * 2,
+                    self.breaker_max_cooldown)
+            return
+
+        self._failures = 0
+        self._cooldown = self.breaker_cooldown
+        if latency == None:
+            endpoint.increase()
+            return
+        if endpoint.latency == None:
+            endpoint.latency = latency
+            endpoint.baseline = latency
+        else:
+            endpoint.latency = endpoint.latency * 0.8 + latency * 0.2
+            if endpoint.latency < endpoint.baseline:
+                endpoint.baseline = endpoint.latency
+            else:
+                # 讓基準值慢慢跟上，避免一次特別快的回應讓之後全部被當成變慢
+                endpoint.baseline = \
+                    endpoint.baseline * 0.99 + endpoint.latency * 0.01
+        if endpoint.latency > endpoint.baseline * self.latency_factor:
+            if endpoint.decrease():
+                self.logger.info('{} 請求回應變慢，同時連線數降為 {}' \
+                    .format(endpoint.name, endpoint.connections))
+        else:
+            endpoint.increase()
+
+    def record_curl(self, request_class, curl, error=None):
+        if error != None:
+            if error.args[0] in trouble_curl_errors:
+                self.record(request_class, trouble=True)
+            return
+        # 429 表示伺服器要求放慢速度，不能當成正常的回應時間
+        status = curl.getinfo(pycurl.RESPONSE_CODE)
+        if status == 429 or status >= 500:
+            self.record(request_class, trouble=True)
+        else:
+            self.record(request_class,
+                latency=curl.getinfo(pycurl.STARTTRANSFER_TIME))
+
+    def describe(self):
+        with self._lock:
+            status = '連線數 ' + ' '.join(map(
+                lambda x: '{} {}/{}'.format(x.name, x.connections,
+                    min(self.max_connections, x.max_connections)),
+                self.endpoints.values()))
+            if self._open_until > monotonic():
+                status += ' 暫停中'
+            return status
@@ -0,0 +1,234 @@
+# License: LGPL3+
+
+from .stats import endpoint_name
+from .trace import tracer
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+import base64
+import json
+import pycurl
+import urllib.parse
+
+# 把每個透過 Request 送出的 HTTP 請求記錄成 HTTP Archive (HAR 1.2) 格式，方便
+# 事後找出重複的請求和花最多時間的節點。cookie 的內容一律不記錄，回應內容只有
+# 在要求時才記錄，而且從 CEIBA 下載的檔案不會記錄內容。
+#
+# 除了標準欄位以外，每一筆記錄還有：
+#   _endpoint  請求的類別，和 --stats 使用的相同
+#   _node      送出請求時正在 fetch 的 VFS 節點路徑
+#   _nodeStack 從外到內所有正在 fetch 的節點路徑
+#   _error     curl 發生錯誤時的錯誤訊息
+
+redacted = '<redacted>'
+redacted_headers = [b'cookie', b'set-cookie']
+
+def parse_header_lines(data):
+    first_line = None
+    headers = list()
+    for line in data.split(b'\r\n'):
+        if len(line) == 0:
+            continue
+        if first_line == None:
+            first_line = line.decode('iso-8859-1')
+            continue
+        if line.find(b':') < 0:
+            continue
+        name, value = line.split(b':', maxsplit=1)
+        if name.strip().lower() in redacted_headers:
+            value = redacted.encode()
+        headers.append(OrderedDict([
+            ('name', name.strip().decode('iso-8859-1')),
+            ('value', value.strip().decode('iso-8859-1'))]))
+    return first_line, headers
+
+class Exchange:
+    def __init__(self):
+        self.started = datetime.now(timezone.utc)
+        self.header_out = b''
+        self.header_in = b''
+        self.body = bytearray()
+        self.context = tracer.context()
+
+    def debug(self, info_type, data, keep_body):
+        if info_type == pycurl.INFOTYPE_HEADER_OUT:
+            self.header_out += data
+        elif info_type == pycurl.INFOTYPE_HEADER_IN:
+            # 只保留最後一個回應的標頭
+            if data.startswith(b'HTTP/'):
+                self.header_in = b''
+            self.header_in += data
+        elif info_type == pycurl.INFOTYPE_DATA_IN and keep_body:
+            self.body += data
+
+class HarRecorder:
+    def __init__(self, include_bodies=False):
+        self.include_bodies = include_bodies
+        self.entries = list()
+        self._exchanges = dict()
+
+    def begin(self, curl, request_class):
+        exchange = Exchange()
+        keep_body = self.include_bodies and not request_class.endswith('_file')
+        self._exchanges[id(curl)] = exchange
+        curl.setopt(pycurl.VERBOSE, True)
+        curl.setopt(pycurl.DEBUGFUNCTION,
+            lambda info_type, data: exchange.debug(info_type, data, keep_body))
+
+    def finish(self, curl, request_class, error=None, head=False):
+        exchange = self._exchanges.pop(id(curl), None)
+        curl.setopt(pycurl.VERBOSE, False)
+        if exchange == None:
+            return
+        url = curl.getinfo(pycurl.EFFECTIVE_URL)
+        request_line, request_headers = parse_header_lines(exchange.header_out)
+        status_line, response_headers = parse_header_lines(exchange.header_in)
+        if request_line:
+            method = request_line.split(' ')[0]
+        else:
+            method = 'HEAD' if head else 'GET'
+        http_version = 'HTTP/1.1'
+        status_text = ''
+        if status_line:
+            status_parts = status_line.split(' ', 2)
+            http_version = status_parts[0]
+            if len(status_parts) > 2:
+                status_text = status_parts[2]
+
+        # curl 的時間都是從開始累積的，HAR 要的是各階段各自的時間，單位是毫秒。
+        # 依照 HAR 的規定，TLS 交握的時間同時算在 connect 和 ssl 裡面
+        def info(name):
+            return curl.getinfo(name) * 1000
+        namelookup = info(pycurl.NAMELOOKUP_TIME)
+        connect = info(pycurl.CONNECT_TIME)
+        appconnect = info(pycurl.APPCONNECT_TIME)
+        pretransfer = info(pycurl.PRETRANSFER_TIME)
+        starttransfer = info(pycurl.STARTTRANSFER_TIME)
+        total = info(pycurl.TOTAL_TIME)
+        connected = max(connect, appconnect)
+        timings = OrderedDict([
+            ('blocked', -1),
+            ('dns', namelookup),
+            ('connect', max(connected - namelookup, 0)),
+            ('ssl', max(appconnect - connect, 0) if appconnect > 0 else -1),
+            ('send', max(pretransfer - connected, 0)),
+            ('wait', max(starttransfer - pretransfer, 0)),
+            ('receive', max(total - max(starttransfer, pretransfer), 0)),
+        ])
+
+        size = int(curl.getinfo(pycurl.SIZE_DOWNLOAD))
+        content = OrderedDict([
+            ('size', size),
+            ('mimeType', curl.getinfo(pycurl.CONTENT_TYPE) or ''),
+        ])
+        if len(exchange.body) > 0:
+            try:
+                content['text'] = exchange.body.decode('utf-8')
+            except UnicodeDecodeError:
+                content['text'] = base64.b64encode(exchange.body).decode()
+                content['encoding'] = 'base64'
+
+        query = urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query)
+        entry = OrderedDict([
+            ('startedDateTime', exchange.started.isoformat()),
+            ('time', total),
+            ('request', OrderedDict([
+                ('method', method),
+                ('url', url),
+                ('httpVersion', http_version),
+                ('cookies', []),
+                ('headers', request_headers),
+                ('queryString', list(map(lambda x: OrderedDict(
+                    [('name', x[0]), ('value', x[1])]), query))),
+                ('headersSize', len(exchange.header_out) or -1),
+                ('bodySize', 0),
+            ])),
+            ('response', OrderedDict([
+                ('status', curl.getinfo(pycurl.RESPONSE_CODE)),
+                ('statusText', status_text),
+                ('httpVersion', http_version),
+                ('cookies', []),
+                ('headers', response_headers),
+                ('content', content),
+                ('redirectURL', curl.getinfo(pycurl.REDIRECT_URL) or ''),
+                ('headersSize', len(exchange.header_in) or -1),
+                ('bodySize', size),
+            ])),
+            ('cache', OrderedDict()),
+            ('timings', timings),
+            ('_endpoint', endpoint_name(request_class, url, head=head)),
+            ('_node', exchange.context[-1] if exchange.context else None),
+            ('_nodeStack', exchange.context),
+        ])
+        if error != None:
+            entry['_error'] = str(error)
+        self.entries.append(entry)
+
+    def write(self, path):
+        try:
+            from ._version import version
+        except ImportError:
+            version = ''
+        har = OrderedDict([('log', OrderedDict([
+            ('version', '1.2'),
+            ('creator', OrderedDict([
+                ('name', 'ceiba-dl'), ('version', version)])),
+            ('pages', []),
+            ('entries', self.entries),
+        ]))])
+        with open(path, 'w') as har_file:
+            json.dump(har, har_file, ensure_ascii=False, indent=1)
+
+# 分析 HAR 檔案：重複的請求、每個節點送出的請求數量，以及花最多時間的節點路徑
+
+def analyze(har, output, limit=20):
+    entries = har['log']['entries']
+    total_time = sum(map(lambda x: max(x['time'], 0), entries))
+    total_bytes = sum(map(
+        lambda x: max(x['response'].get('bodySize', 0), 0), entries))
+    output.write('請求數：{}，總時間：{:.2f} 秒，總下載量：{:.2f} MiB\n'.format(
+        len(entries), total_time / 1000, total_bytes / 2**20))
+
+    # 網址和 Range 都相同才算是重複的請求
+    def request_key(entry):
+        request = entry['request']
+        ranges = [ x['value'] for x in request.get('headers', [])
+            if x['name'].lower() == 'range' ]
+        return (request['method'], request['url'], tuple(ranges))
+    groups = OrderedDict()
+    for entry in entries:
+        groups.setdefault(request_key(entry), list()).append(entry)
+    duplicates = sorted(filter(lambda x: len(x[1]) > 1, groups.items()),
+        key=lambda x: sum(map(lambda y: y['time'], x[1][1:])), reverse=True)
+    output.write('\n重複的請求：{} 組，多花了 {:.2f} 秒\n'.format(len(duplicates),
+        sum(map(lambda x: sum(map(lambda y: y['time'], x[1][1:])),
+            duplicates)) / 1000))
+    for (method, url, ranges), group in duplicates[:limit]:
+        output.write('  {} 次  {:8.2f} 秒  {} {}\n'.format(len(group),
+            sum(map(lambda x: x['time'], group[1:])) / 1000, method, url))
+
+    def node_of(entry):
+        return entry.get('_node') or '（不明）'
+    node_counts = Counter(map(node_of, entries))
+    node_times = Counter()
+    for entry in entries:
+        node_times[node_of(entry)] += entry['time']
+    output.write('\n各節點送出的請求：\n')
+    for node, count in node_counts.most_common(limit):
+        output.write('  {:5} 個  {:8.2f} 秒  {}\n'.format(
+            count, node_times[node] / 1000, node))
+
+    # 每個節點的時間包含它底下所有節點的請求，從最外層開始每次往下選時間最長的
+    inclusive = Counter()
+    children = dict()
+    for entry in entries:
+        stack = tuple(entry.get('_nodeStack') or [])
+        for depth in range(len(stack) + 1):
+            inclusive[stack[:depth]] += entry['time']
+            if depth < len(stack):
+                children.setdefault(stack[:depth], set()).add(stack[:depth + 1])
+    output.write('\n花最多時間的節點路徑：\n')
+    current = ()
+    while current in children:
+        current = max(children[current], key=lambda x: inclusive[x])
+        output.write('  {:8.2f} 秒  {}\n'.format(
+            inclusive[current] / 1000, current[-1]))
@@ -0,0 +1,204 @@
+# License: LGPL3+
+
+from . import Error
+from .atomic import write_atomic
+from collections import OrderedDict
+from fuse import FUSE, FuseOSError, Operations
+from io import BytesIO
+import errno
+import hashlib
+import logging
+import os
+import posixpath
+import pycurl
+import stat
+import time
+
+# 透過 FUSE 把 VFS 掛載成真正的檔案系統。資料夾在第一次列出時才會下載，從網路
+# 下載的檔案則以固定大小的區塊存在磁碟上，讀取時只下載需要的區塊，超過
+# cache_size 時先刪掉最久沒有用到的區塊。
+#
+# VFS 和 CEIBA 的登入狀態都不能同時處理多個請求，所以 FUSE 必須以單一執行緒
+# 執行。
+
+class CeibaOperations(Operations):
+    def __init__(self, vfs, block_dir, block_size=2**20,
+        cache_size=256 * 2**20):
+        self.logger = logging.getLogger(__name__)
+        self.vfs = vfs
+        self.block_dir = block_dir
+        self.block_size = block_size
+        self.cache_size = cache_size
+        self.mount_time = time.time()
+        self._blocks = self._scan_blocks()
+
+    # 只有上層資料夾需要下載，查詢屬性時不會下載資料夾本身，ls -l 掛載的資料夾
+    # 才不用下載每個子資料夾
+    def _open(self, path, fetch=True):
+        try:
+            if fetch:
+                return self.vfs.open(path)
+            parent_path, name = posixpath.split(path)
+            parent = self.vfs.open(parent_path)
+            if name == '':
+                return parent
+            if not self.vfs.is_directory(parent):
+                raise NotADirectoryError('{} 不是資料夾'.format(parent_path))
+            return parent.access(name)
+        except FileNotFoundError:
+            raise FuseOSError(errno.ENOENT)
+        except NotADirectoryError:
+            raise FuseOSError(errno.ENOTDIR)
+        except (Error, pycurl.error) as err:
+            self.logger.error(err)
+            raise FuseOSError(errno.EIO)
+
+    # 從網路下載的檔案需要送出 HEAD 請求才知道大小，和 ls -l 共用快取
+    def _info(self, node):
+        if node.local:
+            return {'size': node.size(), 'mtime': None}
+        info = self.vfs.cache.get('file_info', node.remote_path)
+        if info == None:
+            try:
+                info = node.info()
+            except (Error, pycurl.error) as err:
+                self.logger.error(err)
+                raise FuseOSError(errno.EIO)
+            self.vfs.cache.set('file_info', node.remote_path, info)
+        return info
+
+    def getattr(self, path, fh=None):
+        node = self._open(path, fetch=False)
+        attrs = {
+            'st_uid': os.getuid(),
+            'st_gid': os.getgid(),
+            'st_atime': self.mount_time,
+            'st_mtime': self.mount_time,
+            'st_ctime': self.mount_time
+        }
+        if self.vfs.is_internal_link(node):
+            attrs['st_mode'] = stat.S_IFLNK | 0o777
+            attrs['st_nlink'] = 1
+            attrs['st_size'] = len(node.read_link().encode())
+        elif self.vfs.is_directory(node):
+            attrs['st_mode'] = stat.S_IFDIR | 0o555
+            attrs['st_nlink'] = 2
+            attrs['st_size'] = 0
+        elif self.vfs.is_regular(node):
+            attrs['st_mode'] = stat.S_IFREG | 0o444
+            attrs['st_nlink'] = 1
+            info = self._info(node)
+            attrs['st_size'] = info['size']
+            if info['mtime'] != None:
+                attrs['st_mtime'] = info['mtime']
+        else:
+            assert False, '無法辨識的檔案格式'
+        return attrs
+
+    def readdir(self, path, fh):
+        node = self._open(path)
+        if not self.vfs.is_directory(node):
+            raise FuseOSError(errno.ENOTDIR)
+        try:
+            children = node.list()
+        except (Error, pycurl.error) as err:
+            self.logger.error(err)
+            raise FuseOSError(errno.EIO)
+        return ['.', '..'] + list(map(lambda x: x[0], children))
+
+    def readlink(self, path):
+        node = self._open(path)
+        if not self.vfs.is_internal_link(node):
+            raise FuseOSError(errno.EINVAL)
+        return node.read_link()
+
+    def open(self, path, flags):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            raise FuseOSError(errno.EROFS)
+        node = self._open(path)
+        if not self.vfs.is_regular(node):
+            raise FuseOSError(errno.EISDIR)
+        return 0
+
+    # 檔案大小也是區塊名稱的一部分，檔案被更新後就不會讀到舊的區塊
+    def _block_path(self, node, size, index):
+        key = hashlib.sha1('{} {}'.format(node.remote_path, size).encode()) \
+            .hexdigest()
+        return os.path.join(self.block_dir, key[:2], key, str(index))
+
+    # 依照修改時間由舊到新排列，讀取區塊時會更新修改時間
+    def _scan_blocks(self):
+        blocks = list()
+        for dir_path, dir_names, file_names in os.walk(self.block_dir):
+            for file_name in file_names:
+                block_path = os.path.join(dir_path, file_name)
+                try:
+                    block_stat = os.stat(block_path)
+                except OSError:
+                    continue
+                blocks.append((block_stat.st_mtime, block_path,
+                    block_stat.st_size))
+        blocks.sort()
+        return OrderedDict(map(lambda x: (x[1], x[2]), blocks))
+
+    def _evict_blocks(self):
+        total = sum(self._blocks.values())
+        while total > self.cache_size and len(self._blocks) > 1:
+            block_path, block_size = self._blocks.popitem(last=False)
+            total -= block_size
+            try:
+                os.unlink(block_path)
+            except OSError:
+                pass
+
+    def _read_block(self, node, size, index):
+        block_path = self._block_path(node, size, index)
+        try:
+            with open(block_path, 'rb') as block_file:
+                data = block_file.read()
+            os.utime(block_path)
+            self._blocks[block_path] = len(data)
+            self._blocks.move_to_end(block_path)
+            return data
+        except FileNotFoundError:
+            pass
+
+        block = BytesIO()
+        node.read(block, offset=index * self.block_size,
+            length=self.block_size)
+        os.makedirs(os.path.dirname(block_path), exist_ok=True)
+        write_atomic(block_path, block.getvalue(), mode='wb')
+        self._blocks[block_path] = len(block.getvalue())
+        self._evict_blocks()
+        return block.getvalue()
+
+    def read(self, path, size, offset, fh):
+        node = self._open(path)
+        if not self.vfs.is_regular(node):
+            raise FuseOSError(errno.EISDIR)
+        try:
+            # 其他檔案的內容本來就在記憶體中，直接取需要的部份
+            if node.local:
+                content = BytesIO()
+                node.read(content, offset=offset, length=size)
+                return content.getvalue()
+
+            data = bytearray()
+            first = offset // self.block_size
+            last = (offset + size - 1) // self.block_size
+            for index in range(first, last + 1):
+                block = self._read_block(node, self._info(node)['size'],
+                    index)
+                data += block
+                if len(block) < self.block_size:
+                    break
+            start = offset - first * self.block_size
+            return bytes(data[start:start + size])
+        except (Error, pycurl.error) as err:
+            self.logger.error(err)
+            raise FuseOSError(errno.EIO)
+
+def mount(vfs, mountpoint, block_dir, cache_size=256 * 2**20,
+    foreground=True):
+    FUSE(CeibaOperations(vfs, block_dir, cache_size=cache_size), mountpoint,
+        foreground=foreground, nothreads=True, ro=True, fsname='ceiba-dl')
@@ -0,0 +1,156 @@
+# License: LGPL3+
+
+from collections import Counter
+import functools
+import os
+import pstats
+import resource
+import sys
+
+# 用 cProfile 和 tracemalloc 找出花最多 CPU 時間和記憶體的程式碼。
+#
+# CPU 的部分直接用 cProfile 執行子指令，可以寫成 pstats 格式或是 flamegraph.pl
+# 使用的 collapsed stack 格式。cProfile 只記錄呼叫者和被呼叫者的關係，所以
+# collapsed stack 是依照每個呼叫者佔的比例把時間分下去推算出來的。
+#
+# 記憶體的部分會在列出學期、下載課程和下載完檔案這些階段結束時記錄 tracemalloc
+# 追蹤到的記憶體用量和峰值，結束時再和一開始的 snapshot 比較，列出配置最多記憶體
+# 的程式碼。預設不啟用，這時每個階段只多一次判斷的成本。
+
+def write_cpu_profile(profile, path, profile_format='pstats'):
+    stats = pstats.Stats(profile)
+    if profile_format == 'pstats':
+        stats.dump_stats(path)
+    else:
+        with open(path, 'w') as profile_file:
+            profile_file.write(collapsed_stacks(stats))
+
+def function_name(func):
+    filename, line, name = func
+    if filename == '~':
+        return name.replace(';', ':')
+    return '{}:{}:{}'.format(os.path.basename(filename), line, name) \
+        .replace(';', ':')
+
+# 從沒有呼叫者的函式開始往下走，每個被呼叫的函式分到的比例是從這個呼叫者來的
+# 時間佔它總時間的比例。遇到遞迴或分到的時間不到 1 微秒時就不再往下走
+def collapsed_stacks(stats, max_depth=64):
+    callees = dict()
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for caller, caller_stats in callers.items():
+            callees.setdefault(caller, list()).append((func, caller_stats[3]))
+    self_time = Counter()
+
+    def walk(func, stack, fraction):
+        stack = stack + (func,)
+        self_time[stack] += stats.stats[func][2] * fraction
+        if len(stack) >= max_depth:
+            return
+        for callee, edge_time in callees.get(func, []):
+            callee_time = stats.stats[callee][3]
+            if callee in stack or callee_time <= 0:
+                continue
+            callee_fraction = fraction * min(edge_time / callee_time, 1)
+            if callee_time * callee_fraction >= 1e-6:
+                walk(callee, stack, callee_fraction)
+
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if len(callers) == 0:
+            walk(func, (), 1)
+
+    lines = list()
+    for stack, duration in sorted(self_time.items()):
+        weight = int(round(duration * 1e6))
+        if weight > 0:
+            lines.append('{} {}'.format(
+                ';'.join(map(function_name, stack)), weight))
+    return '\n'.join(lines) + '\n'
+
+# Linux 的 ru_maxrss 單位是 KiB，macOS 則是位元組
+def peak_rss():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss
+    return maxrss * 1024
+
+def current_rss():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return None
+
+class MemoryProfiler:
+    def __init__(self):
+        self.enabled = False
+        self.phases = list()
+        self._baseline = None
+
+    def enable(self, frames=1):
+        import tracemalloc
+        tracemalloc.start(frames)
+        self.enabled = True
+        self._baseline = tracemalloc.take_snapshot()
+
+    # 記錄從上一個階段結束到現在的記憶體峰值，然後重新開始計算峰值
+    def phase(self, name):
+        if not self.enabled:
+            return
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        self.phases.append((name, current, peak, current_rss()))
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+    def report(self, output, limit=10):
+        import tracemalloc
+        import cProfile
+        # 不要把分析程式本身用到的記憶體算進去
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, pstats.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        ])
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        def mib(size):
+            return '{:.2f}'.format(size / 2**20) if size != None else '-'
+        if len(self.phases) > 0:
+            output.write('記憶體峰值最高的階段（MiB）：\n')
+            output.write('  {:>8}  {:>8}  {:>8}  {}\n'.format(
+                '峰值', '結束時', 'RSS', '階段'))
+            for name, phase_current, phase_peak, rss in sorted(self.phases,
+                key=lambda x: x[2], reverse=True)[:limit]:
+                output.write('  {:>10}  {:>10}  {:>10}  {}\n'.format(
+                    mib(phase_peak), mib(phase_current), mib(rss), name))
+        output.write('增加最多記憶體的程式碼：\n')
+        for stat in snapshot.compare_to(self._baseline, 'lineno')[:limit]:
+            frame = stat.traceback[0]
+            output.write('  {:>+10.1f} KiB  {:>8} 個  {}:{}\n'.format(
+                stat.size_diff / 1024, stat.count_diff,
+                frame.filename, frame.lineno))
+        output.write('tracemalloc 結束時 {} MiB，峰值 {} MiB，RSS 峰值 {} MiB\n' \
+            .format(mib(current), mib(max([peak] + list(map(
+                lambda x: x[2], self.phases)))), mib(peak_rss())))
+
+memory = MemoryProfiler()
+
+def phase(name):
+    memory.phase(name)
+
+# 用在 fetch 之類的方法，方法結束時記錄一個階段
+def memory_phase(describe):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                if memory.enabled:
+                    memory.phase(describe(self, *args, **kwargs))
+        return wrapper
+    return decorator
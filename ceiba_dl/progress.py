@@ -0,0 +1,296 @@
+# License: LGPL3+
+
+from collections import OrderedDict, deque
+from time import monotonic, time
+import functools
+import json
+import shutil
+import threading
+
+# 整個執行過程的下載進度。所有檔案傳輸和節點的 fetch 都會回報到同一個 Progress，
+# 由另一個執行緒定時畫到終端機上，或是以每行一個 JSON 的格式寫給包裝 ceiba-dl
+# 的程式讀取。回報進度只需要更新幾個數字，畫面更新的頻率不會影響下載速度。
+#
+# JSON 事件的 event 欄位有以下幾種：
+#   start     開始傳輸一個檔案，有 path 和 total
+#   done      一個檔案傳輸結束，有 path 和 bytes
+#   fetch     開始下載一個節點的內容，有 path
+#   progress  定時送出的整體進度，和 Progress.snapshot 的內容相同
+#   end       全部結束，之後不會再有其他事件
+
+class Transfer:
+    def __init__(self, path):
+        self.path = path
+        self.total = None
+        self.downloaded = 0
+        self.started = monotonic()
+
+class Progress:
+    def __init__(self):
+        self.enabled = False
+        self.listeners = list()
+        # 連線狀態，可以是字串或是回傳字串的函式
+        self.status = None
+        self._lock = threading.Lock()
+        self._planned_files = 0
+        self._planned_bytes = 0
+        self._files_done = 0
+        self._bytes_done = 0
+        self._bytes_finished_total = 0
+        self._transfers = OrderedDict()
+        self._fetching = dict()
+        self._samples = deque()
+
+    def enable(self):
+        self.enabled = True
+
+    def _emit(self, event, **fields):
+        if len(self.listeners) == 0:
+            return
+        event = OrderedDict([('event', event), ('time', time())])
+        event.update(sorted(fields.items()))
+        for listener in self.listeners:
+            listener(event)
+
+    # 事先知道要下載多少檔案時，ETA 才能包含還沒開始的檔案
+    def plan(self, files=0, size=0):
+        with self._lock:
+            self._planned_files += files
+            self._planned_bytes += size
+
+    # total 和 downloaded 是 curl 回報的數字，本機的檔案和資料夾則是 None
+    def update(self, path, total, downloaded, status=None):
+        if status != None:
+            self.status = status
+        with self._lock:
+            transfer = self._transfers.get(path)
+            if transfer == None:
+                transfer = Transfer(path)
+                self._transfers[path] = transfer
+                started = True
+            else:
+                started = False
+            if downloaded != None:
+                if total:
+                    transfer.total = total
+                transfer.downloaded = downloaded
+        if started:
+            self._emit('start', path=path, total=transfer.total)
+
+    def finish(self, path):
+        with self._lock:
+            transfer = self._transfers.pop(path, None)
+            if transfer == None:
+                return
+            self._files_done += 1
+            self._bytes_done += transfer.downloaded
+            self._bytes_finished_total += max(
+                transfer.total or 0, transfer.downloaded)
+        self._emit('done', path=path, bytes=transfer.downloaded)
+
+    def fetch_begin(self, path):
+        with self._lock:
+            self._fetching[threading.get_ident()] = path
+        self._emit('fetch', path=path)
+
+    def fetch_end(self):
+        with self._lock:
+            self._fetching.pop(threading.get_ident(), None)
+
+    # 傳輸速度以最近 10 秒的下載量計算
+    def snapshot(self, window=10):
+        with self._lock:
+            current = monotonic()
+            transfers = list(map(lambda x: OrderedDict([
+                ('path', x.path),
+                ('total', x.total),
+                ('downloaded', x.downloaded),
+                ('elapsed', current - x.started),
+            ]), self._transfers.values()))
+            bytes_done = self._bytes_done + sum(
+                map(lambda x: x['downloaded'], transfers))
+            known_bytes = self._bytes_finished_total + sum(
+                map(lambda x: x['total'] or 0, transfers))
+            files_done = self._files_done
+            fetching = list(self._fetching.values())
+            self._samples.append((current, bytes_done))
+            while len(self._samples) > 2 and \
+                current - self._samples[1][0] >= window:
+                self._samples.popleft()
+            first_time, first_bytes = self._samples[0]
+        if current - first_time > 0:
+            rate = (bytes_done - first_bytes) / (current - first_time)
+        else:
+            rate = 0
+        status = self.status() if callable(self.status) else self.status
+        files_planned = self._planned_files or None
+        bytes_planned = max(self._planned_bytes, known_bytes)
+        if rate > 0 and bytes_planned > bytes_done:
+            eta = (bytes_planned - bytes_done) / rate
+        else:
+            eta = None
+        return OrderedDict([
+            ('files_done', files_done),
+            ('files_planned', files_planned),
+            ('bytes_done', bytes_done),
+            ('bytes_planned', bytes_planned),
+            ('rate', rate),
+            ('eta', eta),
+            ('status', status),
+            ('transfers', transfers),
+            ('fetching', fetching),
+        ])
+
+progress = Progress()
+
+# 用在 File 子類別的 fetch，讓進度顯示知道現在正在下載哪個節點
+def reported_fetch(describe):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not progress.enabled:
+                return method(self, *args, **kwargs)
+            progress.fetch_begin(describe(self))
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                progress.fetch_end()
+        return wrapper
+    return decorator
+
+def format_size(size):
+    return '{:.2f}'.format(size / 2**20)
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return '{:02}:{:02}:{:02}'.format(
+        seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+# 中文字在終端機上佔兩格
+def display_width(text):
+    from unicodedata import east_asian_width
+    return sum(map(lambda x: 2 if east_asian_width(x) in 'WF' else 1, text))
+
+# 太長的路徑保留結尾，避免換行以後游標移動的行數不對
+def fit(text, width):
+    if display_width(text) <= width:
+        return text
+    while len(text) > 0 and display_width(text) > width - 1:
+        text = text[1:]
+    return '…' + text
+
+def summary_line(snapshot):
+    parts = list()
+    if snapshot['files_planned'] != None:
+        parts.append('檔案 {}/{}'.format(
+            snapshot['files_done'], snapshot['files_planned']))
+    else:
+        parts.append('檔案 {}'.format(snapshot['files_done']))
+    parts.append('{}/{} MiB'.format(format_size(snapshot['bytes_done']),
+        format_size(snapshot['bytes_planned'])))
+    parts.append('{} MiB/s'.format(format_size(snapshot['rate'])))
+    if snapshot['eta'] != None:
+        parts.append('剩餘 {}'.format(format_duration(snapshot['eta'])))
+    if snapshot['status']:
+        parts.append('[{}]'.format(snapshot['status']))
+    return '  '.join(parts)
+
+def transfer_line(transfer):
+    if transfer['total']:
+        return '{}: {}% ({}/{} MiB)'.format(transfer['path'],
+            min(transfer['downloaded'] * 100 // transfer['total'], 100),
+            format_size(transfer['downloaded']), format_size(transfer['total']))
+    return '{}: {} MiB'.format(transfer['path'],
+        format_size(transfer['downloaded']))
+
+class Display(threading.Thread):
+    def __init__(self, progress, output=None, json_output=None,
+        interval=0.2, max_transfers=8):
+
+        super().__init__(daemon=True)
+        self.progress = progress
+        self.output = output
+        self.json_output = json_output
+        self.interval = interval
+        self.max_transfers = max_transfers
+        self.terminal = output != None and output.isatty()
+        self._lock = threading.RLock()
+        self._stop_event = threading.Event()
+        self._drawn = 0
+        self._last_plain = 0
+        if json_output != None:
+            progress.listeners.append(self.event)
+
+    def event(self, fields):
+        with self._lock:
+            self.json_output.write(json.dumps(fields, ensure_ascii=False) + '\n')
+            self.json_output.flush()
+
+    def _erase(self):
+        if self._drawn > 0:
+            self.output.write('\x1b[{}F\x1b[J'.format(self._drawn))
+            self._drawn = 0
+
+    def _draw(self, snapshot):
+        width = max(shutil.get_terminal_size().columns - 1, 10)
+        lines = [summary_line(snapshot)]
+        for transfer in snapshot['transfers'][:self.max_transfers]:
+            lines.append('  ' + transfer_line(transfer))
+        if len(snapshot['transfers']) > self.max_transfers:
+            lines.append('  還有 {} 個檔案正在下載'.format(
+                len(snapshot['transfers']) - self.max_transfers))
+        for path in snapshot['fetching']:
+            lines.append('  讀取 {}'.format(path))
+        self._erase()
+        for line in lines:
+            self.output.write(fit(line, width) + '\n')
+        self._drawn = len(lines)
+        self.output.flush()
+
+    # 不是終端機時不能移動游標，只偶爾印出一行整體進度
+    def _render(self, final=False):
+        snapshot = self.progress.snapshot()
+        with self._lock:
+            if self.json_output != None:
+                fields = OrderedDict([('event', 'progress'), ('time', time())])
+                fields.update(snapshot)
+                self.event(fields)
+            if self.output == None:
+                return
+            if self.terminal:
+                if final:
+                    self._erase()
+                    self.output.write(summary_line(snapshot) + '\n')
+                    self.output.flush()
+                else:
+                    self._draw(snapshot)
+            elif final or monotonic() - self._last_plain >= 10:
+                self._last_plain = monotonic()
+                self.output.write(summary_line(snapshot) + '\n')
+                self.output.flush()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self._render()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self._render(final=True)
+        if self.json_output != None:
+            self.progress.listeners.remove(self.event)
+            self.event({'event': 'end', 'time': time()})
+
+    # 記錄訊息也是寫到終端機上，要先清掉進度再寫，寫完以後馬上重畫
+    def write(self, text):
+        with self._lock:
+            if not self.terminal:
+                return self.output.write(text)
+            self._erase()
+            self.output.write(text)
+            if text.endswith('\n'):
+                self._draw(self.progress.snapshot())
+            return len(text)
+
+    def flush(self):
+        self.output.flush()
@@ -0,0 +1,62 @@
+# License: LGPL3+
+
+from fnmatch import fnmatchcase
+from pathlib import PurePosixPath
+
+# 決定 get 下載檔案的順序。同時下載多個檔案時，如果一開始就被幾個很大的影片
+# 佔住所有連線，數百個小檔案就要等很久才會出現，所以排序的規則是：
+#
+#   1. metadata_first：VFS 產生的 JSON、CSV 等本機檔案最先寫入
+#   2. course_priority：符合清單中前面的 glob 樣式的路徑先下載
+#   3. current_semester_first：目前學期的課程比其他學期先下載
+#   4. largest_first：大檔案依照大小由大到小先開始，讓最久的傳輸盡早開始，
+#      小檔案則由小到大排在後面。磁碟上還沒有的檔案不會先查詢大小，只有快取中
+#      有檔案資訊時才知道大小，不知道大小的檔案都當作小檔案
+#
+# 大檔案同時最多只會佔用 large_connections 個連線，剩下的連線留給小檔案。
+
+class Scheduler:
+    def __init__(self, config={}, large_file_size=0):
+        self.concurrent = config.get('concurrent', False)
+        self.metadata_first = config.get('metadata_first', True)
+        self.current_semester_first = config.get('current_semester_first', True)
+        self.course_priority = list(config.get('course_priority', []))
+        self.largest_first = config.get('largest_first', True)
+        self.large_connections = config.get('large_connections', None)
+        self.large_file_size = large_file_size
+        self.current_semester = None
+
+    def is_large(self, size):
+        return size != None and size >= self.large_file_size
+
+    # 路徑本身或任何一層上層資料夾符合樣式都算
+    def rank(self, path):
+        path_object = PurePosixPath(path)
+        candidates = [str(path_object)] + list(map(str, path_object.parents))
+        for index, pattern in enumerate(self.course_priority):
+            if any(map(lambda x: fnmatchcase(x, pattern), candidates)):
+                return index
+        return len(self.course_priority)
+
+    def in_current_semester(self, path):
+        if self.current_semester == None:
+            return False
+        current = PurePosixPath(self.current_semester)
+        path_object = PurePosixPath(path)
+        return path_object == current or current in path_object.parents
+
+    def key(self, path, size):
+        if self.current_semester_first:
+            semester = 0 if self.in_current_semester(path) else 1
+        else:
+            semester = 0
+        if self.largest_first and self.is_large(size):
+            size_key = (0, -size)
+        else:
+            size_key = (1, size or 0)
+        return (self.rank(path), semester, size_key)
+
+    # items 的每一項是 (路徑, 大小, 其他資料)，排序是穩定的，相同優先順序時維持
+    # 原本的順序
+    def order(self, items):
+        return sorted(items, key=lambda x: self.key(x[0], x[1]))
@@ -0,0 +1,200 @@
+# License: LGPL3+
+
+from .atomic import write_atomic
+from .progress import display_width
+from collections import Counter, OrderedDict
+import json
+import pycurl
+import urllib.parse
+
+# 統計每一類請求的數量、下載量、HTTP 狀態、重試次數和花費的時間。請求依照
+# 網址分類：CEIBA API 用 mode 參數分類，網頁用檔名分類，例如 hw_show.php，
+# 檔案下載則全部歸為同一類，避免每個檔案各自成為一類。
+
+# 各階段的時間都是從送出請求開始計算的累積時間
+timing_names = OrderedDict([
+    ('namelookup', pycurl.NAMELOOKUP_TIME),
+    ('connect', pycurl.CONNECT_TIME),
+    ('appconnect', pycurl.APPCONNECT_TIME),
+    ('starttransfer', pycurl.STARTTRANSFER_TIME),
+    ('total', pycurl.TOTAL_TIME),
+])
+
+# 總時間分布的上限，單位是秒
+latency_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf')]
+
+def endpoint_name(request_class, url, head=False):
+    parts = urllib.parse.urlsplit(url)
+    if request_class == 'api':
+        query = urllib.parse.parse_qs(parts.query)
+        return 'api mode={}'.format(query.get('mode', [''])[0])
+    if request_class == 'page':
+        return parts.path.rsplit('/', 1)[-1]
+    if head:
+        return 'file HEAD'
+    return 'file'
+
+class EndpointStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.statuses = Counter()
+        self.timings = OrderedDict(map(lambda x: (x, 0.0), timing_names))
+        self.histogram = [0] * len(latency_buckets)
+
+    def to_dict(self):
+        return OrderedDict([
+            ('requests', self.requests),
+            ('errors', self.errors),
+            ('retries', self.retries),
+            ('bytes', self.bytes),
+            ('statuses', OrderedDict(sorted(
+                map(lambda x: (str(x[0]), x[1]), self.statuses.items())))),
+            ('timings', self.timings),
+            ('histogram', OrderedDict(map(
+                lambda x: ('+Inf' if x[0] == float('inf') else str(x[0]), x[1]),
+                zip(latency_buckets, self.histogram)))),
+        ])
+
+class Stats:
+    def __init__(self):
+        self.endpoints = dict()
+        # 和個別請求無關的事件，例如連線停滯和續傳的次數
+        self.events = Counter()
+        self._last_endpoint = None
+
+    def _endpoint(self, name):
+        if name not in self.endpoints:
+            self.endpoints[name] = EndpointStats()
+        return self.endpoints[name]
+
+    def record(self, request_class, curl, error=None, head=False):
+        name = endpoint_name(request_class,
+            curl.getinfo(pycurl.EFFECTIVE_URL), head=head)
+        endpoint = self._endpoint(name)
+        self._last_endpoint = name
+        endpoint.requests += 1
+        if error != None:
+            endpoint.errors += 1
+            endpoint.statuses['curl {}'.format(error.args[0])] += 1
+        else:
+            endpoint.statuses[curl.getinfo(pycurl.RESPONSE_CODE)] += 1
+        endpoint.bytes += int(curl.getinfo(pycurl.SIZE_DOWNLOAD))
+        for timing, info in timing_names.items():
+            endpoint.timings[timing] += curl.getinfo(info)
+        total = curl.getinfo(pycurl.TOTAL_TIME)
+        for index, bucket in enumerate(latency_buckets):
+            if total <= bucket:
+                endpoint.histogram[index] += 1
+                break
+
+    # 回傳平均每秒下載的位元組數和平均等待第一個位元組的時間
+    def throughput(self, name):
+        endpoint = self.endpoints.get(name)
+        if endpoint == None or endpoint.requests == 0:
+            return None, None
+        latency = endpoint.timings['starttransfer'] / endpoint.requests
+        transfer_time = endpoint.timings['total'] - endpoint.timings['starttransfer']
+        if endpoint.bytes == 0 or transfer_time <= 0:
+            return None, latency
+        return endpoint.bytes / transfer_time, latency
+
+    # 重試的是最近一次記錄的請求
+    def retry(self):
+        self.events['retries'] += 1
+        if self._last_endpoint != None:
+            self._endpoint(self._last_endpoint).retries += 1
+
+    def to_dict(self):
+        return OrderedDict([
+            ('events', OrderedDict(sorted(self.events.items()))),
+            ('endpoints', OrderedDict(map(
+                lambda x: (x[0], x[1].to_dict()), sorted(self.endpoints.items())))),
+        ])
+
+    def summary(self):
+        header = ['類別', '請求', '錯誤', '重試', 'MiB', 'DNS', '連線', 'TLS',
+            '首位元組', '總時間']
+        rows = list()
+        for name, endpoint in sorted(self.endpoints.items(),
+            key=lambda x: x[1].timings['total'], reverse=True):
+            rows.append([name, str(endpoint.requests), str(endpoint.errors),
+                str(endpoint.retries), '{:.2f}'.format(endpoint.bytes / 2**20)] +
+                list(map(lambda x: '{:.2f}'.format(x), endpoint.timings.values())))
+        lines = list()
+        widths = list(map(lambda x: max(map(display_width, x)),
+            zip(header, *rows)))
+        for row in [header] + rows:
+            cells = list()
+            for index, cell in enumerate(row):
+                padding = ' ' * (widths[index] - display_width(cell))
+                cells.append(cell + padding if index == 0 else padding + cell)
+            lines.append('  '.join(cells))
+        for name, count in sorted(self.events.items()):
+            lines.append('{}: {}'.format(event_descriptions.get(name, name), count))
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        write_atomic(path, json.dumps(self.to_dict(),
+            ensure_ascii=False, indent=2) + '\n', permissions=0o644)
+
+    # Prometheus node_exporter 的 textfile collector 格式
+    def write_prometheus(self, path):
+        lines = list()
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP ceiba_dl_{} {}'.format(name, help_text))
+            lines.append('# TYPE ceiba_dl_{} {}'.format(name, kind))
+            for labels, value in samples:
+                label_text = ','.join(map(lambda x: '{}="{}"'.format(
+                    x[0], prometheus_escape(x[1])), labels))
+                lines.append('ceiba_dl_{}{{{}}} {}'.format(name, label_text, value))
+        items = sorted(self.endpoints.items())
+        metric('requests_total', 'counter', 'HTTP requests sent',
+            map(lambda x: ([('endpoint', x[0])], x[1].requests), items))
+        metric('request_errors_total', 'counter', 'HTTP requests failed by curl',
+            map(lambda x: ([('endpoint', x[0])], x[1].errors), items))
+        metric('request_retries_total', 'counter', 'HTTP requests retried',
+            map(lambda x: ([('endpoint', x[0])], x[1].retries), items))
+        metric('response_bytes_total', 'counter', 'Response body bytes received',
+            map(lambda x: ([('endpoint', x[0])], x[1].bytes), items))
+        metric('responses_total', 'counter', 'HTTP responses by status',
+            [ ([('endpoint', name), ('status', str(status))], count)
+                for name, endpoint in items
+                for status, count in sorted(endpoint.statuses.items(), key=str) ])
+        metric('request_phase_seconds_total', 'counter',
+            'Cumulative curl timing by phase',
+            [ ([('endpoint', name), ('phase', phase)], value)
+                for name, endpoint in items
+                for phase, value in endpoint.timings.items() ])
+        lines.append('# HELP ceiba_dl_request_duration_seconds '
+            'Total time of HTTP requests')
+        lines.append('# TYPE ceiba_dl_request_duration_seconds histogram')
+        for name, endpoint in items:
+            cumulative = 0
+            for bucket, count in zip(latency_buckets, endpoint.histogram):
+                cumulative += count
+                lines.append('ceiba_dl_request_duration_seconds_bucket'
+                    '{{endpoint="{}",le="{}"}} {}'.format(prometheus_escape(name),
+                    '+Inf' if bucket == float('inf') else bucket, cumulative))
+            lines.append('ceiba_dl_request_duration_seconds_sum'
+                '{{endpoint="{}"}} {}'.format(prometheus_escape(name),
+                endpoint.timings['total']))
+            lines.append('ceiba_dl_request_duration_seconds_count'
+                '{{endpoint="{}"}} {}'.format(prometheus_escape(name),
+                endpoint.requests))
+        metric('events_total', 'counter', 'Stalls, resumes and retries',
+            map(lambda x: ([('event', x[0])], x[1]), sorted(self.events.items())))
+        # textfile collector 可能隨時讀取檔案，所以要先寫到暫存檔再改名
+        write_atomic(path, '\n'.join(lines) + '\n', permissions=0o644)
+
+event_descriptions = {
+    'stalls': '連線停滯',
+    'resumes': '從中斷處繼續下載',
+    'retries': '重試請求',
+}
+
+def prometheus_escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
@@ -0,0 +1,140 @@
+# License: LGPL3+
+
+from .atomic import AtomicFile
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+# 以 SHA-256 為索引的檔案儲存區。同樣內容的檔案只會存一份，下載到的位置都是指向
+# 儲存區的硬連結。manifest.json 記錄每個網址上次下載時的大小、ETag 和內容雜湊，
+# 只要大小和 ETag 都相同就不需要再下載一次。
+
+class HashWriter:
+    def __init__(self, output):
+        self._output = output
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._output.write(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+class Store:
+    def __init__(self, root='.ceiba-dl-store'):
+        self._logger = logging.getLogger(__name__)
+        self._manifest = dict()
+        self._changed = False
+        self.root = root
+
+    @property
+    def objects_dir(self):
+        return os.path.join(self.root, 'objects')
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.root, 'manifest.json')
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def load(self):
+        if not os.path.exists(self.manifest_path):
+            return True
+
+        self._logger.info('準備讀取儲存區清單 {}'.format(self.manifest_path))
+
+        try:
+            with open(self.manifest_path, 'r') as manifest_file:
+                manifest = json.load(manifest_file)
+        except (IOError, ValueError) as err:
+            # 清單壞掉只會讓檔案被重新下載，內容相同的物件仍然不會重複儲存
+            self._logger.warning('無法載入儲存區清單：{}'.format(err))
+            return True
+
+        if isinstance(manifest, dict):
+            self._manifest = manifest
+        return True
+
+    def store(self):
+        if not self._changed:
+            return True
+
+        self._logger.info('準備寫入儲存區清單 {}'.format(self.manifest_path))
+
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            with AtomicFile(self.manifest_path) as manifest_file:
+                json.dump(self._manifest, manifest_file, ensure_ascii=False)
+        except IOError as err:
+            self._logger.error('無法寫入儲存區清單：{}'.format(err))
+            return False
+
+        self._changed = False
+        return True
+
+    def lookup(self, key, info):
+        entry = self._manifest.get(key, None)
+        if entry == None or info['etag'] == None:
+            return None
+        if entry['etag'] != info['etag'] or entry['size'] != info['size']:
+            return None
+        if not os.path.exists(self.object_path(entry['sha256'])):
+            return None
+        return entry['sha256']
+
+    def download(self, key, read):
+        # 一邊下載一邊計算雜湊值，下載完才知道要放在哪裡。下載失敗時暫存檔
+        # 會被刪掉
+        os.makedirs(self.objects_dir, exist_ok=True)
+        with AtomicFile(None, mode='wb',
+            directory=self.objects_dir) as temp_file:
+            writer = HashWriter(temp_file.file)
+            info = read(writer)
+
+            digest = writer.hexdigest()
+            object_path = self.object_path(digest)
+            if os.path.exists(object_path):
+                self._logger.info('內容已經存在於儲存區中：{}'.format(digest))
+                temp_file.discard()
+            else:
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                temp_file.commit(object_path)
+
+        etag = info['etag'] if info else None
+        self._manifest[key] = {
+            'size': writer.size, 'etag': etag, 'sha256': digest}
+        self._changed = True
+        return digest
+
+    def link(self, digest, disk_path):
+        object_path = self.object_path(digest)
+        disk_path = str(disk_path)
+        if os.path.exists(disk_path) and os.path.samefile(object_path, disk_path):
+            return
+
+        # 先建立在暫存的名稱再改名，避免取代既有檔案的途中留下不完整的檔案。
+        # 暫存的名稱不能比原本的長，檔案名稱太長時才會在改名時發現
+        temp_path = os.path.join(os.path.dirname(disk_path),
+            '.ceiba-dl-{}'.format(digest[:16]))
+        try:
+            os.link(object_path, temp_path)
+        except FileExistsError:
+            os.unlink(temp_path)
+            os.link(object_path, temp_path)
+        except OSError as err:
+            # 不同檔案系統或不支援硬連結時只好直接複製
+            if err.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+                raise
+            shutil.copyfile(object_path, temp_path)
+        try:
+            os.replace(temp_path, disk_path)
+        except OSError:
+            os.unlink(temp_path)
+            raise
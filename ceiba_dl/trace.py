@@ -0,0 +1,120 @@
+# License: LGPL3+
+
+from collections import Counter
+from contextlib import contextmanager
+from time import perf_counter
+import functools
+import json
+import os
+import threading
+
+# 記錄 VFS 節點的 fetch、HTTP 請求和 HTML 解析花費的時間。每一段時間是一個
+# span，巢狀的 span 組成呼叫樹，可以輸出成 Chrome 的 trace event 格式（用
+# chrome://tracing 或 Perfetto 開啟），或是 flamegraph.pl 使用的 collapsed
+# stack 格式。fetch 的時間扣掉其中的網路和解析時間，就是爬網頁程式本身的時間。
+#
+# 預設不啟用，這時每個 span 只多一次判斷的成本。
+
+class Span:
+    __slots__ = ['name', 'category', 'args', 'thread', 'start', 'end', 'stack']
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.spans = list()
+        self._local = threading.local()
+        self._origin = perf_counter()
+
+    def enable(self):
+        self.enabled = True
+        self._origin = perf_counter()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = list()
+        return self._local.stack
+
+    @contextmanager
+    def span(self, name, category, **args):
+        if not self.enabled:
+            yield
+            return
+        span = Span()
+        stack = self._stack()
+        span.name = name
+        span.category = category
+        span.args = args
+        span.thread = threading.get_ident()
+        span.stack = tuple(map(lambda x: x.name, stack)) + (name,)
+        stack.append(span)
+        span.start = perf_counter()
+        try:
+            yield
+        finally:
+            span.end = perf_counter()
+            stack.pop()
+            self.spans.append(span)
+
+    # 目前這個執行緒正在處理的節點路徑，從外到內排列
+    def context(self):
+        if not self.enabled:
+            return []
+        return [ span.args['path'] for span in self._stack()
+            if 'path' in span.args ]
+
+    def chrome_events(self):
+        threads = dict()
+        events = list()
+        for span in sorted(self.spans, key=lambda x: x.start):
+            tid = threads.setdefault(span.thread, len(threads) + 1)
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': (span.start - self._origin) * 1e6,
+                'dur': (span.end - span.start) * 1e6,
+                'pid': os.getpid(),
+                'tid': tid,
+                'args': span.args
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    # 每個 stack 的權重是扣掉子 span 以後剩下的時間，單位是微秒
+    def collapsed_stacks(self):
+        self_time = Counter()
+        for span in self.spans:
+            self_time[span.stack] += span.end - span.start
+            if len(span.stack) > 1:
+                self_time[span.stack[:-1]] -= span.end - span.start
+        lines = list()
+        for stack, duration in sorted(self_time.items()):
+            weight = int(round(duration * 1e6))
+            if weight > 0:
+                lines.append('{} {}'.format(
+                    ';'.join(map(lambda x: x.replace(';', ':'), stack)), weight))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, trace_format='chrome'):
+        with open(path, 'w') as trace_file:
+            if trace_format == 'chrome':
+                json.dump(self.chrome_events(), trace_file, ensure_ascii=False)
+            else:
+                trace_file.write(self.collapsed_stacks())
+
+tracer = Tracer()
+
+def span(name, category, **args):
+    return tracer.span(name, category, **args)
+
+# 用在 File 子類別的 fetch 之類的方法，span 會標上節點的路徑和類別
+def traced_method(category, describe):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not tracer.enabled:
+                return method(self, *args, **kwargs)
+            with tracer.span('{} {}'.format(category, type(self).__name__),
+                category, **describe(self, *args, **kwargs)):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
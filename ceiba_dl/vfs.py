@@ -1,28 +1,37 @@
 # License: LGPL3+
 
-from . import ServerError
+from . import Error, ServerError
+from .cache import Cache
+from .profiler import memory_phase
+from .progress import reported_fetch
+from .trace import span, traced_method
 from collections import OrderedDict
-from io import BytesIO, StringIO
+from io import BufferedReader, BytesIO, RawIOBase, StringIO
 from lxml import etree
 from pathlib import PurePosixPath
 from urllib.parse import urlencode, urlsplit, parse_qs, quote, unquote
 import ast
 import csv
+import hashlib
 import json
 import html
+import io
 import logging
+import pycurl
 
 # 提供給外部使用的 VFS 界面
 
 class VFS:
-    def __init__(self, request, strings, edit):
+    def __init__(self, request, strings, edit, cache=None):
         self.logger = logging.getLogger(__name__)
         self.request = request
         self.strings = strings
+        self.cache = cache if cache else Cache()
         self.root = RootDirectory(self)
         self._edit = edit
 
-    def open(self, path, cwd=None, edit_check=True, allow_students=True):
+    def open(self, path, cwd=None, edit_check=True, allow_students=True,
+        fetch=True):
         if edit_check and hasattr(self, '_edit'):
             self._do_edit()
         if cwd == None:
@@ -36,7 +45,7 @@ class VFS:
             if not allow_students and work is self.root.students:
                 return False
             work = work.access(item)
-        if not work.ready:
+        if fetch and not work.ready:
             work.fetch()
         return work
 
@@ -52,6 +61,33 @@ class VFS:
     def is_internal_link(self, node):
         return isinstance(node, InternalLink)
 
+    # 查詢多個遠端檔案的資訊，回傳每個檔案的 (資訊, 錯誤)。可以直接下載的檔案
+    # 一次送出所有 HEAD 請求，其中一個失敗或需要先經過其他頁面的檔案就改成一個
+    # 一個查詢，找出是哪個檔案有問題。查到的資訊會存進快取
+    def file_infos(self, nodes):
+        batch = list(filter(lambda x: getattr(x, 'download_request', None)
+            != None, nodes))
+        infos = dict()
+        if len(batch) > 0:
+            try:
+                for node, info in zip(batch, self.request.file_info_multi(
+                    list(map(lambda x: x.download_request, batch)))):
+                    infos[id(node)] = info
+            except (pycurl.error, Error) as err:
+                self.logger.warning('同時查詢檔案資訊失敗：{}'.format(err))
+        results = list()
+        for node in nodes:
+            info = infos.get(id(node))
+            if info == None:
+                try:
+                    info = node.info()
+                except (pycurl.error, Error) as err:
+                    results.append((None, err))
+                    continue
+            self.cache.set('file_info', node.remote_path, info)
+            results.append((info, None))
+        return results
+
     def _do_edit(self):
         s = self.strings
 
@@ -186,21 +222,147 @@ def js_window_open_get_url(js_script):
     assert len(python_ast.body[0].value.args) == 3
     return python_ast.body[0].value.args[0].s
 
-# 在真正開始爬網頁前先檢查功能是否開啟
-
-def ceiba_function_enabled(request, course_sn, function, path):
-    frame_path = '/modules/index.php'
-    frame_args = {'csn': course_sn, 'default_fun': function}
-    request.web(frame_path, args=frame_args, allow_return_none=True)
-    return len(request.web(path).xpath('//table')) > 0
+# 有些網頁沒有跳脫 < 字元，導致後面緊接的 a 標籤被當成其他標籤的一部分。這裡
+# 把原始碼依照 > 切成好幾段，若某段的最後一個 < 是 a 標籤的開頭，就把同一段中
+# 在它之前的 < 全部刪除。每個字元只會處理常數次，所以大頁面也不會變慢
+def html_repair_unescaped_lt(source):
+    segments = source.split('>')
+    for index, segment in enumerate(segments):
+        last_lt = segment.rfind('<')
+        if last_lt > 0 and segment.startswith('<a href=', last_lt):
+            segments[index] = segment[:last_lt].replace('<', '') + \
+                segment[last_lt:]
+    return '>'.join(segments)
+
+# 在真正開始爬網頁前先檢查功能是否開啟。同一門課只需要切換一次課程頁面，接著
+# 就可以一次送出所有功能頁面的請求。檢查結果會存進快取，而已開啟功能的網頁則會
+# 一併回傳，讓之後的 fetch 不用再下載一次
+
+ceiba_function_paths = {
+    'hw': '/modules/hw/hw.php',
+    'grade': '/modules/grade/grade.php',
+    'share': '/modules/share/share.php',
+    'vote': '/modules/vote/vote.php',
+    'student': '/modules/student/student.php',
+    'student_profile': '/modules/student/stu_person.php'
+}
+
+# 學生個人資料頁面要從學生名單的功能進入，其他功能都從課程資訊進入
+ceiba_function_frames = {
+    'student_profile': 'student'
+}
+
+def ceiba_functions_enabled(vfs, course_sn, functions):
+    known = dict(vfs.cache.get('functions', course_sn, {}))
+    missing = [ f for f in functions if f not in known ]
+    pages = dict()
+    groups = OrderedDict()
+    for function in missing:
+        groups.setdefault(ceiba_function_frames.get(function, 'info'),
+            list()).append(function)
+    for default_fun, group in groups.items():
+        frame_path = '/modules/index.php'
+        frame_args = {'csn': course_sn, 'default_fun': default_fun}
+        vfs.request.web(frame_path, args=frame_args, allow_return_none=True)
+        group_pages = vfs.request.web_multi(
+            [ (ceiba_function_paths[f], {}) for f in group ])
+        for function, page in zip(group, group_pages):
+            known[function] = len(page.xpath('//table')) > 0
+            if known[function]:
+                pages[function] = page
+    if len(missing) > 0:
+        vfs.cache.set('functions', course_sn, known)
+    enabled = dict(map(lambda f: (f, known[f]), functions))
+    return (enabled, pages)
+
+# 只留下 offset 開始的 length 個位元組，length 是 None 表示讀到結尾
+def chunks_range(chunks, offset=None, length=None):
+    if offset == None:
+        offset = 0
+    position = 0
+    for chunk in chunks:
+        start = max(offset - position, 0)
+        if length != None:
+            end = min(offset + length - position, len(chunk))
+        else:
+            end = len(chunk)
+        position += len(chunk)
+        if start < end:
+            yield chunk[start:end]
+        if length != None and position >= offset + length:
+            break
+
+# 讓普通檔案可以像一般的檔案一樣 seek 和 read，每次 read 只會取得需要的部份
+class RegularReader(RawIOBase):
+    def __init__(self, node):
+        super().__init__()
+        self._node = node
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self._node.size() + offset
+        else:
+            raise ValueError('無法辨識的 whence 數值 {}'.format(whence))
+        if position < 0:
+            raise ValueError('檔案位置不可以是負數')
+        self._position = position
+        return self._position
+
+    def readinto(self, buffer):
+        if len(buffer) == 0:
+            return 0
+        content = BytesIO()
+        self._node.read(content, offset=self._position, length=len(buffer))
+        data = content.getvalue()
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+# 從上層資料夾的內容找出節點的完整路徑，只在追蹤時使用
+def node_path(node):
+    parts = list()
+    while node.parent is not node and node.parent != None:
+        for name, child in getattr(node.parent, '_children', []):
+            if child is node:
+                parts.append(name)
+                break
+        else:
+            parts.append('<{}>'.format(type(node).__name__))
+        node = node.parent
+    return '/' + '/'.join(reversed(parts))
 
 # 基本的檔案型別：普通檔案、目錄、內部連結、外部連結
 
 class File:
+    # 每個子類別的 fetch 都會被追蹤，記錄下載和建立內容花費的時間，也會回報給
+    # 進度顯示
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'fetch' in cls.__dict__:
+            cls.fetch = traced_method('fetch',
+                lambda self: {'path': node_path(self)})(
+                reported_fetch(node_path)(cls.__dict__['fetch']))
+
     def __init__(self, vfs, parent):
         self.parent = parent
         self.vfs = vfs
         self.local = True
+        # 只要 signature 和上次下載時相同，就表示內容沒有改變，可以不用再下載
+        self.signature = None
         self._ready = False
 
     def fetch(self):
@@ -224,21 +386,44 @@ class Regular(File):
     def __init__(self, vfs, parent):
         super().__init__(vfs, parent)
 
-    def read(self, output, progress_callback=lambda *x: None):
+    def read(self, output, progress_callback=lambda *x: None,
+        offset=None, length=None):
         progress_callback(False, None, None, None)
         if not self.ready:
             self.fetch()
-        output.write(self._content.encode())
+        for chunk in chunks_range(self.chunks(), offset, length):
+            output.write(chunk)
         progress_callback(True, None, None, None)
 
+    def open(self, buffer_size=io.DEFAULT_BUFFER_SIZE):
+        return BufferedReader(RegularReader(self), buffer_size)
+
+    # 一次只編碼一小段，比較或寫入大檔案時就不需要在記憶體中多放一份完整內容
+    def chunks(self, chunk_size=65536):
+        if not self.ready:
+            self.fetch()
+        for index in range(0, len(self._content), chunk_size):
+            yield self._content[index:index + chunk_size].encode()
+
     def size(self):
-        return len(self._content.encode())
+        if not hasattr(self, '_size'):
+            self._size = sum(map(len, self.chunks()))
+        return self._size
 
 class Directory(File):
     def __init__(self, vfs, parent):
         super().__init__(vfs, parent)
         self._children = list()
 
+    # 下載時會跳過 signature 沒有變更的資料夾，但讀取資料夾時可能會順便修改其他
+    # 資料夾。effects 回傳這些修改，會和 signature 一起記在快取中，跳過時再交給
+    # replay 重新套用
+    def effects(self):
+        return None
+
+    def replay(self, effects):
+        pass
+
     def read(self, output, **kwargs):
         if not self.ready:
             self.fetch()
@@ -337,6 +522,7 @@ class RootCoursesDirectory(Directory):
                 self.add(name, new_directory)
         return super().access(name)
 
+    @memory_phase(lambda self: '列出學期')
     def fetch(self):
         s = self.vfs.strings
         result = self.vfs.request.api({'mode': 'semester'})
@@ -366,40 +552,55 @@ class RootCoursesDirectory(Directory):
         assert course_list_header_row[7].text in ['網頁助教', 'Web Assistant']
 
         self._course_list_map = dict()
-        for row in course_list_rows:
-            assert len(row[4]) == 2
-            assert row[4][0].tag == 'a'
-            assert row[4][0].get('href')
-            assert row[4][1].tag == 'br'
+        self._course_list_unresolved_rows = list(reversed(course_list_rows))
+
+    # 每門課都要送一次請求才能從重導向的網址得知課程代號，所以只解析到找到
+    # 需要的課程為止，解析過的結果也會存進快取
+    def _resolve_course_list_row(self, row):
+        assert len(row[4]) == 2
+        assert row[4][0].tag == 'a'
+        assert row[4][0].get('href')
+        assert row[4][1].tag == 'br'
+
+        course_path = url_to_path_and_args(row[4][0].get('href'))[0]
+        sn = self.vfs.cache.get('course_list', course_path)
+        if sn != None:
+            self._course_list_map[sn] = row
+            return
 
-            course_path = url_to_path_and_args(row[4][0].get('href'))[0]
-            try:
-                location = self.vfs.request.web_redirect(course_path)
-            except ServerError as err:
-                assert err.status == 200
-                location = course_path
-            assert location
-
-            redirected_path, redirected_args = url_to_path_and_args(location)
-            if redirected_path == '/login_test.php':
-                assert set(redirected_args.keys()) == set(['csn'])
-                self._course_list_map[redirected_args['csn']] = row
-            elif redirected_path.startswith('/course/') and \
-                redirected_path.endswith('/index.htm'):
-                assert redirected_args == {}
-                self._course_list_map[redirected_path.split('/')[2]] = row
-            else:
-                assert False
+        try:
+            location = self.vfs.request.web_redirect(course_path)
+        except ServerError as err:
+            assert err.status == 200
+            location = course_path
+        assert location
+
+        redirected_path, redirected_args = url_to_path_and_args(location)
+        if redirected_path == '/login_test.php':
+            assert set(redirected_args.keys()) == set(['csn'])
+            sn = redirected_args['csn']
+        elif redirected_path.startswith('/course/') and \
+            redirected_path.endswith('/index.htm'):
+            assert redirected_args == {}
+            sn = redirected_path.split('/')[2]
+        else:
+            assert False
+
+        self._course_list_map[sn] = row
+        self.vfs.cache.set('course_list', course_path, sn)
 
     def search_course_list(self, sn):
         if not hasattr(self, '_course_list_map'):
             self._create_course_list_map()
+        while sn not in self._course_list_map and \
+            len(self._course_list_unresolved_rows) > 0:
+            self._resolve_course_list_row(
+                self._course_list_unresolved_rows.pop())
         return self._course_list_map[sn]
 
 class RootStudentsDirectory(Directory):
     def __init__(self, vfs, parent):
         super().__init__(vfs, parent)
-        self._course_status_cache = dict()
         self.ready = True
 
     def access(self, name):
@@ -408,12 +609,104 @@ class RootStudentsDirectory(Directory):
             self.add_student(name)
         return super().access(name)
 
+    # 這裡檢查的是學生個人資料頁面，和課程資料夾檢查的學生名單頁面不同
     def _is_student_function_enabled(self, sn):
-        if sn not in self._course_status_cache:
-            self._course_status_cache[sn] = \
-                ceiba_function_enabled(self.vfs.request, sn,
-                    'student', '/modules/student/stu_person.php')
-        return self._course_status_cache[sn]
+        functions, function_pages = ceiba_functions_enabled(
+            self.vfs, sn, ['student_profile'])
+        return functions['student_profile']
+
+    def list(self):
+        # 一次更新所有過期的個人資料，並讓下載時可以跳過沒有變更的學生
+        if hasattr(self, '_last_sn'):
+            accounts = list()
+            for name, node in self._children:
+                if isinstance(node, StudentsStudentDirectory) and \
+                    not node.ready:
+                    accounts.append(name)
+            try:
+                self.fetch_profiles(accounts)
+            except (ServerError, pycurl.error) as err:
+                self.vfs.logger.warning('無法一次下載學生的個人資料：{}' \
+                    .format(err))
+            for name, node in self._children:
+                if isinstance(node, StudentsStudentDirectory) and \
+                    not node.ready:
+                    cached = self.vfs.cache.get('students', name)
+                    # 沒有拿到個人資料的學生等到讀取資料夾時再下載
+                    if cached == None:
+                        continue
+                    node.signature = {'hash': cached['hash'],
+                        'photo_etag': cached['photo_etag']}
+        return super().list()
+
+    # 個人資料會依照帳號存進快取，過期前都不需要再下載。需要下載時只要切換
+    # 一次課程頁面，所有學生的個人資料頁面就可以一起送出。每次只送出網頁請求
+    # 目前允許的連線數，下載完一批就先存進快取，其中一批失敗時仍然繼續下載
+    # 其他批，最後再回報最後一個錯誤
+    def fetch_profiles(self, accounts):
+        accounts = list(filter(
+            lambda x: self.vfs.cache.get('students', x) == None, accounts))
+        if len(accounts) == 0:
+            return
+
+        frame_path = '/modules/index.php'
+        frame_args = {'csn': self.last_sn, 'default_fun': 'info'}
+
+        self.vfs.request.web(frame_path, args=frame_args, allow_return_none=True)
+
+        error = None
+        while len(accounts) > 0:
+            count = self.vfs.request.governor.connections('page')
+            batch = accounts[:count]
+            accounts = accounts[count:]
+            try:
+                self._fetch_profiles(batch)
+            except (ServerError, pycurl.error) as err:
+                self.vfs.logger.warning('無法下載 {} 等 {} 位學生的個人資料：{}' \
+                    .format(batch[0], len(batch), err))
+                error = err
+        if error != None:
+            raise error
+
+    def _fetch_profiles(self, accounts):
+        student_path = '/modules/student/stu_person.php'
+
+        student_pages = self.vfs.request.web_multi(list(map(
+            lambda x: (student_path, {'stu': x}), accounts)))
+
+        # 無法辨識的頁面只影響那一位學生，讀取資料夾時會再下載一次
+        profiles = OrderedDict()
+        for account, student_page in zip(accounts, student_pages):
+            try:
+                profiles[account] = student_page_get_profile(
+                    self.vfs, account, student_page)
+            except AssertionError:
+                self.vfs.logger.warning('無法辨識 {} 的個人資料頁面' \
+                    .format(account))
+
+        # 照片另外用 ETag 判斷是否有更新，拿不到也沒關係，下載時會再檢查
+        photo_paths = list(filter(None,
+            map(lambda x: x['photo_path'], profiles.values())))
+        try:
+            photo_infos = dict(zip(photo_paths, self.vfs.request.file_info_multi(
+                list(map(lambda x: (x, {}), photo_paths)))))
+        except (ServerError, pycurl.error) as err:
+            self.vfs.logger.warning('無法查詢學生照片的資訊：{}'.format(err))
+            photo_infos = dict()
+
+        for account, profile in profiles.items():
+            profile_json = json.dumps(profile, sort_keys=True, ensure_ascii=False)
+            photo_etag = photo_infos.get(profile['photo_path'], {}).get('etag')
+            self.vfs.cache.set('students', account, {
+                'profile': profile,
+                'hash': hashlib.sha256(profile_json.encode()).hexdigest(),
+                'photo_etag': photo_etag})
+
+    def get_profile(self, account):
+        self.fetch_profiles([account])
+        cached = self.vfs.cache.get('students', account)
+        assert cached != None, '無法辨識 {} 的個人資料頁面'.format(account)
+        return cached
 
     def add_student(self, account, sn=None, pwd=None):
         s = self.vfs.strings
@@ -621,6 +914,146 @@ class TeachersTeacherDirectory(Directory):
         teacher_file.finish()
         self.ready = True
 
+# 學生個人資料頁面的所有欄位，名稱和 strings 中的 attr_students_* 對應
+student_profile_keys = ['role', 'photo', 'name', 'english_name',
+    'screen_name', 'school_year', 'homepage_url', 'email_address',
+    'frequently_used_email', 'phone', 'address', 'more_personal_information']
+
+def student_page_get_profile(vfs, account, student_page):
+    assert len(student_page.xpath('//table')) > 0
+
+    student_rows = student_page.xpath('//div[@id="sect_cont"]/table/tr')
+    assert len(student_rows) == 12
+
+    profile = dict()
+
+    # 身份
+    student_role = row_get_value(student_rows[0],
+        ['身份', 'Role'], {}, free_form=True).strip()
+    profile['role'] = student_role
+
+    # 照片
+    student_photo_element = row_get_value(student_rows[1],
+        ['照片', 'Photo'], {}, free_form=True, return_object=True)
+    if len(student_photo_element) > 0:
+        assert len(student_photo_element) == 1
+        assert student_photo_element[0].tag == 'img'
+        assert student_photo_element[0].get('src')
+        student_photo = student_photo_element[0].get('src') \
+            .rsplit('/', maxsplit=1)[1]
+        student_photo_path = url_to_path_and_args(
+            student_photo_element[0].get('src'), no_query_string=True)[0]
+    else:
+        student_photo = ''
+        student_photo_path = ''
+    profile['photo_path'] = student_photo_path
+    profile['photo'] = student_photo
+
+    # 姓名
+    student_name = row_get_value(student_rows[2],
+        ['姓名', 'Name'], {}, free_form=True).strip()
+    profile['name'] = student_name
+
+    # 英文姓名
+    student_english_name = row_get_value(student_rows[3],
+        ['英文姓名', 'English Name'], {}, free_form=True).strip()
+    profile['english_name'] = student_english_name
+
+    # 匿名代號
+    student_screen_name = row_get_value(student_rows[4],
+        ['匿名代號', 'Screen Name'], {}, free_form=True).strip()
+    profile['screen_name'] = student_screen_name
+
+    # 學校系級
+    student_school_year = row_get_value(student_rows[5],
+        ['系級', 'Major & Year', '學校系級', 'School & Dept'],
+        {}, free_form=True).strip()
+    profile['school_year'] = student_school_year
+
+    # 個人首頁網址
+    student_homepage_url_element = row_get_value(student_rows[6],
+        ['個人首頁網址', 'Homepage URL'], {}, free_form=True, return_object=True)
+    assert len(student_homepage_url_element) == 1
+    assert student_homepage_url_element[0].tag == 'a'
+    assert student_homepage_url_element[0].get('href')
+    student_homepage_url = element_get_text(student_homepage_url_element[0])
+    assert student_homepage_url_element[0].get('href') == \
+        student_homepage_url or \
+        student_homepage_url_element[0].get('href') == \
+        'http://' + student_homepage_url
+    profile['homepage_url'] = student_homepage_url
+
+    # 電子郵件
+    student_email_address_element = row_get_value(student_rows[7],
+        ['電子郵件', 'Email Address'], {}, free_form=True, return_object=True)
+    assert len(student_email_address_element) == 1
+    assert student_email_address_element[0].tag == 'a'
+    assert student_email_address_element[0].get('href')
+    student_email_address = element_get_text(student_email_address_element[0])
+    if len(student_email_address_element[0]) == 0:
+        if student_email_address.find('"') < 0:
+            assert student_email_address_element[0].get('href') == \
+                'mailto:' + student_email_address
+    else:
+        vfs.logger.warning('學號 {} 的個人頁面電子郵件欄位有多餘的標籤' \
+            .format(account))
+        vfs.logger.warning('這很有可能是 CEIBA 沒有跳脫特殊字元所造成')
+        student_email_address_href = student_email_address_element[0].get('href')
+        assert student_email_address_href.startswith('mailto:')
+        if student_email_address_href.find('<') >= 7 and \
+            student_email_address_href.find('>') >= 7:
+            student_email_address = student_email_address_href[7:]
+        else:
+            assert student_email_address.find('"') >= 0
+    profile['email_address'] = student_email_address
+
+    # 常用電子郵件
+    student_frequently_used_email_element = row_get_value(student_rows[8],
+        ['常用電子郵件', 'Frequently Used Email'],
+        {}, free_form=True, return_object=True)
+    assert len(student_frequently_used_email_element) == 1
+    assert student_frequently_used_email_element[0].tag == 'a'
+    assert student_frequently_used_email_element[0].get('href')
+    student_frequently_used_email = element_get_text(
+        student_frequently_used_email_element[0])
+    student_frequently_used_email_from_href = \
+        student_frequently_used_email_element[0].get('href')
+
+    # CEIBA 不會跳脫 < 和 > 符號，如果使用者填寫的電子郵件地址包含這個符號
+    # 會使透過 .text 拿到的資料不正確
+    if student_frequently_used_email_from_href.find('<') >= 0 and \
+        student_frequently_used_email_from_href.find('>') >= 0:
+        assert student_frequently_used_email_from_href.startswith('mailto:')
+        student_frequently_used_email = \
+            student_frequently_used_email_from_href[7:]
+    else:
+        assert student_frequently_used_email_from_href == \
+            'mailto:' + student_frequently_used_email
+
+    profile['frequently_used_email'] = student_frequently_used_email
+
+    # 聯絡電話
+    student_phone = row_get_value(student_rows[9],
+        ['聯絡電話', 'Phone'], {}, free_form=True).strip()
+    profile['phone'] = student_phone
+
+    # 聯絡地址
+    student_address = row_get_value(student_rows[10],
+        ['聯絡地址', 'Address'], {}, free_form=True).strip()
+    profile['address'] = student_address
+
+    # 更多的個人資訊
+    student_more_personal_information_element = row_get_value(student_rows[11],
+        ['更多的個人資訊', 'More Personal Information'],
+        {}, free_form=True, return_object=True)
+
+    # 使用者可以自己在這個欄位塞各種標籤……
+    student_more_personal_information = ''.join(
+        student_more_personal_information_element.itertext())
+    profile['more_personal_information'] = student_more_personal_information
+
+    return profile
+
 class StudentsStudentDirectory(Directory):
     def __init__(self, vfs, parent, account):
         super().__init__(vfs, parent)
@@ -628,157 +1061,27 @@ class StudentsStudentDirectory(Directory):
 
     def fetch(self):
         s = self.vfs.strings
-        sn = self.vfs.root.students.last_sn
-
-        frame_path = '/modules/index.php'
-        frame_args = {'csn': sn, 'default_fun': 'info'}
-
         student_path = '/modules/student/stu_person.php'
-        student_args = {'stu': self._account}
-
-        self.vfs.request.web(frame_path, args=frame_args, allow_return_none=True)
-        student_page = self.vfs.request.web(student_path, args=student_args)
-        assert len(student_page.xpath('//table')) > 0
 
-        student_rows = student_page.xpath('//div[@id="sect_cont"]/table/tr')
-        assert len(student_rows) == 12
+        # 個人資料可能已經和其他學生一起下載好，或是還在快取中
+        cached = self.vfs.root.students.get_profile(self._account)
+        profile = cached['profile']
+        self.signature = {'hash': cached['hash'],
+            'photo_etag': cached['photo_etag']}
 
         student_file = JSONFile(self.vfs, self)
-        student_filename = '{}.json'.format(self._account, sn)
+        student_filename = '{}.json'.format(self._account)
         self.add(student_filename, student_file)
 
-        # 身份
-        student_role = row_get_value(student_rows[0],
-            ['身份', 'Role'], {}, free_form=True).strip()
-        student_file.add(s['attr_students_role'], student_role, student_path)
+        if profile['photo_path']:
+            photo_file = DownloadFile(self.vfs, self, profile['photo_path'])
+            if cached['photo_etag']:
+                photo_file.signature = {'etag': cached['photo_etag']}
+            self.add(profile['photo'], photo_file)
 
-        # 照片
-        student_photo_element = row_get_value(student_rows[1],
-            ['照片', 'Photo'], {}, free_form=True, return_object=True)
-        if len(student_photo_element) > 0:
-            assert len(student_photo_element) == 1
-            assert student_photo_element[0].tag == 'img'
-            assert student_photo_element[0].get('src')
-            student_photo = student_photo_element[0].get('src') \
-                .rsplit('/', maxsplit=1)[1]
-            student_photo_path = url_to_path_and_args(
-                student_photo_element[0].get('src'), no_query_string=True)[0]
-            self.add(student_photo, DownloadFile(self.vfs, self,
-                student_photo_path))
-        else:
-            student_photo = ''
-        student_file.add(s['attr_students_photo'], student_photo, student_path)
-
-        # 姓名
-        student_name = row_get_value(student_rows[2],
-            ['姓名', 'Name'], {}, free_form=True).strip()
-        student_file.add(s['attr_students_name'], student_name, student_path)
-
-        # 英文姓名
-        student_english_name = row_get_value(student_rows[3],
-            ['英文姓名', 'English Name'], {}, free_form=True).strip()
-        student_file.add(s['attr_students_english_name'],
-            student_english_name, student_path)
-
-        # 匿名代號
-        student_screen_name = row_get_value(student_rows[4],
-            ['匿名代號', 'Screen Name'], {}, free_form=True).strip()
-        student_file.add(s['attr_students_screen_name'],
-            student_screen_name, student_path)
-
-        # 學校系級
-        student_school_year = row_get_value(student_rows[5],
-            ['系級', 'Major & Year', '學校系級', 'School & Dept'],
-            {}, free_form=True).strip()
-        student_file.add(s['attr_students_school_year'],
-            student_school_year, student_path)
-
-        # 個人首頁網址
-        student_homepage_url_element = row_get_value(student_rows[6],
-            ['個人首頁網址', 'Homepage URL'], {}, free_form=True, return_object=True)
-        assert len(student_homepage_url_element) == 1
-        assert student_homepage_url_element[0].tag == 'a'
-        assert student_homepage_url_element[0].get('href')
-        student_homepage_url = element_get_text(student_homepage_url_element[0])
-        assert student_homepage_url_element[0].get('href') == \
-            student_homepage_url or \
-            student_homepage_url_element[0].get('href') == \
-            'http://' + student_homepage_url
-        student_file.add(s['attr_students_homepage_url'],
-            student_homepage_url, student_path)
-
-        # 電子郵件
-        student_email_address_element = row_get_value(student_rows[7],
-            ['電子郵件', 'Email Address'], {}, free_form=True, return_object=True)
-        assert len(student_email_address_element) == 1
-        assert student_email_address_element[0].tag == 'a'
-        assert student_email_address_element[0].get('href')
-        student_email_address = element_get_text(student_email_address_element[0])
-        if len(student_email_address_element[0]) == 0:
-            if student_email_address.find('"') < 0:
-                assert student_email_address_element[0].get('href') == \
-                    'mailto:' + student_email_address
-        else:
-            self.vfs.logger.warning('學號 {} 的個人頁面電子郵件欄位有多餘的標籤' \
-                .format(self._account))
-            self.vfs.logger.warning('這很有可能是 CEIBA 沒有跳脫特殊字元所造成')
-            student_email_address_href = student_email_address_element[0].get('href')
-            assert student_email_address_href.startswith('mailto:')
-            if student_email_address_href.find('<') >= 7 and \
-                student_email_address_href.find('>') >= 7:
-                student_email_address = student_email_address_href[7:]
-            else:
-                assert student_email_address.find('"') >= 0
-        student_file.add(s['attr_students_email_address'],
-            student_email_address, student_path)
-
-        # 常用電子郵件
-        student_frequently_used_email_element = row_get_value(student_rows[8],
-            ['常用電子郵件', 'Frequently Used Email'],
-            {}, free_form=True, return_object=True)
-        assert len(student_frequently_used_email_element) == 1
-        assert student_frequently_used_email_element[0].tag == 'a'
-        assert student_frequently_used_email_element[0].get('href')
-        student_frequently_used_email = element_get_text(
-            student_frequently_used_email_element[0])
-        student_frequently_used_email_from_href = \
-            student_frequently_used_email_element[0].get('href')
-
-        # CEIBA 不會跳脫 < 和 > 符號，如果使用者填寫的電子郵件地址包含這個符號
-        # 會使透過 .text 拿到的資料不正確
-        if student_frequently_used_email_from_href.find('<') >= 0 and \
-            student_frequently_used_email_from_href.find('>') >= 0:
-            assert student_frequently_used_email_from_href.startswith('mailto:')
-            student_frequently_used_email = \
-                student_frequently_used_email_from_href[7:]
-        else:
-            assert student_frequently_used_email_from_href == \
-                'mailto:' + student_frequently_used_email
-
-        student_file.add(s['attr_students_frequently_used_email'],
-            student_frequently_used_email, student_path)
-
-        # 聯絡電話
-        student_phone = row_get_value(student_rows[9],
-            ['聯絡電話', 'Phone'], {}, free_form=True).strip()
-        student_file.add(s['attr_students_phone'], student_phone, student_path)
-
-        # 聯絡地址
-        student_address = row_get_value(student_rows[10],
-            ['聯絡地址', 'Address'], {}, free_form=True).strip()
-        student_file.add(s['attr_students_address'],
-            student_address, student_path)
-
-        # 更多的個人資訊
-        student_more_personal_information_element = row_get_value(student_rows[11],
-            ['更多的個人資訊', 'More Personal Information'],
-            {}, free_form=True, return_object=True)
-
-        # 使用者可以自己在這個欄位塞各種標籤……
-        student_more_personal_information = ''.join(
-            student_more_personal_information_element.itertext())
-        student_file.add(s['attr_students_more_personal_information'],
-            student_more_personal_information, student_path)
+        for key in student_profile_keys:
+            student_file.add(s['attr_students_' + key], profile[key],
+                student_path)
 
         student_file.finish()
         self.ready = True
@@ -788,6 +1091,7 @@ class SemesterDirectory(Directory):
         super().__init__(vfs, parent)
         self._semester = semester
 
+    @memory_phase(lambda self: '學期 {}'.format(node_path(self)))
     def fetch(self):
         result = self.vfs.request.api(
             {'mode': 'semester', 'semester': self._semester})
@@ -858,7 +1162,79 @@ class CourseDirectory(Directory):
         self._sn = sn
         self._time = time
         self._class_no = class_no
+        self._lazy_loaders = list()
+
+    # 需要爬網頁或額外請求才能知道是否存在的項目，等到真的被列出或存取時才建立
+    def _lazy_names(self):
+        s = self.vfs.strings
+        return [
+            (s['dir_course_share'], self._fetch_functions),
+            (s['dir_course_vote'], self._fetch_functions),
+            (s['dir_course_students'], self._fetch_functions),
+            (s['dir_course_teaching_assistants'], self._fetch_assistants),
+            (s['dir_course_web_assistants'], self._fetch_assistants)]
+
+    def _children_order(self):
+        s = self.vfs.strings
+        return [
+            s['file_course_metadata'],
+            s['dir_course_bulletin'],
+            s['dir_course_contents'],
+            s['dir_course_boards'],
+            s['dir_course_homeworks'],
+            s['dir_course_grades'],
+            s['dir_course_share'],
+            s['dir_course_vote'],
+            s['dir_course_teachers'],
+            s['dir_course_students'],
+            s['dir_course_teaching_assistants'],
+            s['dir_course_web_assistants']]
+
+    def _run_lazy_loader(self, loader):
+        if loader not in self._lazy_loaders:
+            return
+        self._call_lazy_loader(loader)
+        self._lazy_loaders.remove(loader)
+        # 維持和一次全部建立時相同的順序
+        order = self._children_order()
+        self._children.sort(key=lambda x:
+            order.index(x[0]) if x[0] in order else len(order))
+
+    @memory_phase(lambda self, loader: '課程 {} {}'.format(
+        node_path(self), loader.__name__))
+    @traced_method('load', lambda self, loader:
+        {'path': node_path(self), 'loader': loader.__name__})
+    def _call_lazy_loader(self, loader):
+        loader()
+
+    def _run_all_lazy_loaders(self):
+        for name, loader in self._lazy_names():
+            self._run_lazy_loader(loader)
+
+    def list(self):
+        if not self.ready:
+            self.fetch()
+        self._run_all_lazy_loaders()
+        return self._children
+
+    def access(self, name):
+        if name not in ['.', '..']:
+            if not self.ready:
+                self.fetch()
+            if name not in map(lambda x: x[0], self._children):
+                for lazy_name, loader in self._lazy_names():
+                    if lazy_name == name:
+                        self._run_lazy_loader(loader)
+                        break
+                else:
+                    self._run_all_lazy_loaders()
+        return super().access(name)
+
+    def read(self, output, **kwargs):
+        self.list()
+        super().read(output, **kwargs)
 
+    @memory_phase(lambda self: '課程 {}'.format(node_path(self)))
     def fetch(self):
         # 填入課程基本資料
         s = self.vfs.strings
@@ -955,28 +1331,41 @@ class CourseDirectory(Directory):
             self.add(s['dir_course_grades'], CourseGradesDirectory(
                 self.vfs, self, self._sn, result['course_grade']))
 
+        # teacher_info
+        self.add(s['dir_course_teachers'], CourseTeacherInfoDirectory(
+            self.vfs, self, self._sn, result['teacher_info']))
+
+        # 資源分享、投票區、修課學生、課程助教、網頁助教
+        self._lazy_loaders.append(self._fetch_functions)
+        self._lazy_loaders.append(self._fetch_assistants)
+
+        self.ready = True
+
+    def _fetch_functions(self):
+        s = self.vfs.strings
+
+        # 一次檢查所有需要爬網頁的功能
+        functions, function_pages = ceiba_functions_enabled(
+            self.vfs, self._sn, ['share', 'vote', 'student'])
+
         # 資源分享
-        if ceiba_function_enabled(self.vfs.request, self._sn,
-            'share', '/modules/share/share.php'):
+        if functions['share']:
             self.add(s['dir_course_share'], CourseShareDirectory(
                 self.vfs, self, self._sn))
 
         # 投票區
-        if ceiba_function_enabled(self.vfs.request, self._sn,
-            'vote', '/modules/vote/vote.php'):
+        if functions['vote']:
             self.add(s['dir_course_vote'], CourseVoteDirectory(
-                self.vfs, self, self._sn))
-
-        # teacher_info
-        self.add(s['dir_course_teachers'], CourseTeacherInfoDirectory(
-            self.vfs, self, self._sn, result['teacher_info']))
+                self.vfs, self, self._sn, function_pages.get('vote')))
 
         # 修課學生
-        if ceiba_function_enabled(self.vfs.request, self._sn,
-            'student', '/modules/student/student.php'):
+        if functions['student']:
             self.add(s['dir_course_students'], CourseRosterDirectory(
                 self.vfs, self, self._sn, self._name))
 
+    def _fetch_assistants(self):
+        s = self.vfs.strings
+
         # 課程助教
         course_list_row = self.vfs.root.courses.search_course_list(self._sn)
         if len(course_list_row[6]) > 0:
@@ -988,8 +1377,6 @@ class CourseDirectory(Directory):
             self.add(s['dir_course_web_assistants'],
                 CourseAssistantsDirectory(self.vfs, self, course_list_row[7]))
 
-        self.ready = True
-
 class WebCourseDirectory(Directory):
     def __init__(self, vfs, parent, semester, sn):
         super().__init__(vfs, parent)
@@ -1050,37 +1437,36 @@ class WebCourseDirectory(Directory):
         metadata.finish()
         self.add(s['file_course_metadata'], metadata)
 
+        # 一次檢查所有需要爬網頁的功能
+        functions, function_pages = ceiba_functions_enabled(
+            self.vfs, self._sn, ['hw', 'grade', 'share', 'vote', 'student'])
+
         # homeworks
-        if ceiba_function_enabled(self.vfs.request, self._sn,
-            'hw', '/modules/hw/hw.php'):
+        if functions['hw']:
             self.add(s['dir_course_homeworks'], CourseHomeworksDirectory(
                 self.vfs, self, self._sn, [], api=False))
 
         # course_grade
-        if ceiba_function_enabled(self.vfs.request, self._sn,
-            'grade', '/modules/grade/grade.php'):
+        if functions['grade']:
             self.add(s['dir_course_grades'], CourseGradesDirectory(
                 self.vfs, self, self._sn, []))
 
         # 資源分享
-        if ceiba_function_enabled(self.vfs.request, self._sn,
-            'share', '/modules/share/share.php'):
+        if functions['share']:
             self.add(s['dir_course_share'], CourseShareDirectory(
                 self.vfs, self, self._sn))
 
         # 投票區
-        if ceiba_function_enabled(self.vfs.request, self._sn,
-            'vote', '/modules/vote/vote.php'):
+        if functions['vote']:
             self.add(s['dir_course_vote'], CourseVoteDirectory(
-                self.vfs, self, self._sn))
+                self.vfs, self, self._sn, function_pages.get('vote')))
 
         # 教師資訊
         self.add(s['dir_course_teachers'], CourseTeacherInfoDirectory(
             self.vfs, self, self._sn, []))
 
         # 修課學生
-        if ceiba_function_enabled(self.vfs.request, self._sn,
-            'student', '/modules/student/student.php'):
+        if functions['student']:
             self.add(s['dir_course_students'], CourseRosterDirectory(
                 self.vfs, self, self._sn, self._name))
 
@@ -1296,93 +1682,158 @@ class CourseBoardsThreadDirectory(Directory):
                     threads[post['parent']] = [ post ]
 
         for sn, thread in threads.items():
-            thread_dir = Directory(self.vfs, self)
-            thread_attachments = list()
-            collected_accounts = OrderedDict()
-            for post in thread:
-                post_node = JSONFile(self.vfs, thread_dir)
-                post_node.add(s['attr_course_boards_thread_sn'], post['sn'], 'sn')
-                if post['parent'] != '0':
-                    post_node.add(s['attr_course_boards_thread_parent'],
-                        post['parent'], 'parent')
-                post_node.add(s['attr_course_boards_thread_subject'],
-                    post['subject'], 'subject')
-                post_node.add(s['attr_course_boards_thread_post_time'],
-                    post['post_time'], 'post_time')
-                if post['attach'] != '' or post['file_path'] != '':
-                    assert post['attach'] != ''
-                    extension = post['attach'].rsplit('.', maxsplit=1)[1]
-                    post_node.add(s['attr_course_boards_thread_attach'],
-                        post['attach'], 'attach')
-                    if post['file_path'] != '':
-                        assert post['file_path'] == post['sn'] + '.' + extension
-                        thread_attachments.append(
-                            (post['sn'], post['attach'], post['file_path']))
-                post_node.add(s['attr_course_boards_thread_author'],
-                    post['author'], 'author')
-                collected_accounts[post['author']] = None
-                post_node.add(s['attr_course_boards_thread_cauthor'],
-                    post['cauthor'], 'cauthor')
-                post_node.add(s['attr_course_boards_thread_count_rep'],
-                    post['count_rep'], 'count_rep')
-                post_node.add(s['attr_course_boards_thread_latest_rep'],
-                    post['latest_rep'], 'latest_rep')
-                post_node.finish()
-                content = '\n'.join([
-                    '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN"',
-                    '  "http://www.w3.org/TR/html4/loose.dtd">',
-                    '<html>',
-                    '  <head>',
-                    '    <meta http-equiv="Content-Type" content="text/html; charset=UTF-8">',
-                    '    <title>{}</title>'.format(html.escape(post['subject'])),
-                    '  </head>',
-                    '  <body>',
-                    '    <p>',
-                    '      {}'.format(post['content']),
-                    '    </p>',
-                    '  </body>',
-                    '</html>' ]) + '\n'
-                post_content = StringFile(self.vfs, thread_dir, content)
-                post_node_filename = format_filename(
-                    post['sn'], post['subject'], 'json')
-                post_content_filename = format_filename(
-                    post['sn'], post['subject'], 'html')
-                thread_dir.add(post_node_filename, post_node)
-                thread_dir.add(post_content_filename, post_content)
-            for account in collected_accounts.keys():
-                if quote(account) != account:
-                    continue
-                if self.vfs.root.teachers.is_teacher(account):
-                    thread_dir.add(account, InternalLink(self.vfs, thread_dir,
-                        self.vfs.root.teachers.add_teacher(
-                            account, pwd=thread_dir)))
-                else:
-                    thread_dir.add(account, InternalLink(self.vfs, thread_dir,
-                        self.vfs.root.students.add_student(
-                            account, sn=self._course_sn, pwd=thread_dir)))
-            if len(thread_attachments):
-                files_dir = Directory(self.vfs, thread_dir)
-                for attachment in thread_attachments:
-                    attachment_filename = format_dirname(
-                        attachment[0], attachment[1])
-                    attachment_path = '/course/{}/board/{}'.format(
-                        self._course_sn, attachment[2])
-                    files_dir.add(attachment_filename, DownloadFile(
-                        self.vfs, files_dir, attachment_path))
-                files_dir.ready = True
-                thread_dir.add(s['dir_course_boards_thread_files'], files_dir)
-            thread_dir.ready = True
+            # 討論串的內容要等到真正需要時才產生。文章數量、最新回覆時間和所有
+            # 文章的序號都沒變的話，下載時就可以直接跳過整個討論串
+            thread_dir = CourseBoardsThreadPostsDirectory(
+                self.vfs, self, self._course_sn, thread)
+            thread_post = next(filter(lambda x: x['sn'] == sn, thread))
+            thread_dir.signature = {
+                'count_rep': thread_post['count_rep'],
+                'latest_rep': thread_post['latest_rep'],
+                'posts': list(map(lambda x: x['sn'], thread))}
             thread_dirname = format_dirname(sn, thread_subjects[sn])
             self.add(thread_dirname, thread_dir)
 
         self.ready = True
 
+class CourseBoardsThreadPostsDirectory(Directory):
+    def __init__(self, vfs, parent, course_sn, posts):
+        super().__init__(vfs, parent)
+        self._course_sn = course_sn
+        self._posts = posts
+        self._authors = list()
+
+    # 文章的作者會加進教師和學生資料夾
+    def effects(self):
+        return self._authors
+
+    def replay(self, effects):
+        for kind, account in effects:
+            if kind == 'teacher':
+                self.vfs.root.teachers.add_teacher(account)
+            else:
+                self.vfs.root.students.add_student(account, sn=self._course_sn)
+
+    def fetch(self):
+        s = self.vfs.strings
+
+        thread_attachments = list()
+        collected_accounts = OrderedDict()
+        for post in self._posts:
+            post_node = JSONFile(self.vfs, self)
+            post_node.add(s['attr_course_boards_thread_sn'], post['sn'], 'sn')
+            if post['parent'] != '0':
+                post_node.add(s['attr_course_boards_thread_parent'],
+                    post['parent'], 'parent')
+            post_node.add(s['attr_course_boards_thread_subject'],
+                post['subject'], 'subject')
+            post_node.add(s['attr_course_boards_thread_post_time'],
+                post['post_time'], 'post_time')
+            if post['attach'] != '' or post['file_path'] != '':
+                assert post['attach'] != ''
+                extension = post['attach'].rsplit('.', maxsplit=1)[1]
+                post_node.add(s['attr_course_boards_thread_attach'],
+                    post['attach'], 'attach')
+                if post['file_path'] != '':
+                    assert post['file_path'] == post['sn'] + '.' + extension
+                    thread_attachments.append(
+                        (post['sn'], post['attach'], post['file_path']))
+            post_node.add(s['attr_course_boards_thread_author'],
+                post['author'], 'author')
+            collected_accounts[post['author']] = None
+            post_node.add(s['attr_course_boards_thread_cauthor'],
+                post['cauthor'], 'cauthor')
+            post_node.add(s['attr_course_boards_thread_count_rep'],
+                post['count_rep'], 'count_rep')
+            post_node.add(s['attr_course_boards_thread_latest_rep'],
+                post['latest_rep'], 'latest_rep')
+            post_node.finish()
+            content = '\n'.join([
+                '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN"',
+                '  "http://www.w3.org/TR/html4/loose.dtd">',
+                '<html>',
+                '  <head>',
+                '    <meta http-equiv="Content-Type" content="text/html; charset=UTF-8">',
+                '    <title>{}</title>'.format(html.escape(post['subject'])),
+                '  </head>',
+                '  <body>',
+                '    <p>',
+                '      {}'.format(post['content']),
+                '    </p>',
+                '  </body>',
+                '</html>' ]) + '\n'
+            post_content = StringFile(self.vfs, self, content)
+            post_node_filename = format_filename(
+                post['sn'], post['subject'], 'json')
+            post_content_filename = format_filename(
+                post['sn'], post['subject'], 'html')
+            self.add(post_node_filename, post_node)
+            self.add(post_content_filename, post_content)
+        for account in collected_accounts.keys():
+            if quote(account) != account:
+                continue
+            if self.vfs.root.teachers.is_teacher(account):
+                self._authors.append(['teacher', account])
+                self.add(account, InternalLink(self.vfs, self,
+                    self.vfs.root.teachers.add_teacher(
+                        account, pwd=self)))
+            else:
+                self._authors.append(['student', account])
+                self.add(account, InternalLink(self.vfs, self,
+                    self.vfs.root.students.add_student(
+                        account, sn=self._course_sn, pwd=self)))
+        if len(thread_attachments):
+            files_dir = Directory(self.vfs, self)
+            for attachment in thread_attachments:
+                attachment_filename = format_dirname(
+                    attachment[0], attachment[1])
+                attachment_path = '/course/{}/board/{}'.format(
+                    self._course_sn, attachment[2])
+                attachment_file = DownloadFile(
+                    self.vfs, files_dir, attachment_path)
+                # 附件檔名包含文章序號，已經下載過的就不會再改變
+                attachment_file.signature = attachment_path
+                files_dir.add(attachment_filename, attachment_file)
+            files_dir.ready = True
+            self.add(s['dir_course_boards_thread_files'], files_dir)
+        self.ready = True
+
+# 每份作業需要下載的網頁，順序是作業內容、作業評語、作業觀摩
+def homework_page_requests(hw_sn):
+    return [
+        ('/modules/hw/hw_show.php', {'hw_sn': hw_sn}),
+        ('/modules/hw/hw_eval.php', {'hw_sn': hw_sn, 'all': '1'}),
+        ('/modules/hw/hw_view.php', {'hw_sn': hw_sn, 'all': '1'})]
+
 class CourseHomeworksDirectory(Directory):
     def __init__(self, vfs, parent, course_sn, homeworks, api=True):
         super().__init__(vfs, parent)
         self._course_sn = course_sn
         self._homeworks = homeworks
         self._api = api
+        self._listed = False
+        self._homework_pages = dict()
+
+    def list(self):
+        # 列出目錄內容通常表示接下來每份作業都會被讀取
+        self._listed = True
+        return super().list()
+
+    def fetch_homework_pages(self, hw_sn):
+        # 如果目錄已經被列出過，就把所有還沒讀取的作業網頁一次全部送出，之後
+        # 其他作業就可以直接拿到網頁。只讀取單一作業時則不需要這麼做
+        if hw_sn not in self._homework_pages and self._listed:
+            hw_sns = list()
+            for name, node in self._children:
+                if not node.ready and node._hw_sn not in self._homework_pages:
+                    hw_sns.append(node._hw_sn)
+            requests = list()
+            for sn in hw_sns:
+                requests.extend(homework_page_requests(sn))
+            pages = self.vfs.request.web_multi(requests)
+            for index, sn in enumerate(hw_sns):
+                self._homework_pages[sn] = pages[index * 3:index * 3 + 3]
+        return self._homework_pages.pop(hw_sn, None)
 
     def fetch(self):
         if self._api:
@@ -1452,24 +1903,19 @@ class CourseHomeworksHomeworkDirectory(Directory):
         # 作業列表
         hw_list_path = '/modules/hw/hw.php'
 
-        # 作業內容
-        hw_show_path = '/modules/hw/hw_show.php'
-        hw_show_args = {'hw_sn': self._hw_sn}
-
-        # 作業評語
-        hw_eval_path = '/modules/hw/hw_eval.php'
-        hw_eval_args = {'hw_sn': self._hw_sn, 'all': '1'}
-
-        # 作業觀摩
-        hw_view_path = '/modules/hw/hw_view.php'
-        hw_view_args = {'hw_sn': self._hw_sn, 'all': '1'}
+        # 作業內容、作業評語、作業觀摩
+        hw_page_requests = homework_page_requests(self._hw_sn)
+        hw_show_path, hw_eval_path, hw_view_path = \
+            map(lambda x: x[0], hw_page_requests)
 
-        # 按照順序爬網頁
+        # 按照順序爬網頁，作業本身的網頁可能已經由上層目錄一起下載好了
         self.vfs.request.web(frame_path, args=frame_args, allow_return_none=True)
         self.vfs.request.web(hw_list_path, allow_return_none=True)
-        hw_show_page = self.vfs.request.web(hw_show_path, args=hw_show_args)
-        hw_eval_page = self.vfs.request.web(hw_eval_path, args=hw_eval_args)
-        hw_view_page = self.vfs.request.web(hw_view_path, args=hw_view_args)
+        hw_pages = self.parent.fetch_homework_pages(self._hw_sn)
+        if hw_pages == None:
+            hw_pages = list(map(lambda x: self.vfs.request.web(x[0], args=x[1]),
+                hw_page_requests))
+        hw_show_page, hw_eval_page, hw_view_page = hw_pages
 
         def make_date_hour(date, hour):
             assert len(date) == 10
@@ -1924,21 +2370,47 @@ class CourseGradesDirectory(Directory):
         grade_path = '/modules/grade/grade.php'
         grade_args = {}
 
-        # 重複爬網頁直到頁面中沒有隱藏項目為止
         self.vfs.request.web(frame_path, args=frame_args, allow_return_none=True)
-        while True:
-            grade_page = self.vfs.request.web(grade_path, args=grade_args)
-            grade_page_has_hidden_rows = False
-            for a in grade_page.xpath('//div[@id="sect_cont"]/table/tr/td/a'):
+        grade_page = self.vfs.request.web(grade_path, args=grade_args)
+
+        assert len(grade_page.xpath('//table')) > 0
+
+        # 找出所有隱藏子項目的主項目，一次下載所有展開後的頁面，再把每個頁面中
+        # 對應的主項目和子項目搬回第一個頁面
+        def grade_page_main_rows(page):
+            return list(filter(lambda x: x.get('class') != 'sub',
+                page.xpath('//div[@id="sect_cont"]/table[1]/tr')[1:]))
+
+        # 只看主表格中的主項目，其他表格中的連結和主項目無關
+        main_rows = grade_page_main_rows(grade_page)
+        hidden_rows = list()
+        for index, row in enumerate(main_rows):
+            for a in row.xpath('td/a'):
                 path, args = url_to_path_and_args(a.get('href'))
                 if 'op' in args and args['op'] == 'stu_sub':
-                    grade_args = args
-                    grade_page_has_hidden_rows = True
+                    hidden_rows.append((index, args))
                     break
-            if not grade_page_has_hidden_rows:
-                break
 
-        assert len(grade_page.xpath('//table')) > 0
+        if len(hidden_rows) > 0:
+            expanded_pages = self.vfs.request.web_multi(
+                [ (grade_path, args) for index, args in hidden_rows ])
+            for (index, args), expanded_page in zip(hidden_rows,
+                expanded_pages):
+                row = main_rows[index]
+                expanded_main_rows = grade_page_main_rows(expanded_page)
+                assert len(expanded_main_rows) == len(main_rows)
+                expanded_row = expanded_main_rows[index]
+                assert element_get_text(expanded_row[0]) == \
+                    element_get_text(row[0])
+                expanded_sub_rows = list()
+                next_row = expanded_row.getnext()
+                while next_row != None and next_row.get('class') == 'sub':
+                    expanded_sub_rows.append(next_row)
+                    next_row = next_row.getnext()
+                row.getparent().replace(row, expanded_row)
+                main_rows[index] = expanded_row
+                for sub_row in reversed(expanded_sub_rows):
+                    expanded_row.addnext(sub_row)
 
         grade_rows_all = grade_page.xpath('//div[@id="sect_cont"]/table[1]/tr')
         grade_rows = grade_rows_all[1:]
@@ -2399,40 +2871,7 @@ class CourseShareDirectory(Directory):
 
             # 由於這個頁面上很多地方都沒有跳脫 < 和 >，導致有些重要的 a 標籤
             # 連同編碼錯誤的文字一起被刪除，所以我們要想辦法先把它修好……
-            source_index = 0
-            while True:
-                source_index = share_list_source.find('<a href=', source_index)
-                if source_index < 0:
-                    break
-                # 首先往後找，確定在看到 > 之前不會遇到 <
-                not_a_tag = False
-                for c in share_list_source[source_index + 1:]:
-                    if c == '>':
-                        break
-                    elif c == '<':
-                        not_a_tag = True
-                        break
-                # 先遇到就代表這個大概不是 a 標籤，跳過
-                if not_a_tag:
-                    source_index += 8
-                    continue
-                # 接者往回找，如果先遇到 > 就正常，遇到 < 則刪除
-                reset_source_index = False
-                for c_index in reversed(range(source_index)):
-                    if share_list_source[c_index] == '>':
-                        break
-                    elif share_list_source[c_index] == '<':
-                        # 現在我們要刪除索引值是 c_index 的字元
-                        share_list_source = \
-                            share_list_source[:c_index] + \
-                            share_list_source[c_index + 1:]
-                        # 為了避免索引值錯亂，有任何修改就全部重找
-                        reset_source_index = True
-                        break
-                if reset_source_index:
-                    source_index = 0
-                else:
-                    source_index += 8
+            share_list_source = html_repair_unescaped_lt(share_list_source)
 
             if share_list_source != share_list_source_backup:
                 self.vfs.logger.warning(
@@ -2445,8 +2884,9 @@ class CourseShareDirectory(Directory):
                 self.vfs.logger.warning(
                     '但仍然建議應該自行連上 CEIBA 網頁檢查下載到的資料是否正確')
 
-            share_list_page = etree.fromstring(share_list_source,
-                etree.HTMLParser(remove_comments=True))
+            with span('parse', 'parse', path=share_list_path):
+                share_list_page = etree.fromstring(share_list_source,
+                    etree.HTMLParser(remove_comments=True))
             share_list_tables = share_list_page.xpath(
                 '//div[@id="sect_cont"]//table[1]')
 
@@ -2479,20 +2919,10 @@ class CourseShareDirectory(Directory):
             collected_accounts = OrderedDict()
             share_list_dir = Directory(self.vfs, self)
 
+            # 詳細資料的網頁彼此無關，先從清單中找出所有的序號，一次全部送出
+            share_sns = list()
             for share_list_row in share_list_rows:
-                # 名稱
-                if len(share_list_row[0]) == 1:
-                    assert not share_list_row[0].text
-                    assert share_list_row[0][0].tag == 'a'
-                    share_name = element_get_text(share_list_row[0][0]) \
-                        .replace('∼', '～').replace('•', '‧')
-                elif len(share_list_row[0]) == 0:
-                    share_name = element_get_text(share_list_row[0]) \
-                        .replace('∼', '～').replace('•', '‧')
-                else:
-                    assert False
-
-                # 簡介
+                # 序號在簡介欄位的 more 連結中
                 share_list_more_element = share_list_row[1].xpath('.//a')
                 assert len(share_list_more_element) == 1
                 assert share_list_more_element[0].tag == 'a'
@@ -2505,8 +2935,23 @@ class CourseShareDirectory(Directory):
                     share_list_more_element[0].get('href'))
 
                 assert share_show_path.rsplit('/', maxsplit=1)[1] == path
-                share_sn = args['sn']
-                share_show_args = {'sn': share_sn}
+                share_sns.append(args['sn'])
+            share_show_pages = self.vfs.request.web_multi(list(map(
+                lambda x: (share_show_path, {'sn': x}), share_sns)))
+
+            for share_list_row, share_sn, share_show_page in \
+                zip(share_list_rows, share_sns, share_show_pages):
+                # 名稱
+                if len(share_list_row[0]) == 1:
+                    assert not share_list_row[0].text
+                    assert share_list_row[0][0].tag == 'a'
+                    share_name = element_get_text(share_list_row[0][0]) \
+                        .replace('∼', '～').replace('•', '‧')
+                elif len(share_list_row[0]) == 0:
+                    share_name = element_get_text(share_list_row[0]) \
+                        .replace('∼', '～').replace('•', '‧')
+                else:
+                    assert False
 
                 share_file = JSONFile(self.vfs, share_list_dir)
                 share_filename = format_filename(share_sn, share_name, 'json')
@@ -2546,9 +2991,7 @@ class CourseShareDirectory(Directory):
                 share_file.add(s['attr_course_share_views'],
                     share_views, share_list_path)
 
-                # 下載分享詳細資料
-                share_show_page = self.vfs.request.web(
-                    share_show_path, args=share_show_args)
+                # 分享詳細資料
                 share_show_rows = share_show_page.xpath(
                     '//div[@id="sect_cont"]/table/tr')
                 assert len(share_show_rows) == len(share_show_fields)
@@ -2747,9 +3190,10 @@ class CourseShareDirectory(Directory):
         self.ready = True
 
 class CourseVoteDirectory(Directory):
-    def __init__(self, vfs, parent, course_sn):
+    def __init__(self, vfs, parent, course_sn, vote_list_page=None):
         super().__init__(vfs, parent)
         self._course_sn = course_sn
+        self._vote_list_page = vote_list_page
 
     def fetch(self):
         s = self.vfs.strings
@@ -2760,7 +3204,12 @@ class CourseVoteDirectory(Directory):
         vote_list_path = '/modules/vote/vote.php'
 
         self.vfs.request.web(frame_path, args=frame_args, allow_return_none=True)
-        vote_list_page = self.vfs.request.web(vote_list_path)
+        # 檢查功能是否開啟時可能已經下載過了
+        if self._vote_list_page != None:
+            vote_list_page = self._vote_list_page
+            self._vote_list_page = None
+        else:
+            vote_list_page = self.vfs.request.web(vote_list_path)
 
         vote_list_rows_all = vote_list_page.xpath('//div[@id="sect_cont"]/table/tr')
         vote_list_rows = vote_list_rows_all[1:]
@@ -2773,7 +3222,25 @@ class CourseVoteDirectory(Directory):
         assert vote_list_header_row[3].text in ['結束日期', 'End']
         assert vote_list_header_row[4].text in ['結果', 'Results']
 
+        # 投票結果的網頁彼此無關，先從清單中找出所有的 vid，一次全部送出
+        vote_result_path = '/modules/vote/vote_result.php'
+        vote_vids = list()
         for vote_list_row in vote_list_rows:
+            # 結果
+            assert len(vote_list_row[4]) == 1
+            assert vote_list_row[4][0].tag == 'a'
+            assert vote_list_row[4][0].get('onclick')
+
+            vote_result_script = vote_list_row[4][0].get('onclick')
+            vote_result_link = js_window_open_get_url(vote_result_script)
+
+            vote_result_args = url_to_path_and_args(vote_result_link)[1]
+            vote_vids.append(vote_result_args['vid'])
+        vote_result_pages = self.vfs.request.web_multi(list(map(
+            lambda x: (vote_result_path, {'vid': x}), vote_vids)))
+
+        for vote_list_row, vote_vid, vote_result_page in \
+            zip(vote_list_rows, vote_vids, vote_result_pages):
             # 公告日期
             assert len(vote_list_row[0]) == 0
             vote_ann_date = element_get_text(vote_list_row[0])
@@ -2790,17 +3257,6 @@ class CourseVoteDirectory(Directory):
             assert len(vote_list_row[3]) == 0
             vote_end_date = element_get_text(vote_list_row[3])
 
-            # 結果
-            assert len(vote_list_row[4]) == 1
-            assert vote_list_row[4][0].tag == 'a'
-            assert vote_list_row[4][0].get('onclick')
-
-            vote_result_script = vote_list_row[4][0].get('onclick')
-            vote_result_link = js_window_open_get_url(vote_result_script)
-
-            vote_result_args = url_to_path_and_args(vote_result_link)[1]
-            vote_vid = vote_result_args['vid']
-
             vote_file = JSONFile(self.vfs, self)
             vote_filename = format_filename(vote_vid, vote_topic, 'json')
 
@@ -2813,11 +3269,6 @@ class CourseVoteDirectory(Directory):
             vote_file.add(s['attr_course_vote_end_date'],
                 vote_end_date, vote_list_path)
 
-            vote_result_path = '/modules/vote/vote_result.php'
-            vote_result_args = {'vid': vote_vid}
-            vote_result_page = self.vfs.request.web(
-                vote_result_path, args=vote_result_args)
-
             vote_result_rows = vote_result_page.xpath('/html/body/table/tr')
             assert len(vote_result_rows) == 3
 
@@ -3222,11 +3673,22 @@ class BytesFile(Regular):
         self._bytes_content = bytes_content
         self.ready = True
 
-    def read(self, output, progress_callback=lambda *x: None):
+    def read(self, output, progress_callback=lambda *x: None,
+        offset=None, length=None):
         progress_callback(False, None, None, None)
-        output.write(self._bytes_content)
+        if offset == None and length == None:
+            output.write(self._bytes_content)
+        else:
+            start = offset if offset != None else 0
+            end = start + length if length != None else None
+            output.write(memoryview(self._bytes_content)[start:end])
         progress_callback(True, None, None, None)
 
+    def chunks(self, chunk_size=65536):
+        content = memoryview(self._bytes_content)
+        for index in range(0, len(content), chunk_size):
+            yield content[index:index + chunk_size]
+
     def size(self):
         return len(self._bytes_content)
 
@@ -3238,14 +3700,29 @@ class DownloadFile(Regular):
         self.local = False
         self.ready = True
 
-    def read(self, output, progress_callback=lambda *x: None):
-        self.vfs.request.file(
+    @property
+    def remote_path(self):
+        if len(self._args) > 0:
+            return self._path + '?' + urlencode(self._args)
+        return self._path
+
+    # 不需要先送出其他請求就能下載，get --plan 會記錄下來直接使用
+    @property
+    def download_request(self):
+        return (self._path, dict(self._args))
+
+    def read(self, output, progress_callback=lambda *x: None,
+        offset=None, length=None):
+        return self.vfs.request.file(
             self._path, output, args=self._args,
-            progress_callback=progress_callback)
+            progress_callback=progress_callback, offset=offset, length=length)
 
     def size(self):
         return self.vfs.request.file_size(self._path, args=self._args)
 
+    def info(self):
+        return self.vfs.request.file_info(self._path, args=self._args)
+
 class StateDownloadFile(Regular):
     def __init__(self, vfs, parent, path, args={}, steps=[]):
         super().__init__(vfs, parent)
@@ -3255,14 +3732,26 @@ class StateDownloadFile(Regular):
         self.local = False
         self.ready = True
 
-    def read(self, output, progress_callback=lambda *x: None):
+    @property
+    def remote_path(self):
+        if len(self._args) > 0:
+            return self._path + '?' + urlencode(self._args)
+        return self._path
+
+    def read(self, output, progress_callback=lambda *x: None,
+        offset=None, length=None):
         for step_path, step_args in self._steps:
             self.vfs.request.file(step_path, BytesIO(), args=step_args)
-        self.vfs.request.file(
+        return self.vfs.request.file(
             self._path, output, args=self._args,
-            progress_callback=progress_callback)
+            progress_callback=progress_callback, offset=offset, length=length)
 
     def size(self):
         for step_path, step_args in self._steps:
             self.vfs.request.file(step_path, BytesIO(), args=step_args)
         return self.vfs.request.file_size(self._path, args=self._args)
+
+    def info(self):
+        for step_path, step_args in self._steps:
+            self.vfs.request.file(step_path, BytesIO(), args=step_args)
+        return self.vfs.request.file_info(self._path, args=self._args)
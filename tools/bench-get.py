@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# License: LGPL3+
+#
+# 比較 get 依照資料夾順序一次下載一個檔案和 download 區段 concurrent = True 時
+# 依照 scheduler 排序同時下載的差異。檔案由本機的 HTTPS 伺服器提供，每個請求
+# 會先等待 --latency 秒，每個連線的速度限制為 --throughput 位元組每秒。資料夾
+# 中舊學期的課程放了幾個大檔案，目前學期的課程只有小檔案，並把目前學期的課程
+# 設為優先下載。Request 只允許 HTTPS，所以需要用 openssl 指令產生自簽憑證。
+#
+#   python3 tools/bench-get.py [--small 數量] [--large 數量] [--latency 秒]
+
+import argparse
+import http.server
+import logging
+import os
+import pycurl
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir))
+
+from ceiba_dl import Get, Request
+from ceiba_dl.config import Config
+from ceiba_dl.scheduler import Scheduler
+from ceiba_dl.vfs import VFS, Directory, DownloadFile
+
+class BenchRequest(Request):
+    def _create_curl(self):
+        curl = super()._create_curl()
+        curl.setopt(pycurl.SSL_VERIFYPEER, 0)
+        curl.setopt(pycurl.SSL_VERIFYHOST, 0)
+        return curl
+
+def start_server(files, latency, throughput, cert_dir):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_HEAD(self):
+            self.do_GET(head=True)
+
+        def do_GET(self, head=False):
+            size = files[self.path.split('?')[0]]
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            if head:
+                return
+            chunk = b'x' * 65536
+            left = size
+            while left > 0:
+                length = min(left, len(chunk))
+                self.wfile.write(chunk[:length])
+                left -= length
+                time.sleep(length / throughput)
+
+    cert_path = os.path.join(cert_dir, 'cert.pem')
+    key_path = os.path.join(cert_dir, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+        '-subj', '/CN=127.0.0.1', '-days', '1', '-keyout', key_path,
+        '-out', cert_path], check=True, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_path, key_path)
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def build_vfs(url, layout):
+    request = BenchRequest({}, {}, file_url=url)
+    vfs = VFS(request, Config.defaults['strings'],
+        {'add_courses': [], 'add_unenrolled_courses': [], 'delete_files': []})
+    top = Directory(vfs, vfs.root)
+    top.ready = True
+    vfs.root.add('bench', top)
+    for dir_name, names in layout:
+        directory = Directory(vfs, top)
+        directory.ready = True
+        top.add(dir_name, directory)
+        for name in names:
+            directory.add(name, DownloadFile(vfs, directory, '/' + name, {}))
+    return vfs
+
+def run(label, url, layout, config, large_file_size):
+    vfs = build_vfs(url, layout)
+    work_dir = tempfile.mkdtemp(prefix='ceiba-dl-bench-')
+    saved_cwd = os.getcwd()
+    os.chdir(work_dir)
+    finished = dict()
+    start = time.monotonic()
+    def end_callback(path):
+        finished[path] = time.monotonic() - start
+    try:
+        get = Get(vfs, logging.getLogger('bench'), scheduler=Scheduler(
+            config, large_file_size=large_file_size))
+        ok = get.run('/bench', retry=1, end_download_callback=end_callback)
+        total = time.monotonic() - start
+    finally:
+        os.chdir(saved_cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    files = list(filter(lambda x: x[0].count('/') == 3, finished.items()))
+    current = list(filter(lambda x: x[0].startswith('/bench/current/'), files))
+    print('{:12} {:>5}  {:>10.2f}s  {:>10.2f}s  {:>10.2f}s'.format(label,
+        'ok' if ok else '失敗', min(map(lambda x: x[1], files)),
+        max(map(lambda x: x[1], current)), total))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--small', type=int, default=30)
+    parser.add_argument('--small-size', type=int, default=20 * 2**10)
+    parser.add_argument('--large', type=int, default=2)
+    parser.add_argument('--large-size', type=int, default=12 * 2**20)
+    parser.add_argument('--latency', type=float, default=0.15)
+    parser.add_argument('--throughput', type=int, default=4 * 2**20)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    files = dict()
+    large = list(map(lambda x: 'large{}'.format(x), range(args.large)))
+    small = list(map(lambda x: 'small{}'.format(x), range(args.small)))
+    for name in large:
+        files['/' + name] = args.large_size
+    for name in small:
+        files['/' + name] = args.small_size
+    half = len(small) // 2
+    layout = [('old', large + small[:half]), ('current', small[half:])]
+
+    cert_dir = tempfile.mkdtemp(prefix='ceiba-dl-bench-')
+    try:
+        server = start_server(files, args.latency, args.throughput, cert_dir)
+    finally:
+        shutil.rmtree(cert_dir, ignore_errors=True)
+    url = 'https://127.0.0.1:{}'.format(server.server_address[1])
+    large_file_size = min(args.large_size, args.small_size * 2)
+
+    print('{:12} {:>5}  {:>6}  {:>7}  {:>9}'.format(
+        '', '', '第一個檔案', '目前學期', '全部'))
+    run('sequential', url, layout, {'concurrent': False}, large_file_size)
+    run('concurrent', url, layout, {'concurrent': True,
+        'course_priority': ['/bench/current'], 'large_connections': 2},
+        large_file_size)
+    server.shutdown()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
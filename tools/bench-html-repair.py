@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# License: LGPL3+
+#
+# 比較 html_repair_unescaped_lt 和原本逐字刪除 < 的迴圈：先用隨機產生的片段確認
+# 兩者的結果相同，再量測處理不同大小的資源分享清單所需的時間。原本的迴圈每刪除
+# 一個字元就要從頭找起，頁面大的時候可能要跑好幾分鐘，所以超過 --old-limit 的
+# 大小就只量測新的版本。
+#
+#   python3 tools/bench-html-repair.py [--fragments 數量] [--old-limit 位元組]
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir))
+
+from ceiba_dl.vfs import html_repair_unescaped_lt
+
+# CourseShareDirectory 在 html_repair_unescaped_lt 之前使用的版本
+def old_repair(share_list_source):
+    source_index = 0
+    while True:
+        source_index = share_list_source.find('<a href=', source_index)
+        if source_index < 0:
+            break
+        not_a_tag = False
+        for c in share_list_source[source_index + 1:]:
+            if c == '>':
+                break
+            elif c == '<':
+                not_a_tag = True
+                break
+        if not_a_tag:
+            source_index += 8
+            continue
+        reset_source_index = False
+        for c_index in reversed(range(source_index)):
+            if share_list_source[c_index] == '>':
+                break
+            elif share_list_source[c_index] == '<':
+                share_list_source = \
+                    share_list_source[:c_index] + \
+                    share_list_source[c_index + 1:]
+                reset_source_index = True
+                break
+        if reset_source_index:
+            source_index = 0
+        else:
+            source_index += 8
+    return share_list_source
+
+def random_fragment(rng):
+    pieces = ['<', '>', '<a href=', 'a', ' ', '"x"', '<td>', '</a>']
+    return ''.join(rng.choice(pieces) for i in range(rng.randint(0, 20)))
+
+# 每一列的簡介都有一個沒有跳脫的 <，緊接著就是 more 連結
+def share_page(rows):
+    row = ('<tr><td><a href="share_url_show.php?sn={0}">名稱 {0}</a></td>'
+        '<td>簡介 a<b 還有 x<y<a href="share_url_show.php?sn={0}">'
+        '<span class="more">more »</span></a></td>'
+        '<td><a href="mailto:user{0}@ntu.edu.tw">user{0}</a></td>'
+        '<td>5</td><td>10</td></tr>\n')
+    return '<table>' + ''.join(row.format(i) for i in range(rows)) + '</table>'
+
+def measure(function, source):
+    start = time.perf_counter()
+    result = function(source)
+    return time.perf_counter() - start, result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fragments', type=int, default=200000)
+    parser.add_argument('--old-limit', type=int, default=150000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    for i in range(args.fragments):
+        fragment = random_fragment(rng)
+        if old_repair(fragment) != html_repair_unescaped_lt(fragment):
+            print('結果不同：{!r}'.format(fragment))
+            return 1
+    print('{} 個隨機片段的結果相同'.format(args.fragments))
+
+    print('{:>10}  {:>10}  {:>10}'.format('大小', '原本', '現在'))
+    for rows in [250, 500, 1000, 4000]:
+        source = share_page(rows)
+        new_time, new_result = measure(html_repair_unescaped_lt, source)
+        if len(source.encode()) <= args.old_limit:
+            old_time, old_result = measure(old_repair, source)
+            assert old_result == new_result
+            old_text = '{:.3f}s'.format(old_time)
+        else:
+            old_text = '-'
+        print('{:>8}KB  {:>10}  {:>9.3f}s'.format(
+            len(source.encode()) // 1024, old_text, new_time))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())